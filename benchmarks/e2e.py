@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""End-to-end relay benchmark.
+
+Feeds synthetic updates through the bot's update handlers (the same path
+as getUpdates/webhook updates: _on_message -> relay, the command
+dispatcher and the reaction handler) and the send queue, with a scratch
+SQLite database and the fake Bot API server from tests/fake_bot_api.py (in
+a separate process) standing in for Telegram. The traffic is a mix of text
+messages, photos, replies, reactions and mod commands (--mix). Every user
+count runs in a fresh subprocess so peak RSS is per scenario.
+
+Usage: benchmarks/e2e.py [--users 100 1000 ...] [--messages N] [--mix text=80,reaction=20] [--latency S] [-o out.json]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+DEFAULT_USERS = (100, 1000, 10000, 50000)
+TOKEN = "123:abc"
+# Kinds of updates --mix can combine. text, photo and reply are relayed to
+# everyone, reaction reacts to a delivered copy, command is /user sent by a
+# mod in reply to a relayed message.
+KINDS = ("text", "photo", "reply", "reaction", "command")
+RELAYED_KINDS = ("text", "photo", "reply")
+
+def parse_mix(s):
+	"""Parse "text=80,reaction=20" into {kind: weight}."""
+	mix = {}
+	for part in s.split(","):
+		kind, _, weight = part.partition("=")
+		kind = kind.strip()
+		if kind not in KINDS:
+			raise argparse.ArgumentTypeError("unknown kind %r, use one of %s" % (kind, ", ".join(KINDS)))
+		mix[kind] = float(weight or 1)
+	if not any(mix.get(kind, 0) > 0 for kind in RELAYED_KINDS):
+		raise argparse.ArgumentTypeError("the mix needs at least one of %s" % ", ".join(RELAYED_KINDS))
+	return mix
+
+def format_mix(mix):
+	return ",".join("%s=%g" % e for e in mix.items())
+
+def percentile(values, p):
+	if len(values) == 0:
+		return None
+	values = sorted(values)
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def default_messages(users):
+	# keep the number of deliveries per scenario roughly constant
+	return max(3, min(100, 20000 // users))
+
+def _serve_fake_api(conn, latency):
+	from tests.fake_bot_api import FakeBotAPI
+	api = FakeBotAPI(latency=latency).start()
+	conn.send(api.api_url)
+	conn.recv() # block until the benchmark is done
+	conn.send({method: api.count(method) for method in ("sendMessage", "sendPhoto", "setMessageReaction")})
+
+class FakeAPIProcess():
+	"""Runs the fake Bot API in its own process so that its request handling
+	doesn't compete with the bot for the GIL."""
+	def __init__(self, latency):
+		self.conn, child = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=_serve_fake_api, args=(child, latency), daemon=True)
+	def __enter__(self):
+		from tests.fake_bot_api import api_helpers
+		self.process.start()
+		url = self.conn.recv()
+		for helper in api_helpers():
+			helper.API_URL = url
+		return self
+	def stop(self):
+		"""Stop the server, returns the number of calls it got per method."""
+		self.conn.send(None)
+		count = self.conn.recv()
+		self.process.join()
+		return count
+	def __exit__(self, *exc):
+		if self.process.is_alive():
+			self.process.terminate()
+
+def populate(db, users, bot_id):
+	from src.core import RANKS
+	from src.database import User
+	for uid in range(1, users + 1):
+		user = User()
+		user.defaults()
+		user.id = uid
+		user.realname = "user%d" % uid
+		if uid == 1:
+			user.rank = RANKS.mod # sends the mod commands
+		db.addUser(user)
+		db.mark_bot_user_seen(bot_id, uid)
+	db._commit()
+
+def make_message(i, sender, kind="text", reply_to=None):
+	"""Update carrying message i from `sender`, replying to its message `reply_to`."""
+	from telebot.types import Update
+	chat = {"id": sender, "type": "private"}
+	msg = {
+		"message_id": 1000000 + i,
+		"from": {"id": sender, "is_bot": False, "first_name": "user%d" % sender},
+		"chat": chat,
+		"date": int(time.time()),
+	}
+	if kind == "photo":
+		msg["photo"] = [{"file_id": "photo%d" % i, "file_unique_id": "photo%d" % i, "width": 640, "height": 480}]
+		msg["caption"] = "benchmark photo number %d" % i
+	elif kind == "command":
+		msg["text"] = "/user"
+		msg["entities"] = [{"type": "bot_command", "offset": 0, "length": 5}]
+	else:
+		msg["text"] = "benchmark message number %d" % i
+	if reply_to is not None:
+		msg["reply_to_message"] = {"message_id": reply_to, "chat": chat, "date": msg["date"],
+			"from": msg["from"], "text": "earlier message"}
+	return Update.de_json({"update_id": i + 1, "message": msg})
+
+def make_reaction(i, reactor, message_id, emoji="👍"):
+	from telebot.types import Update
+	return Update.de_json({"update_id": i + 1, "message_reaction": {
+		"chat": {"id": reactor, "type": "private"},
+		"message_id": message_id,
+		"user": {"id": reactor, "is_bot": False, "first_name": "user%d" % reactor},
+		"date": int(time.time()),
+		"old_reaction": [],
+		"new_reaction": [{"type": "emoji", "emoji": emoji}],
+	}})
+
+def run_scenario(users, events, latency, senders, use_async, mix):
+	import src.core as core
+	import src.telegram as telegram
+	from src.cache import Cache
+	from src.database import SQLiteDatabase
+	from tests.fake_bot_api import BOT_USER
+
+	tmp = tempfile.TemporaryDirectory()
+	db = SQLiteDatabase(os.path.join(tmp.name, "bench.sqlite"))
+	start = time.perf_counter()
+	populate(db, users, BOT_USER["id"])
+	populate_time = time.perf_counter() - start
+	ch = Cache()
+	config = {"bot_token": TOKEN, "update_workers": 0, "karma_digest_interval": 0,
+		"reaction_mirror_delay": 0, "async_runtime": use_async}
+	if users < 2:
+		mix = {kind: w for kind, w in mix.items() if kind != "reaction"}
+	kinds, weights = zip(*mix.items())
+	rng = random.Random(0)
+
+	with FakeAPIProcess(latency) as api:
+		core.init(config, db, ch)
+		telegram.init(config, db, ch)
+
+		# A fan-out is complete once every copy (and the sender's own mapping) is saved
+		expected = users
+		lock = threading.Lock()
+		saved = {} # msid -> number of mappings saved
+		finished = {} # msid -> perf_counter
+		target = [None] # number of fan-outs to wait for, known once all updates are in
+		all_done = threading.Event()
+		save_mapping = telegram.resolver.saveMapping
+		def tracking_save_mapping(uid, msid, message_id):
+			save_mapping(uid, msid, message_id)
+			with lock:
+				n = saved[msid] = saved.get(msid, 0) + 1
+				if n == expected:
+					finished[msid] = time.perf_counter()
+					if target[0] is not None and len(finished) >= target[0]:
+						all_done.set()
+		telegram.resolver.saveMapping = tracking_save_mapping
+
+		statements = [0]
+		other_statements = 0 # run by the handlers of reactions and commands
+		def count_statement(sql):
+			statements[0] += 1
+		db.db.set_trace_callback(count_statement)
+
+		if telegram.aio is not None:
+			threading.Thread(target=telegram.async_send_thread, daemon=True).start()
+		else:
+			for _ in range(senders):
+				threading.Thread(target=telegram.send_thread, daemon=True).start()
+		# stands in for the scheduler, which queues due reaction mirrors
+		def flush_reactions():
+			while True:
+				telegram._flush_reaction_mirrors()
+				time.sleep(0.1)
+		threading.Thread(target=flush_reactions, daemon=True).start()
+
+		def delivered_copy(not_uid):
+			"""(uid, message_id) of a delivered copy of a relayed message, not owned by not_uid."""
+			while True:
+				with lock:
+					done = list(finished.keys())
+				if done:
+					break
+				time.sleep(0.01)
+			msid = rng.choice(done)
+			uid = rng.randrange(1, users + 1)
+			while uid == not_uid or uid == sender_of[msid]:
+				uid = uid % users + 1
+			return uid, telegram.resolver.getMessageId(uid, msid)
+
+		started = {}
+		sender_of = {} # msid -> sender
+		sent = [] # (sender, message_id) of relayed messages
+		counts = dict.fromkeys(KINDS, 0)
+		rejected = 0
+		start = time.perf_counter()
+		for i in range(events):
+			kind = "text" if i == 0 else rng.choices(kinds, weights)[0]
+			sender = i % users + 1
+			reply_to = None
+			if kind == "reply":
+				sender, reply_to = rng.choice(sent)
+			elif kind == "command":
+				sender, reply_to = sent[0] # the mod's first message
+			if kind == "reaction":
+				reactor, message_id = delivered_copy(None)
+				update = make_reaction(i, reactor, message_id)
+			else:
+				update = make_message(i, sender, kind, reply_to)
+			counts[kind] += 1
+			t0 = time.perf_counter()
+			n = statements[0]
+			telegram._process_update(update)
+			if kind not in RELAYED_KINDS:
+				other_statements += statements[0] - n
+				continue
+			msid = telegram.resolver.getMsid(sender, update.message.message_id)
+			if msid is None:
+				rejected += 1
+				continue
+			started[msid] = t0
+			sender_of[msid] = sender
+			sent.append((sender, update.message.message_id))
+		enqueue_time = time.perf_counter() - start
+		with lock:
+			target[0] = len(started)
+			if len(finished) >= target[0]:
+				all_done.set()
+		messages = len(started)
+		complete = all_done.wait(timeout=max(600, messages * users / 500))
+		# reaction mirrors and notifications still queued
+		telegram.wait_for_queue(timeout=60)
+		elapsed = time.perf_counter() - start
+		db.db.set_trace_callback(None)
+		if telegram.aio is not None:
+			telegram.aio.submit(telegram.async_bot.close_session()).result()
+
+		fanout = [(finished[msid] - t0) * 1000 for msid, t0 in started.items() if msid in finished]
+		deliveries = sum(saved.values()) - len(saved)
+		result = {
+			"users": users,
+			"events": events,
+			"mix": {kind: n for kind, n in counts.items() if n > 0},
+			"messages": messages,
+			"rejected": rejected,
+			"complete": complete,
+			"deliveries": deliveries,
+			"api_calls": api.stop(),
+			"populate_s": round(populate_time, 3),
+			"enqueue_s": round(enqueue_time, 3),
+			"elapsed_s": round(elapsed, 3),
+			"msgs_per_s": round(messages / elapsed, 2),
+			"deliveries_per_s": round(deliveries / elapsed, 1),
+			"fanout_p50_ms": round(percentile(fanout, 50), 1) if fanout else None,
+			"fanout_p99_ms": round(percentile(fanout, 99), 1) if fanout else None,
+			"db_statements_per_message": round((statements[0] - other_statements) / max(messages, 1), 1),
+			"db_statements_per_update": round(statements[0] / max(events, 1), 1),
+			"peak_rss_mib": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+		}
+	tmp.cleanup()
+	return result
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end relay benchmark")
+	parser.add_argument("--users", type=int, nargs="+", default=DEFAULT_USERS, help="user counts to run")
+	parser.add_argument("--messages", type=int, help="updates per scenario (default: scaled by users)")
+	parser.add_argument("--mix", type=parse_mix, default={"text": 1},
+		help="kinds of updates and their weights, e.g. text=70,photo=10,reply=10,reaction=5,command=5 (default: text)")
+	parser.add_argument("--latency", type=float, default=0.0, help="fake Bot API latency per call in seconds")
+	parser.add_argument("--senders", type=int, default=1, help="number of send threads")
+	parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio runtime")
+	parser.add_argument("-o", "--output", help="write JSON results to this file instead of stdout")
+	parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+	args = parser.parse_args()
+	logging.basicConfig(level=logging.ERROR)
+
+	if args.single:
+		users = args.users[0]
+		result = run_scenario(users, args.messages or default_messages(users), args.latency,
+			args.senders, args.use_async, args.mix)
+		print(json.dumps(result))
+		return
+
+	results = []
+	for users in args.users:
+		cmd = [sys.executable, os.path.abspath(__file__), "--single", "--users", str(users),
+			"--latency", str(args.latency), "--senders", str(args.senders), "--mix", format_mix(args.mix)]
+		if args.messages:
+			cmd += ["--messages", str(args.messages)]
+		if args.use_async:
+			cmd.append("--async")
+		print("Running with %d users..." % users, file=sys.stderr)
+		out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+		results.append(json.loads(out.strip().splitlines()[-1]))
+		print(json.dumps(results[-1]), file=sys.stderr)
+
+	report = {"benchmark": "e2e", "python": sys.version.split()[0], "latency": args.latency,
+		"senders": args.senders, "async": args.use_async, "mix": args.mix, "results": results}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of the in-memory data structures.
+
+Covers Cache, MutablePriorityQueue, ScoreKeeper, RepeatMessageDetector, reply
+formatting and text escaping, single-threaded and with several threads contending for their locks.
+
+Usage: benchmarks/micro.py [-n OPS] [--repeat N] [--threads 1 2 4 8] [-k FILTER] [-o out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+	sys.path.insert(0, ROOT)
+
+from src.cache import Cache, CachedMessage
+from src.core import ScoreKeeper, RepeatMessageDetector
+from src.util import MutablePriorityQueue
+import src.replies as rp
+from src.globals import escape_html
+from src.validation import sanitize_text
+
+RECIPIENTS = 100 # copies per message when populating the cache
+
+# Single-threaded benchmarks: setup(n) -> (run, ops)
+BENCHMARKS = {}
+# Contention benchmarks: setup(n, threads) -> (list of thread targets, ops)
+CONTENTION = {}
+
+def bench(name):
+	def deco(f):
+		BENCHMARKS[name] = f
+		return f
+	return deco
+
+def contention(name):
+	def deco(f):
+		CONTENTION[name] = f
+		return f
+	return deco
+
+def populated_cache(messages, recipients=RECIPIENTS, expired=0):
+	ch = Cache()
+	old = datetime.now() - timedelta(hours=49)
+	for i in range(messages):
+		cm = CachedMessage(i % recipients)
+		if i < expired:
+			cm.time = old
+		msid = ch.assignMessageId(cm)
+		for uid in range(recipients):
+			ch.saveMapping(uid, msid, msid * recipients + uid)
+	return ch
+
+# Cache
+
+@bench("cache.assignMessageId")
+def _(n):
+	ch = Cache()
+	def run():
+		for i in range(n):
+			ch.assignMessageId(CachedMessage(i))
+	return run, n
+
+@bench("cache.saveMapping")
+def _(n):
+	ch = Cache()
+	def run():
+		for i in range(n):
+			ch.saveMapping(i % RECIPIENTS, i // RECIPIENTS, i)
+	return run, n
+
+@bench("cache.lookupMapping")
+def _(n):
+	ch = populated_cache(n // RECIPIENTS)
+	def run():
+		for i in range(n):
+			ch.lookupMapping(i % RECIPIENTS, msid=i // RECIPIENTS)
+	return run, n
+
+@bench("cache.lookupMappingByData")
+def _(n):
+	ch = populated_cache(n // RECIPIENTS)
+	def run():
+		for i in range(n):
+			ch.lookupMappingByData(i, uid=i % RECIPIENTS)
+	return run, n
+
+@bench("cache.lookupMappingByData(no uid)")
+def _(n):
+	# linear scan, so far fewer lookups on a smaller cache
+	ch = populated_cache(100)
+	ops = max(n // 1000, 10)
+	def run():
+		for i in range(ops):
+			ch.lookupMappingByData((i * 7919) % (100 * RECIPIENTS))
+	return run, ops
+
+@bench("cache.getRecipientMappings")
+def _(n):
+	messages = n // RECIPIENTS
+	ch = populated_cache(messages)
+	def run():
+		for msid in range(messages):
+			ch.getRecipientMappings(msid)
+	return run, messages
+
+@bench("cache.deleteMappings")
+def _(n):
+	messages = n // RECIPIENTS
+	ch = populated_cache(messages)
+	def run():
+		for msid in range(messages):
+			ch.deleteMappings(msid)
+	return run, messages
+
+@bench("cache.expire (per message, half expired)")
+def _(n):
+	messages = n // RECIPIENTS
+	ch = populated_cache(messages, expired=messages // 2)
+	def run():
+		ch.expire()
+	return run, messages
+
+@bench("cache.getMessages (per cached message)")
+def _(n):
+	messages = n // 10
+	ch = Cache()
+	for i in range(messages):
+		ch.assignMessageId(CachedMessage(i % RECIPIENTS))
+	def run():
+		for uid in range(10):
+			ch.getMessages(uid)
+	return run, messages * 10
+
+# MutablePriorityQueue
+
+@bench("queue.put")
+def _(n):
+	q = MutablePriorityQueue()
+	def run():
+		for i in range(n):
+			q.put(i & 1, i)
+	return run, n
+
+@bench("queue.get")
+def _(n):
+	q = MutablePriorityQueue()
+	for i in range(n):
+		q.put(i & 1, i)
+	def run():
+		for i in range(n):
+			q.get()
+	return run, n
+
+@bench("queue.delete (per queued item)")
+def _(n):
+	q = MutablePriorityQueue()
+	for i in range(n):
+		q.put(0, i)
+	def run():
+		q.delete(lambda item: item % 10 == 0)
+	return run, n
+
+# ScoreKeeper / RepeatMessageDetector
+
+@bench("scores.increaseSpamScore")
+def _(n):
+	sk = ScoreKeeper()
+	def run():
+		for i in range(n):
+			sk.increaseSpamScore(i % 1000, 0.01)
+	return run, n
+
+@bench("scores.getSpamScore")
+def _(n):
+	sk = ScoreKeeper()
+	for uid in range(n):
+		sk.increaseSpamScore(uid, 3)
+	def run():
+		for i in range(n):
+			sk.getSpamScore(i)
+	return run, n
+
+@bench("repeat.check_repeat")
+def _(n):
+	rd = RepeatMessageDetector(max_repeats=4, window_minutes=5)
+	def run():
+		for i in range(n):
+			rd.check_repeat(i % 1000, "message text %d" % (i % 7))
+	return run, n
+
+@bench("repeat.cleanup (per user)")
+def _(n):
+	rd = RepeatMessageDetector(max_repeats=4, window_minutes=5)
+	users = max(n // 10, 1)
+	for i in range(users * 10):
+		rd.check_repeat(i % users, "message text %d" % i)
+	def run():
+		rd.cleanup()
+	return run, users
+
+# Reply formatting
+
+REPLY_STATS = rp.Reply(rp.types.BOT_STATS, queue_depth=12, relayed=3456, delivered=345600,
+	failures=[("RetryAfter", 3)], hit_ratio=0.97, db_p50=0.1, db_p99=1.5, lock_p50=0.01, lock_p99=0.3)
+
+@bench("replies.format (no arguments)")
+def _(n):
+	m = rp.Reply(rp.types.ERR_COMMAND_DISABLED)
+	def run():
+		for i in range(n):
+			rp.formatForTelegram(m)
+	return run, n
+
+@bench("replies.format (arguments)")
+def _(n):
+	m = rp.Reply(rp.types.SUCCESS_DELETEALL, id="abc123", count=17)
+	def run():
+		for i in range(n):
+			rp.formatForTelegram(m)
+	return run, n
+
+@bench("replies.format (template function)")
+def _(n):
+	def run():
+		for i in range(n):
+			rp.formatForTelegram(REPLY_STATS)
+	return run, n
+
+@bench("replies.str.format (uncompiled, for comparison)")
+def _(n):
+	s = rp.format_strs[rp.types.SUCCESS_DELETEALL]
+	def run():
+		for i in range(n):
+			rp.CustomFormatter().format(s, bot_name="", id="abc123", count=17)
+	return run, n
+
+# Escaping and sanitizing user text, 4 KB per call
+
+TEXT_4K = ("Hello <b>world</b> & friends, ünïcødé 🙂\n" * 110)[:4096]
+TEXT_4K_CONTROL = TEXT_4K.replace("\n", "\x00\n", 20)
+
+@bench("text.escape_html (4 KB)")
+def _(n):
+	n = max(n // 100, 1)
+	def run():
+		for i in range(n):
+			escape_html(TEXT_4K)
+	return run, n
+
+@bench("text.sanitize_text (4 KB)")
+def _(n):
+	n = max(n // 100, 1)
+	def run():
+		for i in range(n):
+			sanitize_text(TEXT_4K, max_length=4096)
+	return run, n
+
+@bench("text.sanitize_text (4 KB with control characters)")
+def _(n):
+	n = max(n // 100, 1)
+	def run():
+		for i in range(n):
+			sanitize_text(TEXT_4K_CONTROL, max_length=4096)
+	return run, n
+
+# Lock contention: the same total work split over several threads
+
+@contention("cache.saveMapping+lookupMapping")
+def _(n, threads):
+	ch = populated_cache(100)
+	per = n // threads
+	def target(t):
+		def f():
+			base = (t + 1) * 10000000
+			for i in range(per):
+				if i & 1:
+					ch.saveMapping(i % RECIPIENTS, base + i, base + i)
+				else:
+					ch.lookupMapping(i % RECIPIENTS, msid=i % 100)
+		return f
+	return [target(t) for t in range(threads)], per * threads
+
+@contention("queue.put+get")
+def _(n, threads):
+	q = MutablePriorityQueue()
+	per = n // threads
+	def target(t):
+		def f():
+			for i in range(per):
+				q.put(i & 1, i)
+				q.get()
+		return f
+	return [target(t) for t in range(threads)], per * threads * 2
+
+@contention("scores.increaseSpamScore")
+def _(n, threads):
+	sk = ScoreKeeper()
+	per = n // threads
+	def target(t):
+		def f():
+			for i in range(per):
+				sk.increaseSpamScore(i % 1000, 0.01)
+		return f
+	return [target(t) for t in range(threads)], per * threads
+
+@contention("repeat.check_repeat")
+def _(n, threads):
+	rd = RepeatMessageDetector(max_repeats=4, window_minutes=5)
+	per = n // threads
+	def target(t):
+		def f():
+			for i in range(per):
+				# users are shared so per-user history doesn't depend on the thread count
+				rd.check_repeat((i * threads + t) % 1000, "message text %d" % (i % 7))
+		return f
+	return [target(t) for t in range(threads)], per * threads
+
+def measure(setup, repeat):
+	times = []
+	for _ in range(repeat):
+		run, ops = setup()
+		start = time.perf_counter()
+		run()
+		times.append(time.perf_counter() - start)
+	return times, ops
+
+def run_threads(targets):
+	barrier = threading.Barrier(len(targets) + 1)
+	def wrap(f):
+		def g():
+			barrier.wait()
+			f()
+		return g
+	threads = [threading.Thread(target=wrap(f)) for f in targets]
+	for t in threads:
+		t.start()
+	barrier.wait()
+	start = time.perf_counter()
+	for t in threads:
+		t.join()
+	return time.perf_counter() - start
+
+def result(name, times, ops, **kwargs):
+	best, median = min(times), statistics.median(times)
+	ret = {"name": name, "ops": ops}
+	ret.update(kwargs)
+	ret.update({
+		"best_ns_per_op": round(best / ops * 1e9, 1),
+		"median_ns_per_op": round(median / ops * 1e9, 1),
+		"ops_per_s": round(ops / best),
+	})
+	return ret
+
+def main():
+	parser = argparse.ArgumentParser(description="Microbenchmarks of the in-memory data structures")
+	parser.add_argument("-n", type=int, default=100000, help="operations per benchmark (default 100000)")
+	parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark, the best is reported")
+	parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8], help="thread counts for contention benchmarks")
+	parser.add_argument("-k", dest="filter", help="only run benchmarks whose name contains this")
+	parser.add_argument("-o", "--output", help="write JSON results to this file instead of stdout")
+	args = parser.parse_args()
+
+	results = []
+	for name, setup in BENCHMARKS.items():
+		if args.filter and args.filter not in name:
+			continue
+		times, ops = measure(lambda: setup(args.n), args.repeat)
+		results.append(result(name, times, ops, threads=1))
+		print("%-45s %10.1f ns/op" % (name, results[-1]["best_ns_per_op"]), file=sys.stderr)
+	for name, setup in CONTENTION.items():
+		if args.filter and args.filter not in name:
+			continue
+		for threads in args.threads:
+			times = []
+			for _ in range(args.repeat):
+				targets, ops = setup(args.n, threads)
+				times.append(run_threads(targets))
+			results.append(result("contention:" + name, times, ops, threads=threads))
+			print("%-45s %10.1f ns/op (%d threads)" % ("contention:" + name,
+				results[-1]["best_ns_per_op"], threads), file=sys.stderr)
+
+	report = {"benchmark": "micro", "python": sys.version.split()[0], "n": args.n, "results": results}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import logging
+from datetime import timedelta
+from threading import Thread
+
+class AsyncRuntime():
+	"""Event loop on a dedicated thread, used to run Bot API calls concurrently.
+
+	The number of calls in flight is bounded by a semaphore so that a large
+	fan-out doesn't open hundreds of connections or trip flood limits.
+	All methods except the coroutines may be called from any thread."""
+	def __init__(self, concurrency=16):
+		assert concurrency > 0
+		self.concurrency = concurrency
+		self.loop = asyncio.new_event_loop()
+		self.semaphore = None
+		self.tails = {} # key -> future completed when the latest in_order() user of key is done
+	def start(self):
+		Thread(target=self.loop.run_forever, daemon=True).start()
+		async def setup():
+			self.semaphore = asyncio.Semaphore(self.concurrency)
+		self.submit(setup()).result()
+	def stop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+	def submit(self, coro):
+		"""Schedule a coroutine on the loop, returns a concurrent.futures.Future."""
+		return asyncio.run_coroutine_threadsafe(coro, self.loop)
+	async def bounded(self, coro):
+		async with self.semaphore:
+			return await coro
+	@contextlib.asynccontextmanager
+	async def in_order(self, key):
+		"""Enter only after earlier users of the same key have left. The place in
+		line is taken when entering, without a concurrency slot."""
+		prev = self.tails.get(key)
+		done = self.loop.create_future()
+		self.tails[key] = done
+		try:
+			if prev is not None:
+				await prev
+			yield
+		finally:
+			done.set_result(None)
+			if self.tails.get(key) is done:
+				del self.tails[key]
+	async def ordered(self, key, coro):
+		"""Like bounded(), but only starts after earlier calls with the same key finished."""
+		async with self.in_order(key):
+			return await self.bounded(coro)
+	def fan_out(self, coros, timeout=None):
+		"""Run coroutines concurrently and block until all of them finished.
+		Returns their results in order, with exceptions in place of results."""
+		async def gather():
+			return await asyncio.gather(*(self.bounded(c) for c in coros), return_exceptions=True)
+		return self.submit(gather()).result(timeout)
+
+class AsyncScheduler():
+	"""Counterpart of util.Scheduler running every task as a coroutine on an AsyncRuntime.
+	Plain functions are run in the loop's default executor since they usually
+	block on the database."""
+	def __init__(self, runtime):
+		self.runtime = runtime
+		self.tasks = [] # list of (interval, func)
+	def register(self, func, **kwargs):
+		interval = timedelta(**kwargs) // timedelta(seconds=1)
+		assert interval > 0
+		self.tasks.append((interval, func))
+	@staticmethod
+	async def _task(interval, func):
+		loop = asyncio.get_running_loop()
+		while True:
+			started = loop.time()
+			try:
+				if asyncio.iscoroutinefunction(func):
+					await func()
+				else:
+					await loop.run_in_executor(None, func)
+			except Exception:
+				logging.exception("Exception raised during scheduled task")
+			await asyncio.sleep(max(interval - (loop.time() - started), 0))
+	def run(self):
+		futures = [self.runtime.submit(AsyncScheduler._task(*e)) for e in self.tasks]
+		for f in futures:
+			f.result()
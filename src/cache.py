@@ -1,18 +1,59 @@
 import logging
 import itertools
+import os
+import mmap
+import struct
+from array import array
 from datetime import datetime, timedelta
-from threading import RLock
+from threading import Lock, RLock
 
 from src.globals import *
+import src.metrics as metrics
+
+# bits for CachedMessage.flags
+FLAG_WARNED = 1 # the author was warned for this message
+FLAG_CLEANED = 2 # message was already queued for deletion by /cleanup
+
+# Most messages never receive a vote, so vote containers start out as a shared
+# empty tuple, grow as small tuples and are only promoted to a set once they
+# get past VOTES_SET_THRESHOLD entries.
+_NO_VOTES = ()
+VOTES_SET_THRESHOLD = 8
+# Votes are added from concurrent update workers, so the read-modify-write of
+# upvoted/downvoted (and readers iterating a vote set) happen under this lock.
+_votes_lock = Lock()
+
+def _addVote(votes, uid):
+	if uid in votes:
+		return votes
+	if isinstance(votes, set):
+		votes.add(uid)
+		return votes
+	if len(votes) >= VOTES_SET_THRESHOLD:
+		return set(votes + (uid, ))
+	return votes + (uid, )
 
 class CachedMessage():
-	__slots__ = ('user_id', 'time', 'warned', 'upvoted', 'downvoted')
+	__slots__ = ('user_id', 'time', 'flags', 'upvoted', 'downvoted')
 	def __init__(self, user_id=None):
 		self.user_id = user_id # who has sent this message
 		self.time = datetime.now() # when was this message seen?
-		self.warned = False # was the user warned for this message?
-		self.upvoted = set() # set of users that have given this message karma
-		self.downvoted = set() # set of users that have taken this message karma
+		self.flags = 0 # combination of FLAG_* bits
+		self.upvoted = _NO_VOTES # users that have given this message karma
+		self.downvoted = _NO_VOTES # users that have taken this message karma
+	@property
+	def warned(self): # was the user warned for this message?
+		return self.hasFlag(FLAG_WARNED)
+	@warned.setter
+	def warned(self, v):
+		self.setFlag(FLAG_WARNED, v)
+	def hasFlag(self, flag):
+		return (self.flags & flag) != 0
+	def setFlag(self, flag, v=True):
+		if v:
+			self.flags |= flag
+		else:
+			self.flags &= ~flag
 	def isExpired(self):
 		return datetime.now() >= self.time + timedelta(hours=48)
 	def hasUpvoted(self, user):
@@ -20,9 +61,36 @@ class CachedMessage():
 	def hasDownvoted(self, user):
 		return user.id in self.downvoted
 	def addUpvote(self, user):
-		self.upvoted.add(user.id)
+		"""Record an upvote, returns False if the user has already voted on this message."""
+		with _votes_lock:
+			if user.id in self.upvoted or user.id in self.downvoted:
+				return False
+			self.upvoted = _addVote(self.upvoted, user.id)
+			return True
 	def addDownvote(self, user):
-		self.downvoted.add(user.id)
+		"""Record a downvote, returns False if the user has already voted on this message."""
+		with _votes_lock:
+			if user.id in self.upvoted or user.id in self.downvoted:
+				return False
+			self.downvoted = _addVote(self.downvoted, user.id)
+			return True
+
+# Snapshot file layout (little endian):
+#   header: magic (ends in the format version), next msid, number of messages, number of mappings
+#   messages: msid, user_id, time (unix), flags, #upvotes, #downvotes, then the vote uids
+#   mappings: uid, msid, data
+SNAPSHOT_MAGIC = b"SLC\x02"
+_SNAP_HEADER = struct.Struct("<4sqII")
+_SNAP_MSG = struct.Struct("<qqdBII")
+_SNAP_MAPPING = struct.Struct("<qqq")
+_SNAP_NO_USER = -2**63
+
+def _votesFromArray(a):
+	if len(a) == 0:
+		return _NO_VOTES
+	elif len(a) > VOTES_SET_THRESHOLD:
+		return set(a)
+	return tuple(a)
 
 class Cache():
 	def __init__(self):
@@ -35,6 +103,10 @@ class Cache():
 		# reverse index: msid -> set(uid) to speed up deletions
 		self.msid_index = {}
 
+	def registerMetrics(self):
+		metrics.gauge("cache_messages", "Messages held in the RAM cache", func=lambda: len(self.msgs))
+		metrics.gauge("cache_mappings", "Message id mappings held in the RAM cache", func=lambda: len(self.revmap))
+
 	def _saveMapping(self, x, uid, msid, data):
 		if uid not in x:
 			x[uid] = {}
@@ -85,6 +157,16 @@ class Cache():
 		with self.lock:
 			return self._lookupMapping(self.idmap, uid, msid, data)
 
+	def getRecipientMappings(self, msid):
+		"""Get all (uid, data) pairs saved for msid, using the msid index."""
+		with self.lock:
+			ret = []
+			for uid in self.msid_index.get(msid, ()):
+				data = self.idmap.get(uid, {}).get(msid)
+				if data is not None:
+					ret.append((uid, data))
+			return ret
+
 	def lookupMappingByData(self, data, uid=None):
 		"""Find the msid for a telegram message id (data).
 
@@ -119,12 +201,10 @@ class Cache():
 				return
 			for uid in uids:
 				d = self.idmap.get(uid)
-				if d is not None:
-					d.pop(msid, None)
-				# also remove revmap entries for these uid/data pairs
-				keys_to_delete = [k for k, v in self.revmap.items() if v == msid and k[0] == uid]
-				for k in keys_to_delete:
-					del self.revmap[k]
+				data = d.pop(msid, None) if d is not None else None
+				# also remove the revmap entry for this uid/data pair
+				if data is not None and self.revmap.get((uid, data)) == msid:
+					del self.revmap[(uid, data)]
 
 	def expire(self):
 		ids = set()
@@ -139,3 +219,85 @@ class Cache():
 		if len(ids) > 0:
 			logging.debug("Expired %d entries from cache", len(ids))
 		return ids
+
+	def saveSnapshot(self, path):
+		"""Write messages, votes, flags and the primary mappings to a compact
+		binary file so a restarted process can warm up from it."""
+		buf = bytearray()
+		with self.lock, _votes_lock:
+			next_msid = next(self.counter)
+			self.counter = itertools.count(next_msid)
+			nmappings = sum(len(d) for d in self.idmap.values())
+			buf += _SNAP_HEADER.pack(SNAPSHOT_MAGIC, next_msid, len(self.msgs), nmappings)
+			for msid, cm in self.msgs.items():
+				user_id = _SNAP_NO_USER if cm.user_id is None else cm.user_id
+				buf += _SNAP_MSG.pack(msid, user_id, cm.time.timestamp(), cm.flags,
+					len(cm.upvoted), len(cm.downvoted))
+				if cm.upvoted or cm.downvoted:
+					buf += array("q", itertools.chain(cm.upvoted, cm.downvoted)).tobytes()
+			for uid, mappings in self.idmap.items():
+				for msid, data in mappings.items():
+					buf += _SNAP_MAPPING.pack(uid, msid, data)
+		with open(path + "~", "wb") as f:
+			f.write(buf)
+		os.replace(path + "~", path)
+		logging.debug("Saved cache snapshot (%d messages, %d mappings)", len(self.msgs), nmappings)
+
+	def loadSnapshot(self, path):
+		"""Restore state written by saveSnapshot(). Expired messages and
+		their mappings are skipped. Returns False if there was nothing to load."""
+		try:
+			f = open(path, "rb")
+		except FileNotFoundError:
+			return False
+		cutoff = (datetime.now() - timedelta(hours=48)).timestamp()
+		with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+			magic, next_msid, nmsgs, nmappings = _SNAP_HEADER.unpack_from(mm, 0)
+			if magic != SNAPSHOT_MAGIC:
+				logging.warning("Ignoring cache snapshot with unknown format: %s", path)
+				return False
+			off = _SNAP_HEADER.size
+			msgs = {}
+			for _ in range(nmsgs):
+				msid, user_id, t, flags, nup, ndown = _SNAP_MSG.unpack_from(mm, off)
+				off += _SNAP_MSG.size
+				votes = None
+				if nup + ndown > 0:
+					votes = array("q", mm[off:off + (nup + ndown) * 8])
+					off += (nup + ndown) * 8
+				if t <= cutoff:
+					continue
+				cm = CachedMessage(None if user_id == _SNAP_NO_USER else user_id)
+				cm.time = datetime.fromtimestamp(t)
+				cm.flags = flags
+				if votes is not None:
+					cm.upvoted = _votesFromArray(votes[:nup])
+					cm.downvoted = _votesFromArray(votes[nup:])
+				msgs[msid] = cm
+			mappings = mm[off:off + nmappings * _SNAP_MAPPING.size]
+		n = 0
+		with self.lock:
+			self.msgs.update(msgs)
+			# this is _saveMapping() inlined, it makes a difference for large snapshots
+			idmap, revmap, msid_index = self.idmap, self.revmap, self.msid_index
+			for uid, msid, data in _SNAP_MAPPING.iter_unpack(mappings):
+				if msid not in msgs:
+					continue
+				d = idmap.get(uid)
+				if d is None:
+					d = idmap[uid] = {}
+				d[msid] = data
+				revmap[(uid, data)] = msid
+				uids = msid_index.get(msid)
+				if uids is None:
+					uids = msid_index[msid] = set()
+				uids.add(uid)
+				n += 1
+			self.counter = itertools.count(max(next_msid, next(self.counter)))
+		logging.info("Loaded cache snapshot (%d messages, %d mappings)", len(msgs), n)
+		return True
+
+	def register_tasks(self, sched, snapshot_path, minutes=10):
+		def f():
+			self.saveSnapshot(snapshot_path)
+		sched.register(f, minutes=minutes)
@@ -2,14 +2,18 @@ import logging
 import sys
 from datetime import datetime, timedelta
 from threading import Lock
+from time import monotonic
 from typing import Optional
 
 import src.replies as rp
 from src.globals import *
 from src.database import User, SystemConfig
-from src.cache import CachedMessage
+from src.cache import CachedMessage, FLAG_CLEANED
 from src.util import genTripcode, getLastModFile
 from src.validation import sanitize_text, sanitize_username
+import src.metrics as metrics
+import src.lockprof as lockprof
+from src.sampler import SamplingProfiler, profile_path
 
 launched = None
 is_leader = True
@@ -24,6 +28,7 @@ db = None
 ch = None
 spam_scores = None
 repeat_detector = None
+karma_digest = None
 sign_last_used = {} # uid -> datetime
 vote_up_last_used = {} # uid -> datetime
 vote_down_last_used = {} # uid -> datetime
@@ -44,22 +49,30 @@ vote_down_interval = None
 media_blocked = False
 media_auto_disable_hours = 8
 purge_old_default_days = 7
+karma_digest_interval = 60
+profiler = None
+profile_dir = "profiles"
 
 def relay_message(message, user, msid, reply_msid):
 	return None, msid
 
 def init(config, _db, _ch):
-	global launched, db, ch, spam_scores, repeat_detector, reg_open, log_channel, karma_amount_add, karma_amount_remove, karma_level_names, blacklist_contact, bot_name, karma_is_pats, enable_signing, media_limit_period, sign_interval, vote_up_interval, vote_down_interval, media_blocked, media_auto_disable_hours, is_leader, purge_old_default_days
+	global launched, db, ch, spam_scores, repeat_detector, reg_open, log_channel, karma_amount_add, karma_amount_remove, karma_level_names, blacklist_contact, bot_name, karma_is_pats, enable_signing, media_limit_period, sign_interval, vote_up_interval, vote_down_interval, media_blocked, media_auto_disable_hours, is_leader, purge_old_default_days, karma_digest, karma_digest_interval, profiler, profile_dir
 
 	launched = datetime.now()
 
 	db = _db
 	ch = _ch
+	ch.registerMetrics()
 	spam_scores = ScoreKeeper()
 	repeat_detector = RepeatMessageDetector(
 		max_repeats=config.get("spam_repeat_limit", 4),
 		window_minutes=config.get("spam_repeat_window", 5)
 	)
+	karma_digest = KarmaDigest()
+	karma_digest_interval = int(config.get("karma_digest_interval", 60))
+	profiler = SamplingProfiler()
+	profile_dir = config.get("profile_dir", "profiles")
 
 	reg_open = config.get("reg_open", "")
 	log_channel = config.get("log_channel", False)
@@ -69,6 +82,7 @@ def init(config, _db, _ch):
 	karma_amount_remove = config.get("karma_amount_remove", 1)
 	karma_level_names = config.get("karma_level_names", None)
 	bot_name = config.get("bot_name", "")
+	rp.defaults["bot_name"] = bot_name
 	karma_is_pats = config.get("karma_is_pats", False)
 	blacklist_contact = config.get("blacklist_contact", "")
 	enable_signing = config.get("enable_signing", False)
@@ -100,7 +114,8 @@ def init(config, _db, _ch):
 		db.setSystemConfig(c)
 
 def register_tasks(sched):
-	sched.register(spam_scores.scheduledTask, seconds=SPAM_INTERVAL_SECONDS)
+	if karma_digest_interval > 0:
+		sched.register(karma_digest.scheduledTask, seconds=karma_digest_interval)
 	
 	def task():
 		now = datetime.now()
@@ -137,7 +152,7 @@ def register_tasks(sched):
 						continue
 				if (latest_admin is None or latest_admin < threshold) and (not media_blocked):
 					media_blocked = True
-					Sender.reply(rp.Reply(rp.types.CUSTOM, text="Media has been automatically disabled due to no admin activity."), None, None, None, None)
+					_push_system_message(rp.Reply(rp.types.CUSTOM, text="Media has been automatically disabled due to no admin activity."))
 		except Exception:
 			logging.exception("Error in auto-disable media task")
 
@@ -263,9 +278,64 @@ def getKarmaLevelName(karma):
 		return karma_level_names[getKarmaLevel(karma)]
 	return ""
 
+class UpdateContext():
+	"""State of one incoming update, passed in place of the user to functions
+	decorated with requireUser. The sender is read from the database at most
+	once and changes to it are collected and written back in one go by
+	commit(), which the frontend calls when it is done with the update.
+	`resolve(user_id, message_id)` maps the sender's message ids to msids,
+	lookups are memoized for the update."""
+	__slots__ = ("user_id", "bot_id", "resolve", "msids", "_user", "_changes")
+	_UNKNOWN = object()
+
+	def __init__(self, user_id, bot_id=None, resolve=None):
+		self.user_id = user_id
+		self.bot_id = bot_id
+		self.resolve = resolve
+		self.msids = {} # message id -> msid
+		self._user = None
+		self._changes = {}
+
+	@property
+	def user(self):
+		"""The sender's User, None if they are not known."""
+		if self._user is None:
+			try:
+				self._user = db.getUser(id=self.user_id)
+			except KeyError:
+				self._user = UpdateContext._UNKNOWN
+		return None if self._user is UpdateContext._UNKNOWN else self._user
+
+	def update(self, **fields):
+		"""Change fields of the sender, written to the database on commit()."""
+		user = self.user
+		for k, v in fields.items():
+			setattr(user, k, v)
+		self._changes.update(fields)
+
+	def getMsid(self, message_id):
+		if message_id not in self.msids:
+			self.msids[message_id] = self.resolve(self.user_id, message_id)
+		return self.msids[message_id]
+
+	def commit(self):
+		if len(self._changes) == 0:
+			return
+		changes, self._changes = self._changes, {}
+		try:
+			db.updateUser(self.user_id, **changes)
+		finally:
+			_invalidate_user_cache(self.user_id)
+
 def requireUser(func):
 	def wrapper(c_user, *args, **kwargs):
-		if isinstance(c_user, User):
+		if isinstance(c_user, UpdateContext):
+			user = c_user.user
+			if user is None:
+				return rp.Reply(rp.types.USER_NOT_IN_CHAT, bot_name=bot_name)
+			c_user.update(lastActive=datetime.now())
+			return _checkUser(func, user, *args, **kwargs)
+		elif isinstance(c_user, User):
 			user = c_user
 		else:
 			try:
@@ -276,15 +346,16 @@ def requireUser(func):
 		with db.modifyUser(id=user.id) as user:
 			updateUserFromEvent(user, c_user)
 		_invalidate_user_cache(user.id)
-
-		if user.isBlacklisted():
-			return rp.Reply(rp.types.ERR_BLACKLISTED, reason=user.blacklistReason, contact=blacklist_contact)
-		elif not user.isJoined():
-			return rp.Reply(rp.types.USER_NOT_IN_CHAT, bot_name=bot_name)
-
-		return func(user, *args, **kwargs)
+		return _checkUser(func, user, *args, **kwargs)
 	return wrapper
 
+def _checkUser(func, user, *args, **kwargs):
+	if user.isBlacklisted():
+		return rp.Reply(rp.types.ERR_BLACKLISTED, reason=user.blacklistReason, contact=blacklist_contact)
+	elif not user.isJoined():
+		return rp.Reply(rp.types.USER_NOT_IN_CHAT, bot_name=bot_name)
+	return func(user, *args, **kwargs)
+
 def requireRank(need_rank):
 	def f(func):
 		def wrapper(user, *args, **kwargs):
@@ -307,32 +378,58 @@ def requireAdmin(func):
 		return func(*args, **kwargs)
 	return wrapper
 
+SPAM_REJECTIONS = metrics.counter("spam_rejections_total", "Messages rejected by spam protection", ("reason", ))
+SYSTEM_MESSAGES = metrics.counter("system_messages_total", "Messages sent by the bot itself")
+
 ###
 
 # RAM cache for spam scores
 
 class ScoreKeeper():
-	def __init__(self):
+	"""Spam scores decaying by 1 every `interval` seconds. The decay is
+	computed from the time of a user's last update when the score is read,
+	so there's no periodic sweep over all users. Entries that have decayed
+	to 0 are dropped once the number of writes since the last prune exceeds
+	the number of entries, which keeps that cost constant per write."""
+	def __init__(self, interval=SPAM_INTERVAL_SECONDS, clock=monotonic):
 		self.lock = Lock()
-		self.scores = {}
+		self.interval = interval
+		self.clock = clock
+		self.scores = {} # uid -> (score, time of last update)
+		self.writes = 0 # since the last prune
+	def getSpamScore(self, uid):
+		now = self.clock()
+		with self.lock:
+			e = self.scores.get(uid)
+			if e is None:
+				return 0
+			return max(0, e[0] - (now - e[1]) / self.interval)
 	def increaseSpamScore(self, uid, n):
+		now = self.clock()
 		with self.lock:
-			s = self.scores.get(uid, 0)
+			self.writes += 1
+			if self.writes > len(self.scores):
+				self._prune(now)
+			e = self.scores.get(uid)
+			s = 0 if e is None else e[0] - (now - e[1]) / self.interval
+			if s < 0:
+				s = 0
 			if s > SPAM_LIMIT:
 				return False
 			elif s + n > SPAM_LIMIT:
-				self.scores[uid] = SPAM_LIMIT_HIT
+				self.scores[uid] = (SPAM_LIMIT_HIT, now)
 				return s + n <= SPAM_LIMIT_HIT
-			self.scores[uid] = s + n
+			if s + n > 0:
+				self.scores[uid] = (s + n, now)
+			elif e is not None:
+				del self.scores[uid]
 			return True
-	def scheduledTask(self):
-		with self.lock:
-			for uid in list(self.scores.keys()):
-				s = self.scores[uid] - 1
-				if s <= 0:
-					del self.scores[uid]
-				else:
-					self.scores[uid] = s
+	def _prune(self, now):
+		# caller holds the lock
+		interval = self.interval
+		for uid in [uid for uid, e in self.scores.items() if e[0] <= (now - e[1]) / interval]:
+			del self.scores[uid]
+		self.writes = 0
 
 class RepeatMessageDetector():
 	"""Detects repeated messages and applies cooldowns for spam."""
@@ -386,6 +483,53 @@ class RepeatMessageDetector():
 				if not self.recent_messages[uid]:
 					del self.recent_messages[uid]
 
+class KarmaDigest():
+	"""Aggregates karma received through reactions per author. The first
+	reaction is notified right away, the ones following it within the
+	interval are sent as one digest, so that a popular message results in at
+	most one notification per interval instead of one per reaction."""
+	def __init__(self):
+		self.lock = Lock()
+		# uid -> [user, karma sum, count, last msid, last emoji, karma_is_pats],
+		# authors without an entry haven't been notified during this interval
+		self.pending = {}
+	def add(self, user, karma_change, msid, emoji, karma_is_pats):
+		"""Returns True if the author should be notified right away instead."""
+		with self.lock:
+			e = self.pending.get(user.id)
+			if e is None:
+				self.pending[user.id] = [user, 0, 0, None, None, None]
+				return True
+			e[0] = user
+			e[1] += karma_change
+			e[2] += 1
+			e[3:] = [msid, emoji, karma_is_pats]
+			return False
+	def scheduledTask(self):
+		with self.lock:
+			pending = self.pending
+			# authors who got a digest keep collecting for the next interval,
+			# the others are notified right away again
+			self.pending = {uid: [e[0], 0, 0, None, None, None] for uid, e in pending.items() if e[2] > 0}
+		for user, karma_sum, count, msid, emoji, is_pats in pending.values():
+			if count == 0:
+				continue
+			elif count == 1:
+				m = rp.Reply(rp.types.SUCCESS_EMOJI_RECEIVED,
+					karma_change=karma_sum, emoji=emoji, karma_is_pats=is_pats)
+				_push_system_message(m, who=user, reply_to=msid)
+			else:
+				m = rp.Reply(rp.types.SUCCESS_EMOJI_DIGEST,
+					karma_change=karma_sum, count=count, karma_is_pats=is_pats)
+				_push_system_message(m, who=user)
+
+def _notify_karma_received(sender, msid, karma_change, emoji, is_pats):
+	if karma_digest_interval > 0 and not karma_digest.add(sender, karma_change, msid, emoji, is_pats):
+		return
+	notification = rp.Reply(rp.types.SUCCESS_EMOJI_RECEIVED,
+		karma_change=karma_change, emoji=emoji, karma_is_pats=is_pats)
+	_push_system_message(notification, who=sender, reply_to=msid)
+
 ###
 
 # Event receiver template and Sender class that fwds to all registered event receivers
@@ -421,7 +565,8 @@ class Sender(Receiver): # flawless class hierachy I know...
 
 def registerReceiver(obj):
 	assert issubclass(obj, Receiver)
-	Sender.receivers.append(obj)
+	if obj not in Sender.receivers:
+		Sender.receivers.append(obj)
 	return obj
 
 ####
@@ -606,6 +751,60 @@ def get_bot_info(user):
 	}
 	return rp.Reply(rp.types.BOT_INFO, **params)
 
+@requireUser
+@requireRank(RANKS.admin)
+def get_stats(user):
+	def ms(name, q):
+		m = metrics.REGISTRY.get(name)
+		v = m.quantile(q) if m is not None else None
+		return "-" if v is None else "%.2f" % (v * 1000)
+	def value(name):
+		m = metrics.REGISTRY.get(name)
+		return m.get() if m is not None else 0
+	failures = metrics.REGISTRY.get("send_failures_total")
+	failures = sorted(failures.collect().items(), key=lambda e: -e[1]) if failures is not None else []
+	params = {
+		"queue_depth": value("send_queue_depth"),
+		"relayed": value("relayed_messages_total"),
+		"delivered": value("delivered_messages_total"),
+		"failures": [(k[0], v) for k, v in failures],
+		"hit_ratio": value("resolver_hit_ratio"),
+		"db_p50": ms("db_query_seconds", 0.5),
+		"db_p99": ms("db_query_seconds", 0.99),
+		"lock_p50": ms("db_lock_held_seconds", 0.5),
+		"lock_p99": ms("db_lock_held_seconds", 0.99),
+	}
+	return rp.Reply(rp.types.BOT_STATS, **params)
+
+@requireUser
+@requireRank(RANKS.admin)
+def get_lock_stats(user):
+	if lockprof.profiler is None:
+		return rp.Reply(rp.types.LOCK_STATS, report=None)
+	return rp.Reply(rp.types.LOCK_STATS, report=lockprof.profiler.formatReport())
+
+@requireUser
+@requireRank(RANKS.admin)
+def get_db_stats(user):
+	stats = db.getQueryStats(top=10)
+	if stats is None:
+		return rp.Reply(rp.types.DB_STATS, report=None)
+	lines = ["%d× %.3fs total, %.2fms avg, %.1fms max, %d slow:\n  %s" % (
+		e["count"], e["total"], e["avg"] * 1000, e["max"] * 1000, e["slow"],
+		e["sql"] if len(e["sql"]) <= 200 else e["sql"][:200] + "…") for e in stats]
+	return rp.Reply(rp.types.DB_STATS, report="\n".join(lines) or "no statements recorded")
+
+@requireUser
+@requireRank(RANKS.admin)
+def start_profiling(user, seconds):
+	seconds = min(max(seconds, 1), 300)
+	def done(path, samples):
+		_push_system_message(rp.Reply(rp.types.PROFILE_DONE, path=path, samples=samples), who=user)
+	if not profiler.start(seconds, profile_path(profile_dir), done):
+		return rp.Reply(rp.types.ERR_PROFILE_RUNNING)
+	logging.info("%s started the profiler for %ds", user, seconds)
+	return rp.Reply(rp.types.PROFILE_STARTED, seconds=seconds)
+
 @requireUser
 def get_users(user):
 	active, inactive, black, cooldown = 0, 0, 0, 0
@@ -905,12 +1104,12 @@ def cleanup_messages(user):
 	def f(msid: int, cm: CachedMessage):
 		if cm.user_id is None:
 			return
-		if 1337 in cm.upvoted: # mark that we've been here before
+		if cm.hasFlag(FLAG_CLEANED): # we've been here before
 			return
 		user2 = db.getUser(id=cm.user_id)
 		if user2.isBlacklisted():
 			msids.append(msid)
-			cm.upvoted.add(1337)
+			cm.setFlag(FLAG_CLEANED)
 	ch.iterateMessages(f)
 	logging.info("%s invoked cleanup (matched: %d)", user, len(msids))
 	Sender.delete(msids)
@@ -1118,14 +1317,12 @@ def handle_message_reaction(user, msid, emoji):
 	if norm in negative_reactions:
 		# Negative karma for thumbs down and poop
 		karma_change = -karma_amount_remove
-		result = modify_karma(user, msid, karma_change, emoji=emoji)
+		result = _modify_karma(user, msid, karma_change, emoji=emoji)
 		if result.type == rp.types.ERR_VOTE_OWN_MESSAGE:
 			return result
 		
 		if not sender.hideKarma:
-			notification = rp.Reply(rp.types.SUCCESS_EMOJI_RECEIVED, 
-				karma_change=karma_change, emoji=emoji, karma_is_pats=False)
-			_push_system_message(notification, who=sender, reply_to=msid)
+			_notify_karma_received(sender, msid, karma_change, emoji, False)
 		
 		return rp.Reply(rp.types.SUCCESS_EMOJI_REACTION, karma_change=karma_change, emoji=emoji, karma_is_pats=False, bot_name=bot_name)
 	else:
@@ -1133,19 +1330,20 @@ def handle_message_reaction(user, msid, emoji):
 		karma_change = karma_amount_add
 		# Consider heart emojis as "pats" for display purposes
 		is_pat = emoji in {"❤️", "🥰", "💖", "💗", "💓", "💝"}
-		result = modify_karma(user, msid, karma_change, emoji=emoji, karma_is_pats=is_pat)
+		result = _modify_karma(user, msid, karma_change, emoji=emoji, karma_is_pats=is_pat)
 		if result.type == rp.types.ERR_VOTE_OWN_MESSAGE:
 			return result
 		
 		if not sender.hideKarma:
-			notification = rp.Reply(rp.types.SUCCESS_EMOJI_RECEIVED, 
-				karma_change=karma_change, emoji=emoji, karma_is_pats=is_pat)
-			_push_system_message(notification, who=sender, reply_to=msid)
+			_notify_karma_received(sender, msid, karma_change, emoji, is_pat)
 		
 		return rp.Reply(rp.types.SUCCESS_EMOJI_REACTION, karma_change=karma_change, emoji=emoji, karma_is_pats=is_pat, bot_name=bot_name)
 
 @requireUser
 def modify_karma(user, msid, amount, emoji=None, karma_is_pats=False):
+	return _modify_karma(user, msid, amount, emoji, karma_is_pats)
+
+def _modify_karma(user, msid, amount, emoji=None, karma_is_pats=False):
 	cm = ch.getMessage(msid)
 	if cm is None or cm.user_id is None:
 		return rp.Reply(rp.types.ERR_NOT_IN_CACHE)
@@ -1171,7 +1369,8 @@ def modify_karma(user, msid, amount, emoji=None, karma_is_pats=False):
 				return rp.Reply(rp.types.ERR_SPAMMY_VOTE_UP, **params)
 			vote_up_last_used[user.id] = datetime.now()
 
-		cm.addUpvote(user)
+		if not cm.addUpvote(user): # lost a race with another vote by this user
+			return rp.Reply(rp.types.ERR_ALREADY_VOTED_UP, **params)
 	elif amount < 0:
 		if vote_down_interval.total_seconds() > 1:
 			last_used = vote_down_last_used.get(user.id, None)
@@ -1179,7 +1378,8 @@ def modify_karma(user, msid, amount, emoji=None, karma_is_pats=False):
 				return rp.Reply(rp.types.ERR_SPAMMY_VOTE_DOWN, **params)
 			vote_down_last_used[user.id] = datetime.now()
 
-		cm.addDownvote(user)
+		if not cm.addDownvote(user):
+			return rp.Reply(rp.types.ERR_ALREADY_VOTED_DOWN, **params)
 	else:
 		return
 
@@ -1214,34 +1414,41 @@ def prepare_user_message(user: User, msg_score, *, is_media=False, signed=False,
 			with db.modifyUser(id=user.id) as u:
 				u.cooldownUntil = datetime.now() + cooldown_duration
 			logging.warning("%s triggered repeat spam detection (sent same message %d times)", user, repeat_count)
+			SPAM_REJECTIONS.inc(reason="repeat")
 			return rp.Reply(rp.types.ERR_SPAMMY)
 
 	ok = spam_scores.increaseSpamScore(user.id, msg_score)
 	if not ok:
+		SPAM_REJECTIONS.inc(reason="score")
 		return rp.Reply(rp.types.ERR_SPAMMY)
 
 	if (signed or ksigned) and sign_interval.total_seconds() > 1:
 		last_used = sign_last_used.get(user.id, None)
 		if last_used and (datetime.now() - last_used) < sign_interval:
+			SPAM_REJECTIONS.inc(reason="sign")
 			return rp.Reply(rp.types.ERR_SPAMMY_SIGN)
 		sign_last_used[user.id] = datetime.now()
 
 	return ch.assignMessageId(CachedMessage(user.id))
 
 def _push_system_message(m, *, who=None, except_who=None, reply_to=None):
+	SYSTEM_MESSAGES.inc()
 	msid = None
 	if who is None:
 		msid = ch.assignMessageId(CachedMessage())
 	Sender.reply(m, msid, who, except_who, reply_to)
 
-def check_repeat_spam(user_id, message_text):
+def check_repeat_spam(ctx, message_text):
 	"""
 	Check if a user is spamming repeated messages.
 	Returns (should_block, repeat_count) tuple.
-	Automatically applies cooldown if spam detected.
+	Automatically applies cooldown (on ctx.commit()) if spam detected.
 	"""
+	user_id = ctx.user_id
 	try:
-		user = db.getUser(id=user_id)
+		user = ctx.user
+		if user is None:
+			raise KeyError(user_id)
 		
 		# Mods and admins are exempt from repeat spam detection
 		if user.rank >= RANKS.mod:
@@ -1253,8 +1460,7 @@ def check_repeat_spam(user_id, message_text):
 		if is_spam:
 			# Apply automatic cooldown
 			cooldown_duration = timedelta(minutes=5)
-			with db.modifyUser(id=user_id) as u:
-				u.cooldownUntil = datetime.now() + cooldown_duration
+			ctx.update(cooldownUntil=datetime.now() + cooldown_duration)
 			logging.warning("User %d triggered repeat spam detection (sent same message %d times)", user_id, repeat_count)
 			return True, repeat_count
 		
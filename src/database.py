@@ -2,14 +2,20 @@ import logging
 import os
 import json
 import sqlite3
+import time
 from datetime import date, datetime, timedelta, timezone
 from random import randint
-from threading import RLock
+from threading import Lock, RLock
 from typing import Optional
 
 from typing import Optional, Iterator
 
 from src.globals import *
+from src.metrics import TimedLock
+import src.metrics as metrics
+
+DB_QUERY_TIME = metrics.histogram("db_query_seconds", "Time spent executing SQL statements")
+DB_LOCK_HELD = metrics.histogram("db_lock_held_seconds", "Time Database.lock was held per acquisition")
 
 # what's inside the db
 
@@ -136,12 +142,15 @@ class ModificationContext():
 
 class Database():
 	def __init__(self):
-		self.lock = RLock()
+		self.lock = TimedLock(RLock(), DB_LOCK_HELD)
 		assert self.__class__ != Database # do not instantiate directly
 	def register_tasks(self, sched):
 		raise NotImplementedError()
 	def close(self):
 		raise NotImplementedError()
+	def getQueryStats(self, top=None):
+		"""Per-statement timings, most total time first, or None if the backend doesn't keep them."""
+		return None
 	def getUser(self, id: Optional[int] = None) -> User:
 		"""
 		Get user by ID.
@@ -183,6 +192,12 @@ class Database():
 		with self.lock:
 			l = list(self.getUser(id=id) for id in self.iterateUserIds())
 		yield from l
+	def updateUser(self, id: int, **fields) -> None:
+		"""Set only the given fields of a user, changes made concurrently to
+		other fields are kept."""
+		with self.modifyUser(id=id) as user:
+			for k, v in fields.items():
+				setattr(user, k, v)
 	def modifyUser(self, **kwargs):
 		with self.lock:
 			user = self.getUser(**kwargs)
@@ -295,6 +310,8 @@ class JSONDatabase(Database):
 		return
 	def get_msid_by_uid_message(self, uid: int, message_id: int, bot_id: Optional[int] = None):
 		return None
+	def get_message_id_by_uid_msid(self, uid: int, msid: int, bot_id: Optional[int] = None):
+		return None
 	def get_recipient_mappings_by_msid(self, msid: int, bot_id: Optional[int] = None):
 		return []
 	def delete_message_mappings(self, msid: int, bot_id: Optional[int] = None):
@@ -340,11 +357,89 @@ class JSONDatabase(Database):
 
 # SQLite implementation
 
+class _QueryStats():
+	"""Per-statement execution counters, keyed by the whitespace-normalized SQL."""
+	def __init__(self):
+		self.lock = Lock()
+		self.keys = {} # raw sql -> normalized sql
+		self.stats = {} # normalized sql -> [count, total, max, slow]
+	def key(self, sql):
+		k = self.keys.get(sql)
+		if k is None:
+			k = self.keys[sql] = " ".join(sql.split())
+		return k
+	def record(self, key, elapsed, slow):
+		with self.lock:
+			s = self.stats.get(key)
+			if s is None:
+				s = self.stats[key] = [0, 0.0, 0.0, 0]
+			s[0] += 1
+			s[1] += elapsed
+			s[2] = max(s[2], elapsed)
+			if slow:
+				s[3] += 1
+	def get(self, top=None):
+		"""Return stats as dicts, most total time first."""
+		with self.lock:
+			items = [(k, list(v)) for k, v in self.stats.items()]
+		items.sort(key=lambda e: e[1][1], reverse=True)
+		return [{"sql": k, "count": s[0], "total": s[1], "avg": s[1] / s[0], "max": s[2], "slow": s[3]}
+			for k, s in items[:top]]
+
+# only these are worth an EXPLAIN QUERY PLAN
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+class _TimedConnection():
+	"""sqlite3.Connection wrapper timing every statement executed through it.
+	Statements slower than `slow_threshold` seconds are logged together with
+	their query plan (at most once a minute per statement).
+	Note that for SELECTs this covers the first step, not fetching all rows."""
+	def __init__(self, conn, slow_threshold=None):
+		object.__setattr__(self, "_conn", conn)
+		object.__setattr__(self, "slow_threshold", slow_threshold)
+		object.__setattr__(self, "query_stats", _QueryStats())
+		object.__setattr__(self, "_slow_logged", {}) # normalized sql -> monotonic time
+	def execute(self, sql, parameters=()):
+		start = time.perf_counter()
+		try:
+			return self._conn.execute(sql, parameters)
+		finally:
+			elapsed = time.perf_counter() - start
+			DB_QUERY_TIME.observe(elapsed)
+			slow = self.slow_threshold is not None and elapsed >= self.slow_threshold
+			key = self.query_stats.key(sql)
+			self.query_stats.record(key, elapsed, slow)
+			if slow:
+				self._logSlow(key, sql, parameters, elapsed)
+	def _logSlow(self, key, sql, parameters, elapsed):
+		now = time.monotonic()
+		last = self._slow_logged.get(key)
+		if last is not None and now - last < 60:
+			return
+		self._slow_logged[key] = now
+		plan = None
+		if key.upper().startswith(_EXPLAINABLE):
+			try:
+				rows = self._conn.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+				plan = "; ".join(row[-1] for row in rows)
+			except sqlite3.Error as e:
+				plan = "unavailable (%s)" % e
+		logging.warning("Slow query (%.1fms): %s%s", elapsed * 1000, key,
+			"" if plan is None else "\n  plan: " + plan)
+	def __getattr__(self, name):
+		return getattr(self._conn, name)
+	def __setattr__(self, name, value):
+		if name == "slow_threshold":
+			object.__setattr__(self, name, value)
+		else:
+			setattr(self._conn, name, value)
+
 class SQLiteDatabase(Database):
-	def __init__(self, path):
+	def __init__(self, path, slow_query_ms=100):
 		super(SQLiteDatabase, self).__init__()
-		self.db = sqlite3.connect(path, check_same_thread=False,
-			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+		self.db = _TimedConnection(sqlite3.connect(path, check_same_thread=False,
+			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES),
+			slow_threshold=slow_query_ms / 1000 if slow_query_ms else None)
 		self.db.row_factory = sqlite3.Row
 		self._mm_has_bot_id = False
 		self._pending_commits = 0
@@ -362,6 +457,8 @@ class SQLiteDatabase(Database):
 		def f():
 			self._commit()
 		sched.register(f, seconds=5)
+	def getQueryStats(self, top=None):
+		return self.db.query_stats.get(top)
 	def close(self):
 		with self.lock:
 			if self._pending_commits > 0:
@@ -546,6 +643,23 @@ CREATE TABLE IF NOT EXISTS `bot_users` (
 				logging.error("Failed to get msid by uid/message: %s", e)
 				return None
 
+	def get_message_id_by_uid_msid(self, uid: int, msid: int, bot_id: Optional[int] = None):
+		"""Return the message_id of the copy of msid that uid received (uses idx_mm_uid_msid)."""
+		if self._mm_has_bot_id and bot_id is not None:
+			sql = "SELECT message_id FROM message_mapping WHERE uid = ? AND msid = ? AND (bot_id = ? OR bot_id IS NULL) LIMIT 1"
+			params = (uid, msid, bot_id)
+		else:
+			sql = "SELECT message_id FROM message_mapping WHERE uid = ? AND msid = ? LIMIT 1"
+			params = (uid, msid)
+		with self.lock:
+			try:
+				cur = self.db.execute(sql, params)
+				row = cur.fetchone()
+				return row[0] if row else None
+			except Exception as e:
+				logging.error("Failed to get message id by uid/msid: %s", e)
+				return None
+
 	def get_recipient_mappings_by_msid(self, msid: int, bot_id: Optional[int] = None):
 		"""Return list of (uid, message_id) for all recipients of msid."""
 		if self._mm_has_bot_id and bot_id is not None:
@@ -817,6 +931,17 @@ CREATE TABLE IF NOT EXISTS `bot_users` (
 		with self.lock:
 			self.db.execute(sql, param)
 			self._mark_dirty()
+	def updateUser(self, id, **fields):
+		if len(fields) == 0:
+			return
+		assert all(k in USER_PROPS and k != "id" for k in fields.keys())
+		sql = "UPDATE users SET "
+		sql += ", ".join("`%s` = ?" % k for k in fields.keys())
+		sql += " WHERE id = ?"
+		param = list(fields.values()) + [id, ]
+		with self.lock:
+			self.db.execute(sql, param)
+			self._mark_dirty()
 	def addUser(self, newuser):
 		newuser = SQLiteDatabase._userToDict(newuser)
 		sql = "INSERT INTO users("
@@ -3,12 +3,8 @@ from src.util import Enum
 
 # a few utility functions
 def escape_html(s):
-	ret = ""
-	for c in s:
-		if c in ("<", ">", "&"):
-			c = "&#" + str(ord(c)) + ";"
-		ret += c
-	return ret
+	# "&" first so the entities added after it are left alone
+	return s.replace("&", "&#38;").replace("<", "&#60;").replace(">", "&#62;")
 
 def format_datetime(t, local=False):
 	if local:
@@ -0,0 +1,121 @@
+import logging
+import time
+from queue import Queue, Empty
+from threading import Lock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class HTTPSessionPool():
+	"""Fixed set of keep-alive HTTP sessions shared by all threads talking to the Bot API.
+
+	Without this every thread gets its own session which is thrown away (with
+	its connections) every few minutes. Here `size` sessions are handed out to
+	whichever thread needs one; a thread blocks if all of them are in use.
+	A long-polling getUpdates holds a session for its whole duration.
+
+	`request` has the signature telebot.apihelper.CUSTOM_REQUEST_SENDER expects.
+	"""
+	def __init__(self, size=8, connect_timeout=5, read_timeout=None):
+		assert size > 0
+		self.size = size
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.sessions = Queue()
+		self.all_sessions = []
+		# requests scans the environment (proxies, CA bundle, .netrc) on every
+		# call, which costs more than the request itself on a fast connection.
+		# The settings are resolved once per host instead (see _environSettings).
+		self.env_settings = {}
+		for _ in range(size):
+			session = requests.Session()
+			session.trust_env = False
+			# a session only ever runs one request at a time
+			adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+			session.mount("https://", adapter)
+			session.mount("http://", adapter)
+			self.sessions.put(session)
+			self.all_sessions.append(session)
+		self.lock = Lock()
+		self.stats = {"requests": 0, "errors": 0, "waits": 0, "wait_time": 0.0}
+
+	def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+		"""Perform a request on a pooled session.
+		`timeout` is a (connect, read) tuple; the connect part is always replaced
+		by our own, the read part only if it wasn't set by the caller."""
+		read_timeout = self.read_timeout
+		if isinstance(timeout, tuple):
+			read_timeout = timeout[1]
+		elif timeout is not None:
+			read_timeout = timeout
+		try:
+			session = self.sessions.get_nowait()
+			waited = None
+		except Empty:
+			start = time.monotonic()
+			session = self.sessions.get()
+			waited = time.monotonic() - start
+		env = self._environSettings(url)
+		if proxies is None:
+			proxies = env["proxies"]
+		try:
+			return session.request(method, url, params=params, files=files,
+				timeout=(self.connect_timeout, read_timeout), proxies=proxies,
+				verify=env["verify"], cert=env["cert"], auth=env["auth"])
+		except Exception:
+			with self.lock:
+				self.stats["errors"] += 1
+			raise
+		finally:
+			self.sessions.put(session)
+			with self.lock:
+				self.stats["requests"] += 1
+				if waited is not None:
+					self.stats["waits"] += 1
+					self.stats["wait_time"] += waited
+
+	def _environSettings(self, url):
+		"""What a session with trust_env would pick up from the environment for
+		`url`: proxies, verify (REQUESTS_CA_BUNDLE/CURL_CA_BUNDLE), cert and
+		the .netrc credentials."""
+		host = urlsplit(url)[:2] # scheme and host, proxies depend on both
+		ret = self.env_settings.get(host)
+		if ret is None:
+			with requests.Session() as session:
+				ret = session.merge_environment_settings(url, {}, None, None, None)
+			ret["auth"] = requests.utils.get_netrc_auth(url)
+			self.env_settings[host] = ret
+		return ret
+
+	def getStats(self):
+		"""Return request counters and how often connections were reused."""
+		with self.lock:
+			ret = dict(self.stats)
+		connections = 0
+		requests_sent = 0
+		for session in self.all_sessions:
+			for adapter in set(session.adapters.values()):
+				pools = adapter.poolmanager.pools
+				for key in pools.keys():
+					pool = pools[key]
+					if pool is None:
+						continue
+					connections += pool.num_connections
+					requests_sent += pool.num_requests
+		ret["connections_opened"] = connections
+		ret["connections_reused"] = max(requests_sent - connections, 0)
+		ret["reuse_ratio"] = ret["connections_reused"] / requests_sent if requests_sent > 0 else 0.0
+		return ret
+
+	def close(self):
+		for session in self.all_sessions:
+			session.close()
+
+	def register_tasks(self, sched):
+		def log_stats():
+			stats = self.getStats()
+			logging.info("HTTP pool: %d requests (%d errors), %d connections opened, reuse ratio %.2f, waited %d times for %.1fs",
+				stats["requests"], stats["errors"], stats["connections_opened"], stats["reuse_ratio"],
+				stats["waits"], stats["wait_time"])
+		sched.register(log_stats, hours=1)
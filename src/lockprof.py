@@ -0,0 +1,121 @@
+import logging
+import os
+import sys
+import time
+from threading import Lock
+
+class ProfiledLock():
+	"""Wraps a (reentrant) lock and reports to a LockProfiler how long each
+	acquisition waited for it and held it, keyed by the acquiring call site.
+	Only the outermost acquire() of a reentrant lock counts."""
+	def __init__(self, lock, name, profiler):
+		self.lock = lock
+		self.name = name
+		self.profiler = profiler
+		# only ever modified by the owner
+		self.depth = 0
+		self.site = None
+		self.since = 0.0
+		self.waited = 0.0
+	def _acquire(self, frame, blocking, timeout):
+		waited = 0.0
+		if not self.lock.acquire(False):
+			if not blocking:
+				return False
+			start = time.perf_counter()
+			ok = self.lock.acquire(True, timeout)
+			waited = time.perf_counter() - start
+			if not ok:
+				return False
+		self.depth += 1
+		if self.depth == 1:
+			self.site = self.profiler.site(frame)
+			self.waited = waited
+			self.since = time.perf_counter()
+		return True
+	def acquire(self, blocking=True, timeout=-1):
+		return self._acquire(sys._getframe(1), blocking, timeout)
+	def release(self):
+		self.depth -= 1
+		if self.depth > 0:
+			self.lock.release()
+			return
+		held = time.perf_counter() - self.since
+		site, waited = self.site, self.waited
+		self.lock.release()
+		self.profiler.record(self.name, site, waited, held)
+	def __enter__(self):
+		self._acquire(sys._getframe(1), True, -1)
+		return self
+	def __exit__(self, *_):
+		self.release()
+
+class LockProfiler():
+	"""Collects wait and hold times of ProfiledLocks per call site.
+	A call site is the `depth` innermost frames that acquired the lock."""
+	def __init__(self, depth=2):
+		self.depth = depth
+		self.lock = Lock()
+		self.since = time.monotonic()
+		# dict((lock name, site) -> [acquisitions, contended, wait total, wait max, hold total, hold max])
+		self.stats = {}
+	def wrap(self, obj, attr, name=None):
+		"""Replace the lock at `obj.attr` with a profiled one. Must be done
+		while no thread holds or waits for it, e.g. before startup."""
+		name = name or "%s.%s" % (type(obj).__name__, attr)
+		setattr(obj, attr, ProfiledLock(getattr(obj, attr), name, self))
+	def site(self, frame):
+		parts = []
+		while frame is not None and len(parts) < self.depth:
+			code = frame.f_code
+			parts.append("%s:%d %s" % (os.path.basename(code.co_filename), frame.f_lineno, code.co_name))
+			frame = frame.f_back
+		return " < ".join(parts)
+	def record(self, name, site, waited, held):
+		key = (name, site)
+		with self.lock:
+			s = self.stats.get(key)
+			if s is None:
+				s = self.stats[key] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+			s[0] += 1
+			if waited > 0:
+				s[1] += 1
+				s[2] += waited
+				s[3] = max(s[3], waited)
+			s[4] += held
+			s[5] = max(s[5], held)
+	def reset(self):
+		with self.lock:
+			self.stats = {}
+			self.since = time.monotonic()
+	def getReport(self, top=10):
+		"""Return the `top` call sites by total time spent waiting, as dicts."""
+		with self.lock:
+			items = [(k, list(v)) for k, v in self.stats.items()]
+		items.sort(key=lambda e: (e[1][2], e[1][4]), reverse=True)
+		return [{
+			"lock": name, "site": site, "acquisitions": s[0], "contended": s[1],
+			"wait_total": s[2], "wait_max": s[3], "hold_total": s[4], "hold_max": s[5],
+		} for (name, site), s in items[:top]]
+	def formatReport(self, top=10):
+		lines = ["Lock contention over the last %ds:" % (time.monotonic() - self.since)]
+		for e in self.getReport(top):
+			lines.append("%s @ %s: %d acquired, %d contended, waited %.3fs (max %.1fms), held %.3fs (max %.1fms)" % (
+				e["lock"], e["site"], e["acquisitions"], e["contended"], e["wait_total"],
+				e["wait_max"] * 1000, e["hold_total"], e["hold_max"] * 1000))
+		if len(lines) == 1:
+			lines.append("no acquisitions recorded")
+		return "\n".join(lines)
+	def register_tasks(self, sched, minutes):
+		def log_report():
+			logging.info("%s", self.formatReport())
+			self.reset()
+		sched.register(log_report, minutes=minutes)
+
+# Set by enable() if lock profiling is configured
+profiler = None
+
+def enable(depth=2):
+	global profiler
+	profiler = LockProfiler(depth)
+	return profiler
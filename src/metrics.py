@@ -0,0 +1,208 @@
+import bisect
+import logging
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# seconds, suitable for both DB statements and Bot API calls
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+	0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _formatLabels(labelnames, values):
+	if len(labelnames) == 0:
+		return ""
+	return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+		for k, v in zip(labelnames, values)) + "}"
+
+class Counter():
+	"""Monotonic counter, optionally with labels. If `func` is given the
+	value(s) are read from it when collected instead: it returns a number,
+	or a dict(tuple of label values -> number) if there are labels."""
+	type = "counter"
+	def __init__(self, name, help, labelnames=(), func=None):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labelnames)
+		self.func = func
+		self.lock = Lock()
+		self.values = {} # dict(tuple of label values -> number)
+	def inc(self, amount=1, **labels):
+		key = tuple(labels[k] for k in self.labelnames)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+	def get(self, **labels):
+		if len(labels) == 0 and len(self.labelnames) > 0:
+			return sum(self.collect().values())
+		return self.collect().get(tuple(labels[k] for k in self.labelnames), 0)
+	def collect(self):
+		if self.func is not None:
+			v = self.func()
+			return v if isinstance(v, dict) else {(): v}
+		with self.lock:
+			return dict(self.values)
+	def render(self):
+		return ["%s%s %s" % (self.name, _formatLabels(self.labelnames, k), v)
+			for k, v in sorted(self.collect().items())]
+
+class Gauge(Counter):
+	"""Value that can go up and down, same interface as Counter plus set()."""
+	type = "gauge"
+	def set(self, value, **labels):
+		key = tuple(labels[k] for k in self.labelnames)
+		with self.lock:
+			self.values[key] = value
+
+class Histogram():
+	"""Distribution with fixed buckets. Observing is a bisect plus three
+	additions under a lock, so it's cheap enough to be left on everywhere."""
+	type = "histogram"
+	def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+		self.name = name
+		self.help = help
+		self.buckets = tuple(buckets)
+		self.lock = Lock()
+		self.counts = [0] * (len(self.buckets) + 1) # last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+	def observe(self, value):
+		i = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[i] += 1
+			self.sum += value
+			self.count += 1
+	def time(self):
+		return _HistogramTimer(self)
+	def quantile(self, q):
+		"""Estimate the q-quantile by interpolating within its bucket."""
+		with self.lock:
+			counts, total = list(self.counts), self.count
+		if total == 0:
+			return None
+		rank = q * total
+		seen = 0
+		for i, n in enumerate(counts):
+			if seen + n >= rank and n > 0:
+				if i == len(self.buckets):
+					return self.buckets[-1]
+				lower = self.buckets[i - 1] if i > 0 else 0.0
+				return lower + (self.buckets[i] - lower) * (rank - seen) / n
+			seen += n
+		return self.buckets[-1]
+	def render(self):
+		with self.lock:
+			counts, total, sum_ = list(self.counts), self.count, self.sum
+		ret = []
+		cumulative = 0
+		for le, n in zip(self.buckets + ("+Inf", ), counts):
+			cumulative += n
+			ret.append('%s_bucket{le="%s"} %d' % (self.name, le, cumulative))
+		ret.append("%s_sum %s" % (self.name, sum_))
+		ret.append("%s_count %d" % (self.name, total))
+		return ret
+
+class _HistogramTimer():
+	__slots__ = ("histogram", "start")
+	def __init__(self, histogram):
+		self.histogram = histogram
+	def __enter__(self):
+		self.start = time.perf_counter()
+	def __exit__(self, *_):
+		self.histogram.observe(time.perf_counter() - self.start)
+
+class Registry():
+	def __init__(self):
+		self.lock = Lock()
+		self.metrics = {} # dict(name -> metric)
+	def _getOrCreate(self, cls, name, *args, **kwargs):
+		with self.lock:
+			m = self.metrics.get(name)
+			if m is None:
+				m = self.metrics[name] = cls(name, *args, **kwargs)
+			elif kwargs.get("func") is not None:
+				m.func = kwargs["func"] # re-registered by a new instance
+			return m
+	def counter(self, name, help, labelnames=(), func=None):
+		return self._getOrCreate(Counter, name, help, labelnames, func=func)
+	def gauge(self, name, help, labelnames=(), func=None):
+		return self._getOrCreate(Gauge, name, help, labelnames, func=func)
+	def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+		return self._getOrCreate(Histogram, name, help, buckets)
+	def get(self, name):
+		return self.metrics.get(name)
+	def render(self):
+		"""Return all metrics in the Prometheus text exposition format."""
+		with self.lock:
+			metrics = list(self.metrics.values())
+		lines = []
+		for m in metrics:
+			lines.append("# HELP %s %s" % (m.name, m.help))
+			lines.append("# TYPE %s %s" % (m.name, m.type))
+			try:
+				lines.extend(m.render())
+			except Exception as e:
+				logging.warning("Failed to collect metric %s: %s", m.name, e)
+		return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+class TimedLock():
+	"""Wraps a (reentrant) lock and records how long it is held, counting
+	from the outermost acquire() to the matching release()."""
+	def __init__(self, lock, histogram):
+		self.lock = lock
+		self.histogram = histogram
+		self.depth = 0 # only ever modified by the owner
+		self.since = 0.0
+	def acquire(self, blocking=True, timeout=-1):
+		ok = self.lock.acquire(blocking, timeout)
+		if ok:
+			self.depth += 1
+			if self.depth == 1:
+				self.since = time.perf_counter()
+		return ok
+	def release(self):
+		self.depth -= 1
+		held = time.perf_counter() - self.since if self.depth == 0 else None
+		self.lock.release()
+		if held is not None:
+			self.histogram.observe(held)
+	def __enter__(self):
+		self.acquire()
+		return self
+	def __exit__(self, *_):
+		self.release()
+
+class MetricsServer():
+	"""Serves the registry at /metrics for Prometheus to scrape."""
+	def __init__(self, registry=REGISTRY, listen="127.0.0.1", port=9464):
+		self.registry = registry
+		self.httpd = ThreadingHTTPServer((listen, port), self._makeHandler())
+		self.httpd.daemon_threads = True
+	@property
+	def port(self):
+		return self.httpd.server_address[1]
+	def _makeHandler(self):
+		registry = self.registry
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split("?")[0] != "/metrics":
+					self.send_error(404)
+					return
+				body = registry.render().encode()
+				self.send_response(200)
+				self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+				self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+			def log_message(self, format, *args):
+				pass
+		return Handler
+	def start(self):
+		logging.info("Serving metrics on %s:%d/metrics", *self.httpd.server_address[:2])
+		Thread(target=self.httpd.serve_forever, daemon=True).start()
+	def shutdown(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
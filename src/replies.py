@@ -38,6 +38,7 @@ types = NumericEnum([
 	"SUCCESS_KARMA_REACTION",
 	"SUCCESS_EMOJI_REACTION",
 	"SUCCESS_EMOJI_RECEIVED",
+	"SUCCESS_EMOJI_DIGEST",
 	"SUCCESS_WARN",
 	"SUCCESS_WARN_DELETE",
 	"SUCCESS_WARN_DELETEALL",
@@ -95,6 +96,7 @@ types = NumericEnum([
 	"ERR_POLL_NOT_ANONYMOUS",
 	"ERR_REG_CLOSED",
 	"ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION",
+	"ERR_PROFILE_RUNNING",
 
 	"USER_INFO",
 	"USER_INFO_MOD",
@@ -106,6 +108,11 @@ types = NumericEnum([
 	"HELP",
 	"KARMA_INFO",
 	"BOT_INFO",
+	"BOT_STATS",
+	"LOCK_STATS",
+	"DB_STATS",
+	"PROFILE_STARTED",
+	"PROFILE_DONE",
 ])
 
 # formatting of these as user-readable text
@@ -152,6 +159,9 @@ format_strs = {
 	types.SUCCESS_EMOJI_RECEIVED: lambda karma_is_pats, bot_name="", **_: em(
 			"You just received a {emoji} ({karma_change:+d} " + ("pat" if karma_is_pats else "karma") + "), awesome!"
 		),
+	types.SUCCESS_EMOJI_DIGEST: lambda karma_is_pats, **_: em(
+			"You just received {karma_change:+d} " + ("pats" if karma_is_pats else "karma") + " from {count} reactions, awesome!"
+		),
 	types.SUCCESS_WARN: lambda cooldown, **_:
 		"☑ <b>{id}</b> <i>has been warned" + (" (cooldown: {cooldown})" if cooldown is not None else "") + "</i>",
 	types.SUCCESS_WARN_DELETE: lambda cooldown, **_:
@@ -269,6 +279,7 @@ format_strs = {
 	types.ERR_REG_CLOSED: em("Registrations are closed"),
 	types.ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION:
 		em("This message can't be displayed on premium accounts with restricted access to voice and video messages"),
+	types.ERR_PROFILE_RUNNING: em("The profiler is already running."),
 
 	types.USER_INFO: lambda karma_is_pats, warnings, cooldown, **_:
 		"<b>ID</b>: {id}, <b>username</b>: {username!x}\n" +
@@ -363,6 +374,10 @@ format_strs = {
 			"	/adminsay TEXT" +          " - <i>Post admin message</i>\n" +
 			"	/rules TEXT" +             " - <i>Define rules (HTML)</i>\n" +
 			"	/botinfo" +                " - <i>Show bot system info</i>\n" +
+			"	/stats" +                  " - <i>Show delivery and performance stats</i>\n" +
+			"	/lockstats" +              " - <i>Show the most contended locks</i>\n" +
+			"	/dbstats" +                " - <i>Show the most expensive database statements</i>\n" +
+			"	/profile SECONDS" +        " - <i>Sample all threads and save a flamegraph profile</i>\n" +
 				"\t/uncooldown ID/USERNAME" + " - <i>Remove cooldown from a user</i>\n" +
 				"\t/unblacklist ID/USERNAME" + " - <i>Remove user from blacklist</i>\n" +
 				"\t/preblacklist USERNAME REASON" + " - <i>Blacklist user before they join</i>\n" +
@@ -388,27 +403,109 @@ format_strs = {
 		"<b>Local time:</b> {time}\n" + # Must not use "t" conversion
 		"\n" +
 		"<b>Cached messages:</b> {cached_msgs:n}\n" +
-		"<b>Recently-active users:</b> {active_users:n}"
+		"<b>Recently-active users:</b> {active_users:n}",
+	types.BOT_STATS: lambda failures, **_:
+		"<b>Send queue:</b> {queue_depth:n}\n" +
+		"<b>Relayed messages:</b> {relayed:n}\n" +
+		"<b>Delivered copies:</b> {delivered:n}\n" +
+		"<b>Failed deliveries:</b> " + (", ".join("%s: %d" % (escape_html(e), n) for e, n in failures) or "none") + "\n" +
+		"<b>Lookup hit ratio:</b> {hit_ratio:.2f}\n" +
+		"\n" +
+		"<b>DB query p50/p99:</b> {db_p50} / {db_p99} ms\n" +
+		"<b>DB lock held p50/p99:</b> {lock_p50} / {lock_p99} ms",
+	types.LOCK_STATS: lambda report, **_:
+		"<pre>{report!x}</pre>" if report is not None else
+		"Lock profiling is disabled, set <code>lock_profiling</code> in the config to enable it.",
+	types.DB_STATS: lambda report, **_:
+		"<pre>{report!x}</pre>" if report is not None else
+		"Statement timings are only kept by the SQLite database.",
+	types.PROFILE_STARTED: em("Profiling all threads for {seconds} seconds..."),
+	types.PROFILE_DONE: lambda path, **_:
+		em("Profiler finished with {samples} samples, saved to ") + "<code>{path!x}</code>" if path is not None else
+		em("Profiler finished with {samples} samples, but writing the file failed.")
 }
 
 localization = {}
 
+# keyword arguments every reply can use unless it passes its own,
+# bot_name is set by core.init
+defaults = {"bot_name": ""}
+
+class Template():
+	"""A format string parsed once, so formatting it only has to look up and
+	convert the fields."""
+	__slots__ = ("parts", )
+	def __init__(self, s, formatter):
+		self.parts = tuple(formatter.parse(s))
+	def format(self, formatter, kwargs):
+		out = []
+		for literal, field, spec, conversion in self.parts:
+			if literal:
+				out.append(literal)
+			if field is None:
+				continue
+			if field in kwargs:
+				value = kwargs[field]
+			else:
+				value, _ = formatter.get_field(field, (), kwargs)
+			if conversion is not None:
+				value = formatter.convert_field(value, conversion)
+			if "{" in spec:
+				spec = formatter.vformat(spec, (), kwargs)
+			out.append(formatter.format_field(value, spec))
+		return "".join(out)
+
+class _Templates():
+	"""Compiled templates and memoized replies for one localization."""
+	MAX_COMPILED = 512
+	def __init__(self, localization, defaults):
+		self.localization = localization
+		self.defaults = dict(defaults)
+		self.formatter = localization.get("_FORMATTER_", CustomFormatter)()
+		self.types = {} # type -> Template or function returning the format string
+		self.compiled = {} # format string returned by a function -> Template
+		self.static = {} # type -> text of the reply without arguments
+	def get(self, type):
+		t = self.types.get(type)
+		if t is None:
+			s = self.localization.get(type)
+			if s is None:
+				s = format_strs[type]
+			t = self.types[type] = s if callable(s) else Template(s, self.formatter)
+		return t
+	def compile(self, s):
+		t = self.compiled.get(s)
+		if t is None:
+			if len(self.compiled) >= _Templates.MAX_COMPILED:
+				self.compiled.clear()
+			t = self.compiled[s] = Template(s, self.formatter)
+		return t
+
+_templates = None
+
+def _getTemplates():
+	global _templates
+	t = _templates
+	if t is None or t.localization is not localization or t.defaults != defaults:
+		t = _templates = _Templates(localization, defaults)
+	return t
+
 def formatForTelegram(m):
-	s = localization.get(m.type)
-	if s is None:
-		s = format_strs[m.type]
-	# Provide sensible defaults for formatting (e.g. bot_name) so missing
-	# kwargs don't raise KeyError. Import core lazily to avoid circular
-	# imports.
-	try:
-		import src.core as core
-		_defaults = {"bot_name": getattr(core, 'bot_name', '')}
-	except Exception:
-		_defaults = {"bot_name": ""}
-	# merge defaults with message kwargs (message kwargs take precedence)
-	kw = dict(_defaults)
-	kw.update(m.kwargs or {})
-	if callable(s):
-		s = s(**kw)
-	cls = localization.get("_FORMATTER_", CustomFormatter)
-	return cls().format(s, **kw)
+	templates = _getTemplates()
+	if not m.kwargs:
+		# replies without arguments always format to the same text
+		s = templates.static.get(m.type)
+		if s is not None:
+			return s
+	t = templates.get(m.type)
+	# message kwargs take precedence over the defaults
+	kw = dict(defaults)
+	if m.kwargs:
+		kw.update(m.kwargs)
+	if callable(t):
+		s = templates.compile(t(**kw)).format(templates.formatter, kw)
+	else:
+		s = t.format(templates.formatter, kw)
+		if not m.kwargs:
+			templates.static[m.type] = s
+	return s
@@ -0,0 +1,138 @@
+import logging
+import time
+from threading import Lock
+
+import src.metrics as metrics
+
+class MessageResolver():
+	"""Tiered lookup of relayed messages.
+
+	L1 is the in-process Cache, L2 the persistent message_mapping table.
+	Lookups that missed both tiers are remembered for a short while so that
+	repeated misses (e.g. reactions on ancient messages) don't hit the DB
+	again and again.
+	"""
+	def __init__(self, ch, db, bot_id=None, negative_ttl=30, negative_max=20000):
+		self.ch = ch
+		self.db = db
+		self.bot_id = bot_id
+		self.negative_ttl = negative_ttl
+		self.negative_max = negative_max
+		self.lock = Lock()
+		self.negative = {} # dict(key -> expiry time)
+		self.stats = {"l1_hits": 0, "l2_hits": 0, "negative_hits": 0, "misses": 0}
+
+	def _count(self, key):
+		with self.lock:
+			self.stats[key] += 1
+
+	def _isNegative(self, key):
+		with self.lock:
+			expiry = self.negative.get(key)
+			if expiry is None:
+				return False
+			if time.monotonic() < expiry:
+				self.stats["negative_hits"] += 1
+				return True
+			del self.negative[key]
+			return False
+
+	def _addNegative(self, key):
+		now = time.monotonic()
+		with self.lock:
+			self.stats["misses"] += 1
+			if len(self.negative) >= self.negative_max:
+				self.negative = {k: v for k, v in self.negative.items() if v > now}
+				if len(self.negative) >= self.negative_max:
+					self.negative.clear()
+			self.negative[key] = now + self.negative_ttl
+
+	def _forget(self, *keys):
+		with self.lock:
+			for key in keys:
+				self.negative.pop(key, None)
+
+	def getMsid(self, uid, message_id):
+		"""Find the msid of the message `message_id` in the chat of `uid`."""
+		msid = self.ch.lookupMappingByData(message_id, uid=uid)
+		if msid is not None:
+			self._count("l1_hits")
+			return msid
+		key = ("msid", uid, message_id)
+		if self._isNegative(key):
+			return None
+		try:
+			msid = self.db.get_msid_by_uid_message(uid, message_id, bot_id=self.bot_id)
+		except Exception as e:
+			logging.debug("Failed to get msid from DB: %s", e)
+			msid = None
+		if msid is None:
+			self._addNegative(key)
+			return None
+		self._count("l2_hits")
+		return msid
+
+	def getMessageId(self, uid, msid):
+		"""Find the message_id of the copy of `msid` that `uid` received."""
+		message_id = self.ch.lookupMapping(uid, msid=msid)
+		if message_id is not None:
+			self._count("l1_hits")
+			return message_id
+		key = ("message_id", uid, msid)
+		if self._isNegative(key):
+			return None
+		try:
+			message_id = self.db.get_message_id_by_uid_msid(uid, msid, bot_id=self.bot_id)
+		except Exception as e:
+			logging.debug("Failed to get message id from DB: %s", e)
+			message_id = None
+		if message_id is None:
+			self._addNegative(key)
+			return None
+		self._count("l2_hits")
+		return message_id
+
+	def getMessageIds(self, msid):
+		"""Find the message_ids of all copies of `msid`, as dict(uid -> message_id).
+
+		Used to resolve reply targets for a whole fan-out at once and to find
+		the copies to react to or pin, without iterating over all users."""
+		ret = dict(self.ch.getRecipientMappings(msid))
+		if len(ret) > 0:
+			self._count("l1_hits")
+			return ret
+		key = ("message_ids", msid)
+		if self._isNegative(key):
+			return ret
+		try:
+			ret = dict(self.db.get_recipient_mappings_by_msid(msid, self.bot_id))
+		except Exception as e:
+			logging.debug("Failed to get recipient mappings from DB: %s", e)
+		if len(ret) == 0:
+			self._addNegative(key)
+		else:
+			self._count("l2_hits")
+		return ret
+
+	def saveMapping(self, uid, msid, message_id):
+		"""Record a mapping in both tiers."""
+		self.ch.saveMapping(uid, msid, message_id)
+		try:
+			self.db.save_message_mapping(uid, msid, message_id, bot_id=self.bot_id)
+		except Exception:
+			pass
+		self._forget(("msid", uid, message_id), ("message_id", uid, msid), ("message_ids", msid))
+
+	def registerMetrics(self):
+		metrics.counter("resolver_lookups_total", "Message lookups by the tier that answered them", ("result", ),
+			func=lambda: {(k, ): v for k, v in self.getStats().items() if k != "hit_ratio"})
+		metrics.gauge("resolver_hit_ratio", "Share of message lookups answered from cache or database",
+			func=lambda: self.getStats()["hit_ratio"])
+
+	def getStats(self):
+		"""Return a copy of the counters plus the overall hit ratio."""
+		with self.lock:
+			ret = dict(self.stats)
+		total = ret["l1_hits"] + ret["l2_hits"] + ret["negative_hits"] + ret["misses"]
+		ret["hit_ratio"] = (ret["l1_hits"] + ret["l2_hits"]) / total if total > 0 else 0.0
+		return ret
@@ -0,0 +1,79 @@
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+class SamplingProfiler():
+	"""Statistical profiler sampling the stacks of all threads every
+	`interval` seconds from a background thread, so it can be started and
+	stopped while the bot runs. Results are written in the collapsed stack
+	format ("thread;outer;...;inner count" per line) that flamegraph.pl,
+	speedscope and similar tools read."""
+	def __init__(self, interval=0.01):
+		self.interval = interval
+		self.lock = threading.Lock()
+		self.thread = None
+		self.labels = {} # code object -> frame label
+
+	@property
+	def running(self):
+		return self.thread is not None and self.thread.is_alive()
+
+	def start(self, seconds, path, on_done=None):
+		"""Sample for `seconds` and write the result to `path`, then call
+		on_done(path, samples). Returns False if a run is already active."""
+		with self.lock:
+			if self.running:
+				return False
+			self.thread = threading.Thread(target=self._run, args=(seconds, path, on_done),
+				name="SamplingProfiler", daemon=True)
+			self.thread.start()
+		return True
+
+	def _label(self, code):
+		label = self.labels.get(code)
+		if label is None:
+			label = self.labels[code] = "%s:%s" % (os.path.basename(code.co_filename), code.co_name)
+		return label
+
+	def sample(self, counts):
+		"""Add one sample of every other thread's stack to `counts`."""
+		me = threading.get_ident()
+		names = {t.ident: t.name for t in threading.enumerate()}
+		for ident, frame in sys._current_frames().items():
+			if ident == me:
+				continue
+			stack = []
+			while frame is not None:
+				stack.append(self._label(frame.f_code))
+				frame = frame.f_back
+			stack.append(names.get(ident, str(ident)).replace(";", "_").replace(" ", "_"))
+			key = ";".join(reversed(stack))
+			counts[key] = counts.get(key, 0) + 1
+
+	def _run(self, seconds, path, on_done):
+		counts = {}
+		samples = 0
+		deadline = time.monotonic() + seconds
+		while time.monotonic() < deadline:
+			self.sample(counts)
+			samples += 1
+			time.sleep(self.interval)
+		try:
+			dirname = os.path.dirname(path)
+			if dirname != "":
+				os.makedirs(dirname, exist_ok=True)
+			with open(path, "w") as f:
+				for stack, n in sorted(counts.items()):
+					f.write("%s %d\n" % (stack, n))
+		except OSError as e:
+			logging.error("Failed to write profile to %s: %s", path, e)
+			path = None
+		logging.info("Profiler took %d samples over %ds, written to %s", samples, seconds, path)
+		if on_done is not None:
+			on_done(path, samples)
+
+def profile_path(dir):
+	return os.path.join(dir, datetime.now().strftime("profile-%Y%m%d-%H%M%S.folded"))
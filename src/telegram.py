@@ -1,21 +1,38 @@
 import logging
 import time
 import json
+import asyncio
 import telebot
 from telebot.types import ReactionTypeEmoji
 import datetime
+import urllib.parse
+from threading import Lock, BoundedSemaphore
 
 import src.core as core
 import src.replies as rp
+import src.metrics as metrics
 from src.cache import CachedMessage
-from src.util import MutablePriorityQueue
+from src.resolver import MessageResolver
+from src.http_pool import HTTPSessionPool
+from src.telegram_helpers import send_reply, send_error, extract_command_arg
+from src.tracing import Tracer
+from src.util import MutablePriorityQueue, OrderedWorkerPool
 from src.globals import SCORE_BASE_MESSAGE, SCORE_TEXT_CHARACTER, SCORE_TEXT_LINEBREAK
 
 # Globals initialized in init()
 bot = None
 db = None
 ch = None
+resolver = None
 message_queue = None
+update_pool = None
+webhook = None
+# Optional asyncio runtime (see src/aio.py) and the async client used with it
+aio = None
+async_bot = None
+http_pool = None
+# Per-message lifecycle tracing (see src/tracing.py), None if disabled
+tracer = None
 BOT_ID = None
 BOT_USERNAME = None
 GLOBAL_COUNT_LABEL = "Global user count"
@@ -28,14 +45,65 @@ _cache_time = None
 allow_contacts = False
 allow_documents = False
 allow_polls = False
+reaction_mirror_delay = 2
+
+# Reaction mirrors waiting to be queued, coalesced per msid:
+# msid -> {"emoji": latest emoji, "reactor": its uid,
+#          "previous": latest emoji by someone else or None, "due": monotonic time}
+_pending_reactions = {}
+_pending_reactions_lock = Lock()
+# Queue priority of reaction mirrors (lower is sooner, relayed messages use 0)
+PRIORITY_REACTION = 10
+
+RELAYED = metrics.counter("relayed_messages_total", "User messages relayed")
+DELIVERED = metrics.counter("delivered_messages_total", "Message copies delivered to users")
+SEND_FAILURES = metrics.counter("send_failures_total", "Failed deliveries by error class", ("error", ))
+SEND_TIME = metrics.histogram("send_seconds", "Duration of Bot API send calls")
+
+
+class SystemMessage():
+    """A reply from core rendered once into HTML, shared by the queue items
+    of all its recipients."""
+    __slots__ = ("text", )
+    content_type = "system"
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _QueueItem():
+    """One copy of a message waiting in message_queue."""
+    __slots__ = ("msid", "msg", "reply_msid", "reply_to", "user", "force_caption", "timestamp")
+    kind = "message"
+
+    def __init__(self, msid, msg, reply_msid, reply_to, user, force_caption):
+        self.msid = msid
+        self.msg = msg
+        self.reply_msid = reply_msid
+        self.reply_to = reply_to
+        self.user = user
+        self.force_caption = force_caption
+        self.timestamp = time.time()
+
+
+class _ReactionItem():
+    """A reaction to mirror onto one copy of a message."""
+    __slots__ = ("msid", "chat_id", "message_id", "emoji")
+    kind = "reaction"
+
+    def __init__(self, msid, chat_id, message_id, emoji):
+        self.msid = msid
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.emoji = emoji
 
 
 # Minimal Receiver to deliver system messages emitted by core
 class _TelegramReceiver(core.Receiver):
     @staticmethod
     def reply(m, msid, who, except_who, reply_to):
-        # Format the reply once
-        formatted = rp.formatForTelegram(m)
+        # Format the reply once, every recipient gets the same payload
+        payload = SystemMessage(rp.formatForTelegram(m))
 
         # If `who` is specified, deliver only to that user; otherwise broadcast
         if who is not None:
@@ -46,15 +114,15 @@ class _TelegramReceiver(core.Receiver):
                 return
             if not user.isJoined():
                 return
-            send_to_single(m, msid, user, reply_msid=reply_to)
+            send_to_single(payload, msid, user, reply_msid=reply_to)
             return
 
-        for user in db.iterateUsers():
-            if not user.isJoined():
+        except_id = getattr(except_who, 'id', None)
+        reply_targets = resolver.getMessageIds(reply_to) if reply_to is not None else {}
+        for user in _broadcast_targets(None):
+            if user.id == except_id and not user.debugEnabled:
                 continue
-            if except_who is not None and hasattr(except_who, 'id') and except_who.id == user.id and not user.debugEnabled:
-                continue
-            send_to_single(m, msid, user, reply_msid=reply_to)
+            send_to_single(payload, msid, user, reply_msid=reply_to, reply_to=reply_targets.get(user.id))
 
     @staticmethod
     def stop_invoked(who, delete_out=False):
@@ -75,6 +143,7 @@ class _TelegramReceiver(core.Receiver):
         """
         if not msids:
             return
+        cancel_reaction_mirrors(msids)
         for msid in list(msids):
             pairs = []
             # Prefer DB (survives restart); supplement from cache if present
@@ -87,12 +156,7 @@ class _TelegramReceiver(core.Receiver):
             if not pairs:
                 # Fallback to in-memory cache (current process, pre-expiry)
                 try:
-                    # Use msid_index for speed if available
-                    uids = getattr(ch, 'msid_index', {}).get(msid, set()) or set()
-                    for uid in list(uids):
-                        mid = ch.lookupMapping(uid, msid=msid)
-                        if mid is not None:
-                            pairs.append((uid, mid))
+                    pairs.extend(ch.getRecipientMappings(msid))
                 except Exception:
                     pass
             # De-dupe
@@ -104,14 +168,14 @@ class _TelegramReceiver(core.Receiver):
                     uniq.append(p)
             pairs = uniq
 
-            for (uid, mid) in pairs:
-                try:
-                    bot.delete_message(chat_id=uid, message_id=mid)
-                except Exception as ex:
-                    # Swallow common "already deleted / too old / not found"
-                    low = str(ex).lower()
-                    if "not found" not in low and "can't be deleted" not in low and "message to delete" not in low:
-                        logging.debug("bot.delete_message failed for uid=%s mid=%s: %s", uid, mid, ex)
+            results = _call_many("delete_message", [{"chat_id": uid, "message_id": mid} for uid, mid in pairs])
+            for (uid, mid), ex in zip(pairs, results):
+                if not isinstance(ex, Exception):
+                    continue
+                # Swallow common "already deleted / too old / not found"
+                low = str(ex).lower()
+                if "not found" not in low and "can't be deleted" not in low and "message to delete" not in low:
+                    logging.debug("bot.delete_message failed for uid=%s mid=%s: %s", uid, mid, ex)
             # Clean local structures
             try:
                 ch.deleteMappings(msid)
@@ -122,6 +186,21 @@ class _TelegramReceiver(core.Receiver):
             except Exception:
                 pass
 
+def _call_many(method, calls):
+    """Call the Bot API method `method` once per kwargs dict in `calls`.
+    The calls run concurrently if the async runtime is enabled.
+    Returns the result of each call, or the exception it raised."""
+    if aio is not None:
+        return aio.fan_out([getattr(async_bot, method)(**kwargs) for kwargs in calls])
+    ret = []
+    for kwargs in calls:
+        try:
+            ret.append(getattr(bot, method)(**kwargs))
+        except Exception as e:
+            ret.append(e)
+    return ret
+
+
 def log_into_channel(msg, html=False):
     pass
 
@@ -153,9 +232,12 @@ def _broadcast_targets(sender_id):
         yield u
 
 
-def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
+def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None, api=None):
     """Low-level send using the incoming Telegram message as source.
-    Returns the Telegram message object."""
+    Returns the Telegram message object, or a coroutine resolving to it if
+    `api` is an async client."""
+    if api is None:
+        api = bot
     kwargs = {}
     if reply_to is not None:
         kwargs["reply_to_message_id"] = reply_to
@@ -166,56 +248,136 @@ def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None):
     # Extract caption for media (use force_caption override if provided)
     caption = force_caption if force_caption is not None else getattr(ev, 'caption', None)
     
-    if ct == 'text':
+    if ct == 'system':
+        return api.send_message(chat_id, ev.text, parse_mode='HTML', **kwargs)
+    elif ct == 'text':
         # Forward user text as plain text to avoid HTML parsing of unescaped input
-        return bot.send_message(chat_id, ev.text, parse_mode=None, **kwargs)
+        return api.send_message(chat_id, ev.text, parse_mode=None, **kwargs)
     elif ct == 'photo' and ev.photo:
         photo = max(ev.photo, key=lambda p: p.width * p.height)
         if caption:
             kwargs['caption'] = caption
-        return bot.send_photo(chat_id, photo.file_id, **kwargs)
+        return api.send_photo(chat_id, photo.file_id, **kwargs)
     elif ct == 'sticker':
-        return bot.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
+        return api.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
     elif ct == 'animation':
         if caption:
             kwargs['caption'] = caption
-        return bot.send_animation(chat_id, ev.animation.file_id, **kwargs)
+        return api.send_animation(chat_id, ev.animation.file_id, **kwargs)
     elif ct == 'audio':
         if caption:
             kwargs['caption'] = caption
-        return bot.send_audio(chat_id, ev.audio.file_id, **kwargs)
+        return api.send_audio(chat_id, ev.audio.file_id, **kwargs)
     elif ct == 'document':
         if caption:
             kwargs['caption'] = caption
-        return bot.send_document(chat_id, ev.document.file_id, **kwargs)
+        return api.send_document(chat_id, ev.document.file_id, **kwargs)
     elif ct == 'video':
         if caption:
             kwargs['caption'] = caption
-        return bot.send_video(chat_id, ev.video.file_id, **kwargs)
+        return api.send_video(chat_id, ev.video.file_id, **kwargs)
     elif ct == 'voice':
-        return bot.send_voice(chat_id, ev.voice.file_id, **kwargs)
+        return api.send_voice(chat_id, ev.voice.file_id, **kwargs)
     elif ct == 'video_note':
-        return bot.send_video_note(chat_id, ev.video_note.file_id, **kwargs)
+        return api.send_video_note(chat_id, ev.video_note.file_id, **kwargs)
     elif ct == 'location':
-        return bot.send_location(chat_id, ev.location.latitude, ev.location.longitude, **kwargs)
+        return api.send_location(chat_id, ev.location.latitude, ev.location.longitude, **kwargs)
     elif ct == 'contact':
-        return bot.send_contact(chat_id, ev.contact.phone_number, ev.contact.first_name, **kwargs)
+        return api.send_contact(chat_id, ev.contact.phone_number, ev.contact.first_name, **kwargs)
     else:
         # Fallback: send text as plain text (no HTML) if present
-        return bot.send_message(chat_id, str(getattr(ev, 'text', '')), parse_mode=None, **kwargs)
+        return api.send_message(chat_id, str(getattr(ev, 'text', '')), parse_mode=None, **kwargs)
+
+
+def send_to_single(ev, msid, user, *, reply_msid=None, reply_to=None, force_caption=None):
+    """Queue a single copy for a user.
+    reply_to may carry the recipient's message_id of reply_msid if it was
+    already resolved while enqueueing a fan-out."""
+    message_queue.put(0, _QueueItem(msid, ev, reply_msid, reply_to, user, force_caption))
+
+
+def queue_reaction_mirror(msid, emoji, reactor_id):
+    """Schedule mirroring a reaction onto all copies of msid.
+
+    Reactions arriving for the same msid within reaction_mirror_delay seconds
+    are coalesced: a bot can only hold a single reaction per message, so each
+    copy gets one call with the emoji it would have ended up with had every
+    reaction been mirrored on its own. That is the latest emoji, except on the
+    copy of whoever sent it, which gets the latest emoji of anyone else."""
+    with _pending_reactions_lock:
+        job = _pending_reactions.get(msid)
+        if job is None:
+            job = _pending_reactions[msid] = {
+                "emoji": emoji,
+                "reactor": reactor_id,
+                "previous": None,
+                "due": time.monotonic() + reaction_mirror_delay,
+            }
+        elif job["reactor"] != reactor_id:
+            job["previous"] = job["emoji"]
+        job["emoji"] = emoji
+        job["reactor"] = reactor_id
+
+
+def cancel_reaction_mirrors(msids):
+    """Drop pending and queued reaction mirrors for deleted messages."""
+    msids = set(msids)
+    with _pending_reactions_lock:
+        for msid in msids:
+            _pending_reactions.pop(msid, None)
+    message_queue.delete(lambda item: item.kind == 'reaction' and item.msid in msids)
+
+
+def _flush_reaction_mirrors():
+    """Move due reaction mirrors onto the delivery queue (one low-priority item per copy)."""
+    now = time.monotonic()
+    with _pending_reactions_lock:
+        due = [(msid, job) for msid, job in _pending_reactions.items() if job["due"] <= now]
+        for msid, _ in due:
+            del _pending_reactions[msid]
+    for msid, job in due:
+        n = 0
+        for uid, mid in resolver.getMessageIds(msid).items():
+            emoji = job["previous"] if uid == job["reactor"] else job["emoji"]
+            if emoji is None:
+                continue
+            message_queue.put(PRIORITY_REACTION, _ReactionItem(msid, uid, mid, emoji))
+            n += 1
+        logging.debug("Queued reaction %s on msid=%d for %d copies", job["emoji"], msid, n)
+
+
+def _mirror_reaction(item):
+    try:
+        bot.set_message_reaction(
+            chat_id=item.chat_id,
+            message_id=item.message_id,
+            reaction=[ReactionTypeEmoji(item.emoji)],
+            is_big=False
+        )
+    except Exception as e:
+        logging.warning("✗ Failed to mirror reaction to user %s: %s", item.chat_id, e)
+
 
+def _error_class(e):
+    if isinstance(e, telebot.apihelper.ApiTelegramException):
+        return "api_%d" % e.error_code
+    return type(e).__name__
 
-def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None):
-    """Queue a single copy for a user."""
-    item = type("QueueItem", (), {
-        "msid": msid,
-        "msg": ev,
-        "reply_msid": reply_msid,
-        "user": user,
-        "force_caption": force_caption,
-        "timestamp": time.time()
-    })
-    message_queue.put(0, item)
+
+def _is_unreachable_error(e):
+    error_msg = str(e).lower()
+    return "chat not found" in error_msg or ("400" in error_msg and "not found" in error_msg)
+
+
+def _mark_unreachable(item):
+    global _cache_time
+    try:
+        if BOT_ID is not None and hasattr(item, 'user'):
+            db.set_bot_user_send_blocked(BOT_ID, item.user.id)
+            logging.debug("Marked user %s as unreachable for bot %s", item.user.id, BOT_ID)
+            _cache_time = None  # Invalidate cache
+    except Exception as ex:
+        logging.debug("Failed to mark user as unreachable: %s", ex)
 
 
 def send_thread():
@@ -226,42 +388,31 @@ def send_thread():
             if not item:
                 time.sleep(0.05)
                 continue
+            if item.kind == 'reaction':
+                _mirror_reaction(item)
+                continue
 
-            # Resolve reply_to if reply_msid is set
-            reply_to = None
-            if hasattr(item, 'reply_msid') and item.reply_msid is not None:
+            # Resolve reply_to if reply_msid is set and it wasn't resolved at enqueue time
+            reply_to = getattr(item, 'reply_to', None)
+            if reply_to is None and getattr(item, 'reply_msid', None) is not None:
                 # Look up the recipient's message_id for the replied-to message
-                reply_to = ch.lookupMapping(item.user.id, msid=item.reply_msid)
-                if reply_to is None:
-                    # Fallback to DB for cross-process support
-                    try:
-                        # Get all recipient mappings for this msid, find ours
-                        pairs = db.get_recipient_mappings_by_msid(item.reply_msid, BOT_ID)
-                        for (uid, msg_id) in pairs:
-                            if uid == item.user.id:
-                                reply_to = msg_id
-                                break
-                    except Exception:
-                        pass
+                reply_to = resolver.getMessageId(item.user.id, item.reply_msid)
             
-            sent = send_to_single_inner(item.user.id, item.msg, reply_to, item.force_caption)
+            with SEND_TIME.time():
+                sent = send_to_single_inner(item.user.id, item.msg, reply_to, item.force_caption)
+            DELIVERED.inc()
+            if tracer is not None:
+                tracer.delivered(item.msid)
             if sent and hasattr(sent, 'message_id') and item.msid is not None:
-                ch.saveMapping(item.user.id, item.msid, sent.message_id)
-                try:
-                    db.save_message_mapping(item.user.id, item.msid, sent.message_id, bot_id=BOT_ID)
-                except Exception:
-                    pass
+                resolver.saveMapping(item.user.id, item.msid, sent.message_id)
+            if tracer is not None:
+                tracer.persisted(item.msid)
         except Exception as e:
-            error_msg = str(e).lower()
-            if "chat not found" in error_msg or ("400" in error_msg and "not found" in error_msg):
-                try:
-                    if BOT_ID is not None and hasattr(item, 'user'):
-                        db.set_bot_user_send_blocked(BOT_ID, item.user.id)
-                        logging.debug("Marked user %s as unreachable for bot %s", item.user.id, BOT_ID)
-                        global _cache_time
-                        _cache_time = None  # Invalidate cache
-                except Exception as ex:
-                    logging.debug("Failed to mark user as unreachable: %s", ex)
+            SEND_FAILURES.inc(error=_error_class(e))
+            if _is_unreachable_error(e):
+                _mark_unreachable(item)
+                if tracer is not None:
+                    tracer.failed(item.msid)
                 continue
             
             logging.warning("Message delivery failed: %s", e)
@@ -271,35 +422,104 @@ def send_thread():
                 message_queue.put(0, item)
             else:
                 time.sleep(0.5)
+                if tracer is not None:
+                    tracer.failed(item.msid)
 
 
-def relay(message):
-    """Main incoming message handler: forward to all active users (except sender)."""
-    sender_id = message.from_user.id if hasattr(message, 'from_user') else message.chat.id
-    
-    # Early exit if user not joined
+async def _deliver_async(item):
+    """Coroutine counterpart of one send_thread iteration.
+    Copies for the same chat are sent in queue order, but only the API call
+    itself takes one of the runtime's concurrency slots."""
+    loop = asyncio.get_running_loop()
+    if item.kind == 'reaction':
+        try:
+            async with aio.in_order(item.chat_id):
+                await aio.bounded(async_bot.set_message_reaction(chat_id=item.chat_id,
+                    message_id=item.message_id, reaction=[ReactionTypeEmoji(item.emoji)], is_big=False))
+        except Exception as e:
+            logging.warning("✗ Failed to mirror reaction to user %s: %s", item.chat_id, e)
+        return
     try:
-        user_obj = db.getUser(id=sender_id)
-        if not user_obj.isJoined():
+        async with aio.in_order(item.user.id):
+            reply_to = getattr(item, 'reply_to', None)
+            if reply_to is None and getattr(item, 'reply_msid', None) is not None:
+                reply_to = await loop.run_in_executor(None, resolver.getMessageId, item.user.id, item.reply_msid)
+            start = time.perf_counter()
+            sent = await aio.bounded(send_to_single_inner(item.user.id, item.msg, reply_to, item.force_caption, api=async_bot))
+            SEND_TIME.observe(time.perf_counter() - start)
+        DELIVERED.inc()
+        if tracer is not None:
+            tracer.delivered(item.msid)
+        if sent and hasattr(sent, 'message_id') and item.msid is not None:
+            await loop.run_in_executor(None, resolver.saveMapping, item.user.id, item.msid, sent.message_id)
+        if tracer is not None:
+            tracer.persisted(item.msid)
+    except Exception as e:
+        SEND_FAILURES.inc(error=_error_class(e))
+        if _is_unreachable_error(e):
+            await loop.run_in_executor(None, _mark_unreachable, item)
+            if tracer is not None:
+                tracer.failed(item.msid)
             return
-    except KeyError:
+        logging.warning("Message delivery failed: %s", e)
+        if hasattr(item, 'timestamp') and time.time() - item.timestamp < 60:
+            # back off without holding a slot (or the chat's order)
+            loop.call_later(0.5, message_queue.put, 0, item)
+        elif tracer is not None:
+            tracer.failed(item.msid)
+
+
+def async_send_thread():
+    """Variant of send_thread for the async runtime: queued items are delivered
+    as concurrent coroutines, copies for the same chat still in queue order."""
+    # Only take a bounded number of items off the queue so priorities and
+    # deletions (message_queue.delete) keep working for the rest. The slot is
+    # taken before the item, so nothing waits outside the queue for one.
+    in_flight = BoundedSemaphore(aio.concurrency * 2)
+    while True:
+        in_flight.acquire()
+        item = message_queue.get()
+        future = aio.submit(_deliver_async(item))
+        future.add_done_callback(lambda f: in_flight.release())
+
+
+def _new_context(m):
+    sender_id = m.from_user.id if hasattr(m, 'from_user') else m.chat.id
+    return core.UpdateContext(sender_id, BOT_ID, resolver.getMsid)
+
+
+def _mark_seen(ctx):
+    """Mark the sender as reachable by this bot and invalidate the reachable cache."""
+    if ctx.bot_id is None:
         return
-    
-    # Mark user as reachable and invalidate cache
-    if BOT_ID is not None:
+    try:
+        db.mark_bot_user_seen(ctx.bot_id, ctx.user_id)
+        global _cache_time
+        _cache_time = None
+    except Exception as e:
+        logging.debug("Failed to mark user as seen: %s", e)
+
+
+def relay(message, ctx=None):
+    """Main incoming message handler: forward to all active users (except sender).
+    Without a `ctx` from the caller, the changes to the sender are committed here."""
+    if ctx is None:
+        ctx = _new_context(message)
+        _mark_seen(ctx)
         try:
-            db.mark_bot_user_seen(BOT_ID, sender_id)
-            global _cache_time
-            _cache_time = None
-        except Exception as e:
-            logging.debug("Failed to mark user as seen: %s", e)
+            return relay(message, ctx)
+        finally:
+            ctx.commit()
+    sender_id = ctx.user_id
+    trace = tracer.begin(getattr(message, 'content_type', None)) if tracer is not None else None
+    
+    # Early exit if user not joined
+    user_obj = ctx.user
+    if user_obj is None or not user_obj.isJoined():
+        return
     
     # Update lastActive
-    try:
-        with db.modifyUser(id=sender_id) as u:
-            u.lastActive = datetime.datetime.now()
-    except Exception as e:
-        logging.debug("Failed to update lastActive for user %s: %s", sender_id, e)
+    ctx.update(lastActive=datetime.datetime.now())
     
     # Check for repeated message spam (text, stickers, and GIFs)
     message_text = getattr(message, 'text', None) or getattr(message, 'caption', None)
@@ -323,12 +543,14 @@ def relay(message):
     
     # Check for spam if we have an identifier
     if spam_check_id:
-        is_spam, repeat_count = core.check_repeat_spam(sender_id, spam_check_id)
+        is_spam, repeat_count = core.check_repeat_spam(ctx, spam_check_id)
         if is_spam:
             txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_SPAMMY))
             bot.send_message(sender_id, txt, parse_mode='HTML', reply_to_message_id=getattr(message, 'message_id', None))
             logging.info("Blocked repeat spam from user %s (sent same content %d times)", sender_id, repeat_count)
             return
+    if trace is not None:
+        tracer.stamp(trace, "spam")
     
     # Check media restrictions
     ct = getattr(message, 'content_type', '')
@@ -348,28 +570,30 @@ def relay(message):
         # Look up the msid of the message being replied to
         replied_msg_id = getattr(replied_to_msg, 'message_id', None)
         if replied_msg_id:
-            # Try cache first
-            reply_msid = ch.lookupMappingByData(replied_msg_id, uid=sender_id)
-            if reply_msid is None:
-                # Fallback to DB
-                try:
-                    reply_msid = db.get_msid_by_uid_message(sender_id, replied_msg_id, bot_id=BOT_ID)
-                except Exception:
-                    pass
+            reply_msid = ctx.getMsid(replied_msg_id)
     
     # Cache message and create mappings
     cm = CachedMessage(user_id=sender_id)
     msid = ch.assignMessageId(cm)
+    if trace is not None:
+        tracer.bind(trace, msid)
     try:
-        ch.saveMapping(sender_id, msid, message.message_id)
-        db.save_message_mapping(sender_id, msid, message.message_id, bot_id=BOT_ID)
-        db.save_message_author(msid, sender_id, bot_id=BOT_ID)
+        resolver.saveMapping(sender_id, msid, message.message_id)
+        db.save_message_author(msid, sender_id, bot_id=ctx.bot_id)
     except Exception:
         pass
     
+    # Resolve the reply targets of all recipients at once
+    reply_targets = resolver.getMessageIds(reply_msid) if reply_msid is not None else {}
+    RELAYED.inc()
+
     # Broadcast to all targets with reply chain intact
+    n = 0
     for u in _broadcast_targets(sender_id):
-        send_to_single(message, msid, u, reply_msid=reply_msid)
+        send_to_single(message, msid, u, reply_msid=reply_msid, reply_to=reply_targets.get(u.id))
+        n += 1
+    if trace is not None:
+        tracer.enqueued(trace, n)
     
     logging.debug("relay(): msid=%d broadcast queued (reply_msid=%s)", msid, reply_msid)
 
@@ -401,8 +625,19 @@ def register_tasks(sched):
         except Exception:
             logging.exception("Error cleaning old message mappings")
 
+    def log_resolver_stats():
+        stats = resolver.getStats()
+        logging.debug("Message lookups: %d L1 hits, %d L2 hits, %d negative hits, %d misses (hit ratio %.2f)",
+            stats["l1_hits"], stats["l2_hits"], stats["negative_hits"], stats["misses"], stats["hit_ratio"])
+
     sched.register(clean_expired_messages, hours=6)
     sched.register(clean_old_db_mappings, hours=12)
+    sched.register(log_resolver_stats, hours=1)
+    sched.register(_flush_reaction_mirrors, seconds=1)
+    if http_pool is not None:
+        http_pool.register_tasks(sched)
+    if tracer is not None:
+        tracer.register_tasks(sched)
 
 
 def check_reaction_support():
@@ -415,41 +650,561 @@ def check_reaction_support():
         return False
 
 
+def _update_key(update):
+    """Return the chat an update belongs to, updates of one chat are processed in order."""
+    for name in ("message", "edited_message", "message_reaction", "message_reaction_count"):
+        obj = getattr(update, name, None)
+        if obj is not None:
+            return obj.chat.id
+    callback_query = getattr(update, 'callback_query', None)
+    if callback_query is not None:
+        return callback_query.from_user.id
+    return update.update_id
+
+
+def _process_update(update):
+    bot.process_new_updates([update])
+
+
+# Include reaction updates so we can process reactions/karma
+ALLOWED_UPDATES = [
+    "message",
+    "edited_message",
+    "callback_query",
+    "message_reaction",
+    "message_reaction_count",
+]
+
+
+def _submit_update(update):
+    if update_pool is None:
+        _process_update(update)
+    else:
+        update_pool.submit(_update_key(update), update)
+
+
+def _webhook_server():
+    from src.webhook import WebhookServer
+
+    def on_update(data):
+        update = telebot.types.Update.de_json(data)
+        if update is not None:
+            _submit_update(update)
+
+    path = webhook.get("path") or urllib.parse.urlsplit(webhook["url"]).path or "/"
+    return WebhookServer(on_update, webhook["secret_token"],
+        listen=webhook.get("listen", "127.0.0.1"), port=int(webhook.get("port", 8443)), path=path)
+
+
+def _run_webhook():
+    server = _webhook_server()
+    update_pool.start()
+    bot.set_webhook(url=webhook["url"], secret_token=webhook["secret_token"],
+        allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.shutdown()
+
+
 def run():
-    # Include reaction updates so we can process reactions/karma
-    allowed_updates = [
-        "message",
-        "edited_message",
-        "callback_query",
-        "message_reaction",
-        "message_reaction_count",
+    if webhook is not None:
+        return _run_webhook()
+    try:
+        bot.remove_webhook()  # getUpdates is refused while a webhook is set
+    except Exception as e:
+        logging.warning("Failed to remove webhook: %s", e)
+    if update_pool is None:
+        # process updates inline on the polling thread
+        try:
+            logging.debug(f"Starting bot.polling with allowed_updates={ALLOWED_UPDATES}")
+            bot.infinity_polling(timeout=45, allowed_updates=ALLOWED_UPDATES, skip_pending=True)
+        except Exception as e:
+            logging.error("Polling error: %s", e, exc_info=True)
+            time.sleep(1)
+        return
+
+    # This thread only fetches updates, handlers run on the update pool so that
+    # getUpdates latency doesn't depend on how long handlers take.
+    update_pool.start()
+    offset = _skip_pending_updates()
+    logging.debug(f"Starting polling with allowed_updates={ALLOWED_UPDATES}")
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=50, long_polling_timeout=45,
+                allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            logging.error("Polling error: %s", e)
+            time.sleep(1)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            update_pool.submit(_update_key(update), update)
+
+
+def _skip_pending_updates():
+    """Drop updates that arrived while the bot was down, returns the offset to poll from."""
+    try:
+        # this confirms all but the last pending update, which is skipped by polling after it
+        pending = bot.get_updates(offset=-1, long_polling_timeout=1)  # don't wait long if there are none
+    except Exception as e:
+        logging.warning("Failed to skip pending updates: %s", e)
+        return None
+    if pending:
+        return pending[-1].update_id + 1
+    return None
+
+
+def wait_for_queue(timeout=5):
+    """Give the send thread up to `timeout` seconds to empty the queue, used on shutdown."""
+    deadline = time.monotonic() + timeout
+    while message_queue.qsize() > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+# Command dispatch
+
+class CommandEvent():
+    """Passed to command handlers: the message, the command as invoked, the
+    update's core.UpdateContext (pass it to core functions in place of the
+    user), the sender's User (None for commands registered with user=False),
+    the text following the command (None if empty) and, for reply commands,
+    the msid of the message replied to."""
+    __slots__ = ("message", "cmd", "chat_id", "ctx", "user", "arg", "msid")
+
+    def __init__(self, message, cmd, ctx, user, arg, msid=None):
+        self.message = message
+        self.cmd = cmd
+        self.chat_id = ctx.user_id
+        self.ctx = ctx
+        self.user = user
+        self.arg = arg
+        self.msid = msid
+
+
+class _Command():
+    __slots__ = ("name", "func", "rank", "reply", "arg", "user", "quote")
+
+    def __init__(self, name, func, rank, reply, arg, user, quote):
+        self.name = name
+        self.func = func
+        self.rank = rank
+        self.reply = reply
+        self.arg = arg
+        self.user = user
+        self.quote = quote
+
+
+# command name -> _Command
+COMMANDS = {}
+COMMAND_CALLS = metrics.counter("commands_total", "Commands handled", ("command", ))
+COMMAND_TIME = metrics.counter("command_seconds_total", "Time spent handling commands", ("command", ))
+
+
+def command(*names, rank=None, reply=False, arg=False, user=True, quote=True):
+    """Register `func(ev)` as the handler of the commands `names`.
+    rank:  minimum rank, others get ERR_COMMAND_DISABLED
+    reply: must reply to a relayed message, whose msid is passed as ev.msid
+    arg:   an argument is required, ERR_NO_ARG otherwise
+    user:  look up the sender first, commands from unknown users are ignored
+    quote: send the result as a reply to the command message
+    The handler returns a Reply, a list of them or None."""
+    def deco(func):
+        for name in names:
+            COMMANDS[name] = _Command(name, func, rank, reply, arg, user, quote)
+        return func
+    return deco
+
+
+def _handle_command(m, ctx=None) -> bool:
+    """Run the handler of the command in `m`. Returns False if it isn't one.
+    Without a `ctx` from the caller, the changes to the sender are committed here."""
+    text = getattr(m, 'text', '') or ''
+    if not text.startswith('/'):
+        return False
+    c = COMMANDS.get(text.split()[0].split('@')[0].lstrip('/'))
+    if c is None:
+        return False
+    own_ctx = ctx is None
+    if own_ctx:
+        ctx = core.UpdateContext(m.chat.id, BOT_ID, resolver.getMsid)
+    start = time.perf_counter()
+    try:
+        _run_command(c, m, text, ctx)
+    except Exception:
+        logging.exception('Error handling command')
+    finally:
+        if own_ctx:
+            ctx.commit()
+        COMMAND_CALLS.inc(command=c.name)
+        COMMAND_TIME.inc(time.perf_counter() - start, command=c.name)
+    return True
+
+
+def _run_command(c, m, text, ctx):
+    chat_id = ctx.user_id
+    message_id = getattr(m, 'message_id', None)
+    c_user = None
+    if c.user:
+        c_user = ctx.user
+        if c_user is None:
+            return
+    if c.rank is not None and c_user.rank < c.rank:
+        return send_error(bot, chat_id, rp.types.ERR_COMMAND_DISABLED, message_id)
+    arg = extract_command_arg(text)
+    if c.arg and arg is None:
+        return send_error(bot, chat_id, rp.types.ERR_NO_ARG, message_id)
+    msid = None
+    if c.reply:
+        if getattr(m, 'reply_to_message', None) is None:
+            return send_error(bot, chat_id, rp.types.ERR_NO_REPLY, message_id)
+        msid = ctx.getMsid(getattr(m.reply_to_message, 'message_id', None))
+        if msid is None:
+            return send_error(bot, chat_id, rp.types.ERR_NOT_IN_CACHE, message_id)
+    res = c.func(CommandEvent(m, c.name, ctx, c_user, arg, msid))
+    if not res:
+        return
+    for reply in (res if isinstance(res, list) else [res]):
+        send_reply(bot, chat_id, reply, message_id if c.quote else None)
+
+
+def _send_text(ev, text, **kwargs):
+    """Send a plain (not from a Reply) answer to a command."""
+    try:
+        bot.send_message(ev.chat_id, text, reply_to_message_id=getattr(ev.message, 'message_id', None), **kwargs)
+    except Exception as e:
+        logging.debug('Failed to send reply to %s: %s', ev.chat_id, e)
+
+
+@command('start', user=False, quote=False)
+def _cmd_start(ev):
+    m = ev.message
+    c_user = type('User', (), {
+        'id': ev.chat_id,
+        'username': getattr(m.from_user, 'username', None),
+        'realname': ' '.join(filter(None, [
+            getattr(m.from_user, 'first_name', ''),
+            getattr(m.from_user, 'last_name', '')
+        ])) or 'Unknown'
+    })()
+    return core.user_join(c_user)
+
+
+@command('stop', quote=False)
+def _cmd_stop(ev):
+    return core.user_leave(ev.ctx)
+
+
+# Help: show available commands
+@command('help')
+def _cmd_help(ev):
+    return rp.Reply(rp.types.HELP, rank=ev.user.rank, karma_is_pats=core.karma_is_pats)
+
+
+# Info: show info about your account, or (mods) info about replied user
+@command('info')
+def _cmd_info(ev):
+    res = None
+    replied = getattr(ev.message, 'reply_to_message', None)
+    if replied is not None and ev.user.rank >= core.RANKS.mod:
+        target_msid = ev.ctx.getMsid(replied.message_id)
+        if target_msid is not None:
+            res = core.get_info_mod(ev.ctx, target_msid)
+    if res is None:
+        res = core.get_info(ev.ctx)
+    return res
+
+
+# User: show detailed user info
+@command('user', rank=core.RANKS.mod, reply=True)
+def _cmd_user(ev):
+    return core.get_user_details(ev.ctx, ev.msid)
+
+
+# Rules: show rules (user) or set rules (admin with TEXT argument)
+@command('rules')
+def _cmd_rules(ev):
+    if ev.arg is not None:
+        if ev.user.rank < core.RANKS.admin:
+            return rp.Reply(rp.types.ERR_COMMAND_DISABLED)
+        return core.set_rules(ev.ctx, ev.arg)
+    res = core.get_rules(ev.ctx)
+    if not res:
+        _send_text(ev, "No rules have been set yet.")
+    return res
+
+
+# Users: show user counts
+@command('users')
+def _cmd_users(ev):
+    # Compute per-bot and global counts
+    total_joined = 0
+    reachable_ids = set()
+    try:
+        if BOT_ID is not None:
+            reachable_ids = set(db.get_reachable_user_ids(BOT_ID))
+    except Exception:
+        reachable_ids = set()
+    per_bot_joined = 0
+    for u in db.iterateUsers():
+        if u.isJoined():
+            total_joined += 1
+            if BOT_ID is None or u.id in reachable_ids:
+                per_bot_joined += 1
+
+    # Build a compact summary and append legacy breakdown for mods/admins
+    lines = [
+        f"Users in this bot: <b>{per_bot_joined}</b>",
+        f"{GLOBAL_COUNT_LABEL}: <b>{total_joined}</b>",
     ]
     try:
-        logging.debug(f"Starting bot.polling with allowed_updates={allowed_updates}")
-        bot.infinity_polling(timeout=45, allowed_updates=allowed_updates, skip_pending=True)
+        legacy = core.get_users(ev.ctx)
+        if legacy:
+            # Separate sections
+            lines.append("")
+            lines.append(rp.formatForTelegram(legacy))
+    except Exception:
+        pass
+    _send_text(ev, "\n".join(lines), parse_mode='HTML')
+
+
+# Remove: delete the replied message
+# Removeall: delete all messages from the user
+@command('remove', 'removeall', rank=core.RANKS.mod, reply=True)
+def _cmd_remove(ev):
+    return core.delete_message(ev.ctx, ev.msid, del_all=(ev.cmd == 'removeall'), bot_id=ev.ctx.bot_id)
+
+
+# ks: sign a message with karma level
+@command('ks', arg=True)
+def _cmd_ks(ev):
+    body = ev.arg
+    # Prepare (spam checks, cooldown, signing rules)
+    score = (
+        SCORE_BASE_MESSAGE + len(body) * SCORE_TEXT_CHARACTER + body.count('\n') * SCORE_TEXT_LINEBREAK
+    )
+    prep = core.prepare_user_message(ev.ctx, score, is_media=False, signed=False, tripcode=False, ksigned=True)
+    # On error, core returns a Reply
+    if isinstance(prep, rp.Reply):
+        return prep
+    msid = int(prep)
+    # Persist author so /delete etc work after restart even for signed messages
+    try:
+        db.save_message_author(msid, ev.chat_id, bot_id=ev.ctx.bot_id)
+    except Exception:
+        pass
+    # Compose signed-with-level text in plain text (no HTML)
+    level_name = core.getKarmaLevelName(ev.ctx.karma)
+    out_text = f"{body}\n— {level_name}"
+    # Synthetic text event
+    msg = type('Ev', (), {'content_type': 'text', 'text': out_text})()
+    # Broadcast to all targets (except sender)
+    for u in _broadcast_targets(ev.chat_id):
+        send_to_single(msg, msid, u)
+
+
+# Promotions: /mod USERNAME or /admin USERNAME, demotion: /demote USERNAME
+@command('mod', 'admin', rank=core.RANKS.admin, arg=True)
+def _cmd_promote(ev):
+    target_rank = core.RANKS.admin if ev.cmd == 'admin' else core.RANKS.mod
+    return core.promote_user(ev.ctx, ev.arg, target_rank)
+
+
+@command('demote', rank=core.RANKS.admin, arg=True)
+def _cmd_demote(ev):
+    return core.demote_user(ev.ctx, ev.arg)
+
+
+# Blacklist: /blacklist REASON (reply)
+@command('blacklist', rank=core.RANKS.mod, reply=True)
+def _cmd_blacklist(ev):
+    reason = ev.arg or "No reason specified"
+    # del_all=True to match help text
+    return core.blacklist_user(ev.ctx, ev.msid, reason, del_all=True)
+
+
+# Unblacklist: /unblacklist ID/USERNAME
+@command('unblacklist', rank=core.RANKS.admin, arg=True)
+def _cmd_unblacklist(ev):
+    return core.unblacklist_user(ev.ctx, ev.arg)
+
+
+# Preblacklist: /preblacklist USERNAME REASON
+@command('preblacklist', rank=core.RANKS.admin)
+def _cmd_preblacklist(ev):
+    parts = (ev.arg or "").split(None, 1)
+    if len(parts) < 2:
+        _send_text(ev, "Usage: /preblacklist USERNAME REASON", parse_mode='HTML')
+        return None
+    return core.preblacklist_user(ev.ctx, parts[0], parts[1].strip())
+
+
+# Warn/Delete/Cooldown commands: (delete, del_all, takes a duration)
+_WARN_COMMANDS = {
+    'warn': (False, False, False),
+    'cooldown': (False, False, True),
+    'delete': (True, False, True),
+    'deleteall': (True, True, False),
+}
+
+
+@command(*_WARN_COMMANDS.keys(), rank=core.RANKS.mod, reply=True)
+def _cmd_warn(ev):
+    delete, del_all, has_duration = _WARN_COMMANDS[ev.cmd]
+    duration = (ev.arg or "") if has_duration else ""
+    return core.warn_user(ev.ctx, ev.msid, delete=delete, del_all=del_all, duration=duration, bot_id=ev.ctx.bot_id)
+
+
+# Uncooldown: /uncooldown ID/USERNAME
+@command('uncooldown', rank=core.RANKS.admin, arg=True)
+def _cmd_uncooldown(ev):
+    if ev.arg.isdigit():
+        return core.uncooldown_user(ev.ctx, oid2=ev.arg, username2=None)
+    return core.uncooldown_user(ev.ctx, oid2=None, username2=ev.arg.lstrip('@'))
+
+
+# Pin/unpin the replied message (or /pin MSID) in every chat
+@command('pin', 'unpin', rank=core.RANKS.mod)
+def _cmd_pin(ev):
+    # Determine msid either from reply or from argument
+    target_msid = None
+    replied = getattr(ev.message, 'reply_to_message', None)
+    if replied is not None:
+        target_msid = ev.ctx.getMsid(replied.message_id)
+    elif ev.arg is not None and ev.arg.split()[0].isdigit():
+        target_msid = int(ev.arg.split()[0])
+
+    if target_msid is None:
+        _send_text(ev, "Reply to a message with /pin or /unpin, or use: /pin <msid>")
+        return None
+
+    # Gather all recipient message ids for this msid (cache, else one DB query)
+    recipient_pairs = list(resolver.getMessageIds(target_msid).items())
+    if not recipient_pairs:
+        _send_text(ev, "Couldn't find copies of that message to pin.")
+        return None
+
+    success, failed = 0, 0
+    method = 'pin_chat_message' if ev.cmd == 'pin' else 'unpin_chat_message'
+    results = _call_many(method, [{"chat_id": rcpt_uid, "message_id": rcpt_msg_id}
+        for (rcpt_uid, rcpt_msg_id) in recipient_pairs])
+    for (rcpt_uid, rcpt_msg_id), e in zip(recipient_pairs, results):
+        if isinstance(e, Exception):
+            failed += 1
+            logging.debug("pin/unpin failed for uid=%s mid=%s: %s", rcpt_uid, rcpt_msg_id, e)
+        else:
+            success += 1
+
+    # Persist pin state in DB so that /refresh (purge old non-pinned) leaves pinned messages alone,
+    # and /unpin continues to work for old pinned messages. Scoped by bot for multi-bot DB sharing.
+    try:
+        if ev.cmd == 'pin':
+            db.pin_msid(target_msid, ev.chat_id, bot_id=ev.ctx.bot_id)
+        else:
+            db.unpin_msid(target_msid, bot_id=ev.ctx.bot_id)
     except Exception as e:
-        logging.error("Polling error: %s", e, exc_info=True)
-        time.sleep(1)
+        logging.debug("Failed to record pin/unpin state for msid=%s: %s", target_msid, e)
+
+    action = 'Pinned' if ev.cmd == 'pin' else 'Unpinned'
+    msg = f"{action} this message in {success} chats"
+    if failed:
+        msg += f" (failed in {failed})"
+    _send_text(ev, msg)
+
+
+# Refresh the bot: purge non-pinned messages older than N days (default from config purge_old_default_days, usually 7).
+# Supports "deletion and recreation": /refresh all (or 0) purges *all* non-pinned messages regardless of age.
+# This deletes (where Telegram API still permits) and forgets messages in cache + DB mappings/authors,
+# except anything protected by /pin (pinned messages survive recreation).
+# Examples: /refresh , /refresh 30 , /refresh all
+@command('refresh', rank=core.RANKS.admin)
+def _cmd_refresh(ev):
+    days = getattr(core, 'purge_old_default_days', 7)
+    if ev.arg is not None:
+        arg = ev.arg.lower()
+        if arg in ('all', '0', '*', 'everything'):
+            days = 0  # special: purge all non-pinned (full deletion + recreation)
+        elif arg.isdigit():
+            days = int(arg)
+    return core.purge_old_messages(ev.ctx, days=days, bot_id=ev.ctx.bot_id)
+
+
+@command('togglekarma', 'togglepats')
+def _cmd_togglekarma(ev):
+    return core.toggle_karma(ev.ctx)
+
+
+@command('togglemedia')
+def _cmd_togglemedia(ev):
+    return core.toggle_media(ev.ctx)
+
+
+# Stats: counters and latencies from the metrics registry
+@command('stats', rank=core.RANKS.admin)
+def _cmd_stats(ev):
+    return core.get_stats(ev.ctx)
+
+
+# Lock contention report (needs lock_profiling)
+@command('lockstats', rank=core.RANKS.admin)
+def _cmd_lockstats(ev):
+    return core.get_lock_stats(ev.ctx)
+
+
+# Per-statement database timings
+@command('dbstats', rank=core.RANKS.admin)
+def _cmd_dbstats(ev):
+    return core.get_db_stats(ev.ctx)
+
+
+# Sampling profiler over all threads. Example: /profile 60
+@command('profile', rank=core.RANKS.admin)
+def _cmd_profile(ev):
+    seconds = 30
+    if ev.arg is not None and ev.arg.isdigit():
+        seconds = int(ev.arg)
+    return core.start_profiling(ev.ctx, seconds)
 
 
 def init(config, _db, _ch):
-    global bot, db, ch, message_queue, allow_contacts, allow_documents, allow_polls, GLOBAL_COUNT_LABEL
+    global bot, db, ch, resolver, message_queue, update_pool, webhook, tracer, aio, async_bot, http_pool, allow_contacts, allow_documents, allow_polls, GLOBAL_COUNT_LABEL, reaction_mirror_delay
 
     if not config.get("bot_token"):
         logging.error("No telegram token specified.")
         raise SystemExit(1)
 
     telebot.apihelper.SKIP_PENDING = True
-    telebot.apihelper.READ_TIMEOUT = 20
+    telebot.apihelper.CONNECT_TIMEOUT = config.get("http_connect_timeout", 5)
+    telebot.apihelper.READ_TIMEOUT = config.get("http_read_timeout", 20)
+    http_pool_size = int(config.get("http_pool_size", 8))
+    if http_pool_size > 0:
+        http_pool = HTTPSessionPool(size=http_pool_size, connect_timeout=telebot.apihelper.CONNECT_TIMEOUT,
+            read_timeout=telebot.apihelper.READ_TIMEOUT)
+        telebot.apihelper.CUSTOM_REQUEST_SENDER = http_pool.request
 
     # Save deps
     db = _db
     ch = _ch
     message_queue = MutablePriorityQueue()
+    webhook = config.get("webhook") or None
+    update_workers = int(config.get("update_workers", 4))
+    if update_workers == 0 and webhook is not None:
+        # webhook requests are handled on concurrent server threads, a single
+        # worker processes their updates one by one like the polling thread would
+        logging.info("Webhook updates need an update worker, using update_workers: 1")
+        update_workers = 1
+    update_pool = None
+    if update_workers > 0:
+        update_pool = OrderedWorkerPool(_process_update, workers=update_workers,
+            maxsize=int(config.get("update_queue_size", 1000)))
 
     allow_contacts = bool(config.get("allow_contacts", False))
     allow_documents = bool(config.get("allow_documents", False))
     allow_polls = bool(config.get("allow_polls", False))
+    reaction_mirror_delay = config.get("reaction_mirror_delay", 2)
+    if config.get("trace_file"):
+        tracer = Tracer(config["trace_file"], max_bytes=int(config.get("trace_file_size", 10)) * 1024 * 1024,
+            backups=int(config.get("trace_file_count", 3)))
 
     bot = telebot.TeleBot(config["bot_token"], threaded=False, parse_mode="HTML")
     # Identify this bot instance for DB scoping
@@ -460,6 +1215,22 @@ def init(config, _db, _ch):
         globals()["BOT_USERNAME"] = str(me.username)
     except Exception as e:
         logging.warning("Could not resolve bot identity: %s", e)
+    resolver = MessageResolver(ch, db, bot_id=BOT_ID)
+    resolver.registerMetrics()
+    metrics.gauge("send_queue_depth", "Items waiting in the send queue", func=message_queue.qsize)
+    if update_pool is not None:
+        metrics.gauge("update_queue_depth", "Updates waiting for a worker", func=update_pool.qsize)
+
+    if config.get("async_runtime", False):
+        try:
+            from telebot.async_telebot import AsyncTeleBot
+        except ImportError as e:
+            logging.error("The async runtime needs aiohttp installed (%s), continuing without it", e)
+        else:
+            from src.aio import AsyncRuntime
+            async_bot = AsyncTeleBot(config["bot_token"], parse_mode="HTML")
+            aio = AsyncRuntime(concurrency=int(config.get("async_concurrency", 16)))
+            aio.start()
 
     # Custom label for global user count in /users
     try:
@@ -484,773 +1255,20 @@ def init(config, _db, _ch):
         types += ["poll"]
     types += ["animation", "audio", "photo", "sticker", "video", "video_note", "voice"]
 
-    def _handle_command(m) -> bool:
-        try:
-            text = getattr(m, 'text', '') or ''
-            if not text.startswith('/'):
-                return False
-            cmd = text.split()[0].split('@')[0].lstrip('/')
-            chat_id = m.chat.id
-            
-            # Handle start command
-            if cmd == 'start':
-                c_user = type('User', (), {
-                    'id': chat_id,
-                    'username': getattr(m.from_user, 'username', None),
-                    'realname': ' '.join(filter(None, [
-                        getattr(m.from_user, 'first_name', ''),
-                        getattr(m.from_user, 'last_name', '')
-                    ])) or 'Unknown'
-                })()
-                res = core.user_join(c_user)
-                if res:
-                    replies = res if isinstance(res, list) else [res]
-                    for reply in replies:
-                        try:
-                            txt = rp.formatForTelegram(reply)
-                            bot.send_message(chat_id, txt, parse_mode='HTML')
-                        except Exception as e:
-                            logging.debug('start reply failed: %s', e)
-                return True
-
-            # Help: show available commands
-            if cmd == 'help':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                try:
-                    reply = rp.Reply(rp.types.HELP, rank=c_user.rank, karma_is_pats=core.karma_is_pats)
-                    txt = rp.formatForTelegram(reply)
-                    bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=getattr(m, 'message_id', None))
-                except Exception:
-                    pass
-                return True
-
-            # Info: show info about your account, or (mods) info about replied user
-            if cmd == 'info':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                replied = getattr(m, 'reply_to_message', None)
-                res = None
-                if replied is not None and c_user.rank >= core.RANKS.mod:
-                    target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id) or getattr(db, 'get_msid_by_uid_message', lambda *_args, **_kw: None)(chat_id, replied.message_id, bot_id=BOT_ID)
-                    if target_msid is not None:
-                        res = core.get_info_mod(c_user, target_msid)
-                if res is None:
-                    res = core.get_info(c_user)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=getattr(m, 'message_id', None))
-                    except Exception:
-                        pass
-                return True
-            
-            # User: show detailed user info (mod only, reply required)
-            if cmd == 'user':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: at least moderator
-                if c_user.rank < core.RANKS.mod:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Must be used as a reply
-                replied = getattr(m, 'reply_to_message', None)
-                if replied is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_REPLY))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Get the target msid from the replied message
-                target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id)
-                if target_msid is None:
-                    try:
-                        target_msid = db.get_msid_by_uid_message(chat_id, replied.message_id, bot_id=BOT_ID)
-                    except Exception:
-                        target_msid = None
-                if target_msid is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NOT_IN_CACHE))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Get detailed user info
-                res = core.get_user_details(c_user, target_msid)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-
-            # Rules: show rules (user) or set rules (admin with TEXT argument)
-            if cmd == 'rules':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                
-                # Check if there's an argument (admin setting rules)
-                parts = text.strip().split(None, 1)
-                if len(parts) > 1 and parts[1].strip():
-                    # Admin is setting rules
-                    if c_user.rank < core.RANKS.admin:
-                        try:
-                            txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                            bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                        except Exception:
-                            pass
-                        return True
-                    rules_text = parts[1].strip()
-                    res = core.set_rules(c_user, rules_text)
-                    if res:
-                        try:
-                            txt = rp.formatForTelegram(res)
-                            bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                        except Exception:
-                            pass
-                else:
-                    # User is viewing rules
-                    res = core.get_rules(c_user)
-                    if res:
-                        try:
-                            txt = rp.formatForTelegram(res)
-                            bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=getattr(m, 'message_id', None))
-                        except Exception:
-                            pass
-                    else:
-                        # No rules set yet
-                        try:
-                            bot.send_message(chat_id, "No rules have been set yet.", reply_to_message_id=getattr(m, 'message_id', None))
-                        except Exception:
-                            pass
-                return True
-
-            # Users: show user counts
-            if cmd == 'users':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Compute per-bot and global counts
-                total_joined = 0
-                reachable_ids = set()
-                try:
-                    if BOT_ID is not None:
-                        reachable_ids = set(db.get_reachable_user_ids(BOT_ID))
-                except Exception:
-                    reachable_ids = set()
-                per_bot_joined = 0
-                for u in db.iterateUsers():
-                    if u.isJoined():
-                        total_joined += 1
-                        if BOT_ID is None or u.id in reachable_ids:
-                            per_bot_joined += 1
-
-                # Build a compact summary and append legacy breakdown for mods/admins
-                lines = [
-                    f"Users in this bot: <b>{per_bot_joined}</b>",
-                    f"{GLOBAL_COUNT_LABEL}: <b>{total_joined}</b>",
-                ]
-                try:
-                    legacy = core.get_users(c_user)
-                    if legacy:
-                        legacy_txt = rp.formatForTelegram(legacy)
-                        # Separate sections
-                        lines.append("")
-                        lines.append(legacy_txt)
-                except Exception:
-                    pass
-                out = "\n".join(lines)
-                try:
-                    bot.send_message(chat_id, out, parse_mode='HTML', reply_to_message_id=getattr(m, 'message_id', None))
-                except Exception:
-                    pass
-                return True
-
-            # Remove: delete the replied message (mods)
-            # Removeall: delete all messages from the user (mods)
-            if cmd in ('remove', 'removeall'):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                if c_user.rank < core.RANKS.mod:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                replied = getattr(m, 'reply_to_message', None)
-                if replied is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_REPLY))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id)
-                if target_msid is None:
-                    try:
-                        target_msid = db.get_msid_by_uid_message(chat_id, replied.message_id, bot_id=BOT_ID)
-                    except Exception:
-                        target_msid = None
-                if target_msid is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NOT_IN_CACHE))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Remove single message or all messages from the user
-                del_all = (cmd == 'removeall')
-                res = core.delete_message(c_user, target_msid, del_all=del_all, bot_id=BOT_ID)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-
-            # ks: sign a message with karma level
-            if cmd == 'ks':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                parts = text.strip().split(None, 1)
-                if len(parts) < 2 or not parts[1].strip():
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_ARG))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                body = parts[1].strip()
-                # Prepare (spam checks, cooldown, signing rules)
-                score = (
-                    SCORE_BASE_MESSAGE + len(body) * SCORE_TEXT_CHARACTER + body.count('\n') * SCORE_TEXT_LINEBREAK
-                )
-                prep = core.prepare_user_message(c_user, score, is_media=False, signed=False, tripcode=False, ksigned=True)
-                # On error, core returns a Reply
-                if isinstance(prep, rp.Reply):
-                    try:
-                        txt = rp.formatForTelegram(prep)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                msid = int(prep)
-                # Persist author so /delete etc work after restart even for signed messages
-                try:
-                    db.save_message_author(msid, chat_id, bot_id=BOT_ID)
-                except Exception:
-                    pass
-                # Compose signed-with-level text in plain text (no HTML)
-                level_name = core.getKarmaLevelName(c_user.karma)
-                out_text = f"{body}\n— {level_name}"
-                # Synthetic text event
-                ev = type('Ev', (), {'content_type': 'text', 'text': out_text})()
-                # Broadcast to all targets (except sender)
-                for u in _broadcast_targets(chat_id):
-                    send_to_single(ev, msid, u)
-                return True
-
-            # Admin promotions: /mod USERNAME or /admin USERNAME (admin-only)
-            if cmd in ('mod', 'admin'):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Expect a username arg
-                parts = text.strip().split(None, 1)
-                if len(parts) < 2 or not parts[1].strip():
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_ARG))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                username = parts[1].strip()
-                target_rank = core.RANKS.admin if cmd == 'admin' else core.RANKS.mod
-                res = core.promote_user(c_user, username, target_rank)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-
-            # Demote: /demote USERNAME (admin-only)
-            if cmd == 'demote':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                parts = text.strip().split(None, 1)
-                if len(parts) < 2 or not parts[1].strip():
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_ARG))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                username = parts[1].strip()
-                res = core.demote_user(c_user, username)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-            
-            # Blacklist: /blacklist REASON (reply, mod command)
-            if cmd == 'blacklist':
-                logging.debug("Blacklist command received from user %s", chat_id)
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    logging.debug("User %s not found in database", chat_id)
-                    return True
-                # Permission check: at least moderator
-                if c_user.rank < core.RANKS.mod:
-                    logging.debug("User %s lacks mod permissions (rank: %d)", chat_id, c_user.rank)
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Must be used as a reply
-                replied = getattr(m, 'reply_to_message', None)
-                if replied is None:
-                    logging.debug("Blacklist command used without reply")
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_REPLY))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Get the target msid from the replied message
-                target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id)
-                if target_msid is None:
-                    try:
-                        target_msid = db.get_msid_by_uid_message(chat_id, replied.message_id, bot_id=BOT_ID)
-                    except Exception as e:
-                        logging.debug("Failed to get msid from DB: %s", e)
-                        target_msid = None
-                if target_msid is None:
-                    logging.debug("Could not find msid for replied message")
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NOT_IN_CACHE))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Extract reason from command text
-                parts = text.strip().split(None, 1)
-                reason = parts[1].strip() if len(parts) > 1 else "No reason specified"
-                logging.debug("Calling blacklist_user for msid=%s, reason=%s", target_msid, reason)
-                # Call core blacklist function (del_all=True to match help text)
-                res = core.blacklist_user(c_user, target_msid, reason, del_all=True)
-                logging.debug("Blacklist result: %s", res)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception as e:
-                        logging.error("Failed to send blacklist response: %s", e)
-                return True
-            
-            # Unblacklist: /unblacklist ID/USERNAME (admin command)
-            if cmd == 'unblacklist':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: admin only
-                if c_user.rank < core.RANKS.admin:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Extract username argument
-                parts = text.strip().split(None, 1)
-                if len(parts) < 2 or not parts[1].strip():
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_ARG))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                username = parts[1].strip()
-                res = core.unblacklist_user(c_user, username)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-            
-            # Preblacklist: /preblacklist USERNAME REASON (admin command)
-            if cmd == 'preblacklist':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: admin only
-                if c_user.rank < core.RANKS.admin:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Extract username and reason
-                parts = text.strip().split(None, 2)
-                if len(parts) < 3:
-                    try:
-                        txt = "Usage: /preblacklist USERNAME REASON"
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                username = parts[1].strip()
-                reason = parts[2].strip()
-                res = core.preblacklist_user(c_user, username, reason)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-            
-            # Warn/Delete/Cooldown commands (mod, reply-based)
-            if cmd in ('warn', 'delete', 'deleteall', 'cooldown'):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: at least moderator
-                if c_user.rank < core.RANKS.mod:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Must be used as a reply
-                replied = getattr(m, 'reply_to_message', None)
-                if replied is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_REPLY))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Get the target msid from the replied message
-                target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id)
-                if target_msid is None:
-                    try:
-                        target_msid = db.get_msid_by_uid_message(chat_id, replied.message_id, bot_id=BOT_ID)
-                    except Exception:
-                        target_msid = None
-                if target_msid is None:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NOT_IN_CACHE))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                
-                # Parse duration if provided (for /cooldown and /delete DURATION)
-                parts = text.strip().split(None, 1)
-                duration = parts[1].strip() if len(parts) > 1 else ""
-                
-                # Route to appropriate core function
-                res = None
-                if cmd == 'warn':
-                    res = core.warn_user(c_user, target_msid, delete=False, del_all=False, duration="", bot_id=BOT_ID)
-                elif cmd == 'cooldown':
-                    res = core.warn_user(c_user, target_msid, delete=False, del_all=False, duration=duration, bot_id=BOT_ID)
-                elif cmd == 'delete':
-                    res = core.warn_user(c_user, target_msid, delete=True, del_all=False, duration=duration, bot_id=BOT_ID)
-                elif cmd == 'deleteall':
-                    res = core.warn_user(c_user, target_msid, delete=True, del_all=True, duration="", bot_id=BOT_ID)
-                
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-            
-            # Uncooldown: /uncooldown ID/USERNAME (admin command)
-            if cmd == 'uncooldown':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: admin only
-                if c_user.rank < core.RANKS.admin:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                # Extract username/id argument
-                parts = text.strip().split(None, 1)
-                if len(parts) < 2 or not parts[1].strip():
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_NO_ARG))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                arg = parts[1].strip()
-                # Try to determine if it's an ID or username
-                oid2 = None
-                username2 = None
-                if arg.isdigit():
-                    oid2 = arg
-                else:
-                    username2 = arg.lstrip('@')
-                res = core.uncooldown_user(c_user, oid2=oid2, username2=username2)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-            
-            # Handle stop command
-            if cmd == 'stop':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                res = core.user_leave(c_user)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML')
-                    except Exception as e:
-                        logging.debug('stop reply failed: %s', e)
-                return True
-            
-            # Handle pin/unpin commands (mods and admins only)
-            if cmd in ('pin', 'unpin'):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                # Permission check: at least moderator
-                if c_user.rank < core.RANKS.mod:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-
-                # Determine msid either from reply or from argument
-                target_msid = None
-                replied = getattr(m, 'reply_to_message', None)
-                if replied is not None:
-                    # Prefer cache O(1) lookup
-                    target_msid = ch.lookupMappingByData(replied.message_id, uid=chat_id)
-                    if target_msid is None:
-                        try:
-                            target_msid = db.get_msid_by_uid_message(chat_id, replied.message_id, bot_id=BOT_ID)
-                        except Exception:
-                            target_msid = None
-                else:
-                    # Try parse numeric msid from command arg
-                    parts = text.strip().split()
-                    if len(parts) > 1 and parts[1].isdigit():
-                        try:
-                            target_msid = int(parts[1])
-                        except Exception:
-                            target_msid = None
-
-                if target_msid is None:
-                    # Inform user how to use
-                    try:
-                        help_txt = "Reply to a message with /pin or /unpin, or use: /pin <msid>"
-                        bot.send_message(chat_id, help_txt, reply_to_message_id=getattr(m, 'message_id', None))
-                    except Exception:
-                        pass
-                    return True
-
-                # Gather all recipient message ids for this msid
-                recipient_pairs = []  # list of (uid, message_id)
-                try:
-                    # First try cache for faster mapping
-                    for recipient in db.iterateUsers():
-                        if not recipient.isJoined():
-                            continue
-                        mid = ch.lookupMapping(recipient.id, msid=target_msid)
-                        if mid:
-                            recipient_pairs.append((recipient.id, mid))
-                    if not recipient_pairs:
-                        # Fallback to DB cross-process mapping
-                        recipient_pairs = getattr(db, 'get_recipient_mappings_by_msid', lambda _msid, _bid=None: [])(target_msid, BOT_ID)
-                except Exception:
-                    pass
-
-                if not recipient_pairs:
-                    try:
-                        bot.send_message(chat_id, "Couldn't find copies of that message to pin.", reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-
-                success, failed = 0, 0
-                for (rcpt_uid, rcpt_msg_id) in recipient_pairs:
-                    try:
-                        if cmd == 'pin':
-                            bot.pin_chat_message(rcpt_uid, rcpt_msg_id)
-                        else:
-                            # unpin specific message
-                            bot.unpin_chat_message(rcpt_uid, rcpt_msg_id)
-                        success += 1
-                    except Exception as e:
-                        failed += 1
-                        logging.debug("pin/unpin failed for uid=%s mid=%s: %s", rcpt_uid, rcpt_msg_id, e)
-
-                # Persist pin state in DB so that /refresh (purge old non-pinned) leaves pinned messages alone,
-                # and /unpin continues to work for old pinned messages. Scoped by bot for multi-bot DB sharing.
-                try:
-                    if cmd == 'pin':
-                        db.pin_msid(target_msid, chat_id, bot_id=BOT_ID)
-                    else:
-                        db.unpin_msid(target_msid, bot_id=BOT_ID)
-                except Exception as e:
-                    logging.debug("Failed to record pin/unpin state for msid=%s: %s", target_msid, e)
-
-                # Acknowledge
-                try:
-                    action = 'Pinned' if cmd == 'pin' else 'Unpinned'
-                    msg = f"{action} this message in {success} chats"
-                    if failed:
-                        msg += f" (failed in {failed})"
-                    bot.send_message(chat_id, msg, reply_to_message_id=m.message_id)
-                except Exception:
-                    pass
-                return True
-
-            # Refresh the bot: purge non-pinned messages older than N days (default from config purge_old_default_days, usually 7).
-            # Supports "deletion and recreation": /refresh all (or 0) purges *all* non-pinned messages regardless of age.
-            # This deletes (where Telegram API still permits) and forgets messages in cache + DB mappings/authors,
-            # except anything protected by /pin (pinned messages survive recreation).
-            # Admin only. Examples: /refresh , /refresh 30 , /refresh all
-            if cmd == 'refresh':
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                if c_user.rank < core.RANKS.admin:
-                    try:
-                        txt = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                    return True
-                days = getattr(core, 'purge_old_default_days', 7)
-                parts = text.strip().split(None, 1)
-                if len(parts) > 1:
-                    arg = parts[1].strip().lower()
-                    if arg in ('all', '0', '*', 'everything'):
-                        days = 0  # special: purge all non-pinned (full deletion + recreation)
-                    elif arg.isdigit():
-                        try:
-                            d = int(arg)
-                            if d >= 0:
-                                days = d
-                        except Exception:
-                            pass
-                res = core.purge_old_messages(c_user, days=days, bot_id=BOT_ID)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception:
-                        pass
-                return True
-
-            # Map aliases
-            if cmd in ('togglekarma', 'togglepats'):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                res = core.toggle_karma(c_user)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception as e:
-                        logging.debug('toggle_karma reply failed: %s', e)
-                return True
-            if cmd in ('togglemedia',):
-                try:
-                    c_user = db.getUser(id=chat_id)
-                except KeyError:
-                    return True
-                res = core.toggle_media(c_user)
-                if res:
-                    try:
-                        txt = rp.formatForTelegram(res)
-                        bot.send_message(chat_id, txt, parse_mode='HTML', reply_to_message_id=m.message_id)
-                    except Exception as e:
-                        logging.debug('toggle_media reply failed: %s', e)
-                return True
-        except Exception:
-            logging.exception('Error handling command')
-        return False
-
     @bot.message_handler(content_types=types)
     def _on_message(m):
+        ctx = _new_context(m)
         # Mark user as reachable whenever they send ANY message
-        sender_id = m.from_user.id if hasattr(m, 'from_user') else m.chat.id
-        if BOT_ID is not None:
-            try:
-                db.mark_bot_user_seen(BOT_ID, sender_id)
-                global _cache_time
-                _cache_time = None
-            except Exception as e:
-                logging.debug("Failed to mark user as seen: %s", e)
-        
-        # Intercept commands so they are not broadcast to others
-        if getattr(m, 'text', None) and str(m.text).startswith('/'):
-            # Always handle commands privately, never relay them
-            _handle_command(m)
-            return
-        relay(m)
+        _mark_seen(ctx)
+        try:
+            # Intercept commands so they are not broadcast to others
+            if getattr(m, 'text', None) and str(m.text).startswith('/'):
+                # Always handle commands privately, never relay them
+                _handle_command(m, ctx)
+                return
+            relay(m, ctx)
+        finally:
+            ctx.commit()
 
     # Reaction updates (both per-user and count updates)
     @bot.message_reaction_handler()
@@ -1267,16 +1285,10 @@ def init(config, _db, _ch):
                 logging.debug("reaction: missing chat/message id")
                 return
 
-            msid = ch.lookupMappingByData(msg_id, uid=chat_id)
+            msid = resolver.getMsid(chat_id, msg_id)
             if msid is None:
-                # Fallback to DB for cross-process support
-                try:
-                    msid = db.get_msid_by_uid_message(chat_id, msg_id, bot_id=BOT_ID)
-                except Exception:
-                    msid = None
-                if msid is None:
-                    logging.debug("reaction: no msid for chat=%s msg=%s", chat_id, msg_id)
-                    return
+                logging.debug("reaction: no msid for chat=%s msg=%s", chat_id, msg_id)
+                return
 
             # Count updates don't include user; we only act on per-user updates
             user_obj = getattr(m, 'user', None)
@@ -1315,52 +1327,20 @@ def init(config, _db, _ch):
             emoji = str(added[0])
             logging.debug("Reaction detected: user=%s emoji=%s msid=%s", user_id, emoji, msid)
             
-            try:
-                c_user = db.getUser(id=user_id)
-            except KeyError:
+            ctx = core.UpdateContext(user_id, BOT_ID, resolver.getMsid)
+            if ctx.user is None:
                 logging.debug("reaction: unknown user %s", user_id)
                 return
 
-            # Mirror the reaction to all other users' copies of this message
-            cm = ch.getMessage(msid)
-            logging.debug("Lookup msid=%s -> found=%s sender=%s", msid, cm is not None, cm.user_id if cm else None)
-            if cm:
-                sender_id = cm.user_id
-                mirrored_count = 0
-                # Prefer cache when available; otherwise use DB mapping across processes
-                recipient_pairs = []
-                try:
-                    # Gather from cache
-                    for recipient in db.iterateUsers():
-                        if not recipient.isJoined() or recipient.id == user_id:
-                            continue
-                        recipient_msg_id = ch.lookupMapping(recipient.id, msid=msid)
-                        if recipient_msg_id:
-                            recipient_pairs.append((recipient.id, recipient_msg_id))
-                    # If nothing found in cache, try DB
-                    if not recipient_pairs:
-                        recipient_pairs = getattr(db, 'get_recipient_mappings_by_msid', lambda _msid, _bid=None: [])(msid, BOT_ID)
-                        # filter out the reactor
-                        recipient_pairs = [(uid, mid) for (uid, mid) in recipient_pairs if uid != user_id]
-                except Exception:
-                    pass
-
-                for (rcpt_uid, rcpt_msg_id) in recipient_pairs:
-                    try:
-                        reaction_obj = ReactionTypeEmoji(emoji)
-                        bot.set_message_reaction(
-                            chat_id=rcpt_uid,
-                            message_id=rcpt_msg_id,
-                            reaction=[reaction_obj],
-                            is_big=False
-                        )
-                        mirrored_count += 1
-                    except Exception as e:
-                        logging.warning("✗ Failed to mirror reaction to user %s: %s", rcpt_uid, e)
-                logging.debug("Mirrored reaction to %d users (sender=%s)", mirrored_count, sender_id)
+            # Mirror the reaction to all other users' copies of this message.
+            # This only queues a job, the delivery thread does the API calls.
+            queue_reaction_mirror(msid, emoji, user_id)
 
             # Update karma for the message sender
-            res = core.handle_message_reaction(c_user, msid, emoji)
+            try:
+                res = core.handle_message_reaction(ctx, msid, emoji)
+            finally:
+                ctx.commit()
             logging.debug("handle_message_reaction returned: %s", res)
             if res:
                 txt = rp.formatForTelegram(res)
@@ -0,0 +1,116 @@
+import json
+import logging
+import logging.handlers
+import time
+from threading import Lock
+
+# Stages of the relay lifecycle, in order. Spans are written as offsets in
+# milliseconds from "ingest", which itself is a Unix timestamp.
+STAGES = ("ingest", "spam", "assign", "enqueue", "first", "last", "persist")
+
+class _Trace():
+	__slots__ = ("msid", "type", "start", "stamps", "expected", "delivered", "failed")
+	def __init__(self, type):
+		self.msid = None
+		self.type = type
+		self.start = time.time()
+		self.stamps = {"ingest": time.perf_counter()}
+		self.expected = None # set once all copies are queued
+		self.delivered = 0
+		self.failed = 0
+
+class Tracer():
+	"""Records when each relayed message passes the stages of its lifecycle
+	and writes one compact JSON line per message to a rotating file once all
+	copies are delivered (or failed). util/trace_summary.py summarises them."""
+	def __init__(self, path, max_bytes=10*1024*1024, backups=3, timeout=600):
+		self.timeout = timeout
+		self.lock = Lock()
+		self.traces = {} # msid -> _Trace
+		self.logger = logging.getLogger("secretlounge.trace")
+		self.logger.propagate = False
+		self.logger.setLevel(logging.INFO)
+		handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+		handler.setFormatter(logging.Formatter("%(message)s"))
+		self.logger.addHandler(handler)
+		self.handler = handler
+
+	def begin(self, type):
+		"""Start tracing an incoming message, returns the trace to stamp."""
+		return _Trace(type)
+	def stamp(self, trace, stage):
+		trace.stamps.setdefault(stage, time.perf_counter())
+	def bind(self, trace, msid):
+		"""Associate the trace with its msid, after assignMessageId."""
+		trace.msid = msid
+		self.stamp(trace, "assign")
+		with self.lock:
+			self.traces[msid] = trace
+	def enqueued(self, trace, count):
+		"""All `count` copies of the message were queued."""
+		self.stamp(trace, "enqueue")
+		with self.lock:
+			trace.expected = count
+			done = self._isDone(trace)
+		if done:
+			self._finish(trace)
+
+	def delivered(self, msid):
+		"""A copy of the message was sent."""
+		now = time.perf_counter()
+		with self.lock:
+			trace = self.traces.get(msid)
+			if trace is not None:
+				trace.stamps.setdefault("first", now)
+				trace.stamps["last"] = now
+	def persisted(self, msid):
+		"""The mapping of a sent copy was saved, which completes it."""
+		self._complete(msid, True)
+	def failed(self, msid):
+		"""A copy could not be delivered and won't be retried."""
+		self._complete(msid, False)
+	def _complete(self, msid, ok):
+		now = time.perf_counter()
+		with self.lock:
+			trace = self.traces.get(msid)
+			if trace is None:
+				return
+			if ok:
+				trace.delivered += 1
+				trace.stamps["persist"] = now
+			else:
+				trace.failed += 1
+			done = self._isDone(trace)
+		if done:
+			self._finish(trace)
+	def _isDone(self, trace):
+		return trace.expected is not None and trace.delivered + trace.failed >= trace.expected
+	def _finish(self, trace, incomplete=False):
+		with self.lock:
+			if self.traces.pop(trace.msid, None) is None:
+				return # finished concurrently
+		t0 = trace.stamps["ingest"]
+		span = {"msid": trace.msid, "type": trace.type, "ts": round(trace.start, 3)}
+		for stage in STAGES[1:]:
+			if stage in trace.stamps:
+				span[stage] = round((trace.stamps[stage] - t0) * 1000, 2)
+		span["n"] = trace.expected
+		span["ok"] = trace.delivered
+		if trace.failed > 0:
+			span["failed"] = trace.failed
+		if incomplete:
+			span["incomplete"] = True
+		self.logger.info(json.dumps(span, separators=(",", ":")))
+
+	def expire(self):
+		"""Write out traces whose message never finished delivering."""
+		limit = time.perf_counter() - self.timeout
+		with self.lock:
+			stale = [t for t in self.traces.values() if t.stamps["ingest"] < limit]
+		for trace in stale:
+			self._finish(trace, incomplete=True)
+	def register_tasks(self, sched):
+		sched.register(self.expire, minutes=5)
+	def close(self):
+		self.logger.removeHandler(self.handler)
+		self.handler.close()
@@ -3,8 +3,8 @@ import time
 import logging
 import os
 from datetime import datetime
-from queue import PriorityQueue
-from threading import Lock
+from queue import PriorityQueue, Queue
+from threading import Lock, Thread
 from datetime import timedelta
 
 class Scheduler():
@@ -53,6 +53,8 @@ class MutablePriorityQueue():
 			iid = next(self.counter)
 			self.items[iid] = data
 		self.queue.put((prio, iid))
+	def qsize(self):
+		return len(self.items)
 	def delete(self, selector):
 		with self.lock:
 			# More efficient: build list of keys to delete first
@@ -60,6 +62,35 @@ class MutablePriorityQueue():
 			for iid in keys_to_delete:
 				del self.items[iid]
 
+class OrderedWorkerPool():
+	"""Runs `func(item)` for submitted items on a fixed set of worker threads.
+	Items with the same key always land on the same worker and are therefore
+	processed in submission order. The queues are bounded, submit() blocks
+	while the selected worker is backlogged."""
+	def __init__(self, func, workers=4, maxsize=1000):
+		assert workers > 0
+		self.func = func
+		self.queues = [Queue(max(maxsize // workers, 1)) for _ in range(workers)]
+	def start(self):
+		for q in self.queues:
+			Thread(target=self._run, args=(q, ), daemon=True).start()
+	def _run(self, q):
+		while True:
+			item = q.get()
+			try:
+				self.func(item)
+			except Exception as e:
+				logging.exception("Exception raised in worker")
+			finally:
+				q.task_done()
+	def submit(self, key, item):
+		self.queues[hash(key) % len(self.queues)].put(item)
+	def qsize(self):
+		return sum(q.qsize() for q in self.queues)
+	def join(self):
+		for q in self.queues:
+			q.join()
+
 class Enum():
 	def __init__(self, m, reverse=True):
 		assert len(set(m.values())) == len(m)
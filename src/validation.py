@@ -4,6 +4,24 @@ import unicodedata
 from typing import Optional
 
 
+class _ControlChars(dict):
+    """str.translate() table deleting control characters (category C*) except
+    newlines and tabs, filled in as characters are first seen. User text can
+    contain any code point, so only the first `max_size` are remembered."""
+    max_size = 4096
+
+    def __missing__(self, cp):
+        c = chr(cp)
+        keep = c in ('\n', '\t') or not unicodedata.category(c).startswith('C')
+        v = cp if keep else None
+        if len(self) < self.max_size:
+            self[cp] = v
+        return v
+
+
+_CONTROL_CHARS = _ControlChars()
+
+
 def sanitize_text(text: Optional[str], max_length: int = 500) -> Optional[str]:
     """
     Sanitize user input text.
@@ -25,11 +43,10 @@ def sanitize_text(text: Optional[str], max_length: int = 500) -> Optional[str]:
     if len(text) > max_length:
         text = text[:max_length]
     
-    # Remove control characters except newlines and tabs
-    text = ''.join(
-        c for c in text 
-        if c in ('\n', '\t') or not unicodedata.category(c).startswith('C')
-    )
+    # Remove control characters except newlines and tabs. Printable text
+    # has none, which str.isprintable() checks without a table lookup.
+    if not text.replace('\n', '').replace('\t', '').isprintable():
+        text = text.translate(_CONTROL_CHARS)
     
     return text.strip() if text.strip() else None
 
@@ -99,6 +116,20 @@ def validate_config(config: dict) -> list[str]:
         "vote_down_limit_interval": (0, 3600),
         "media_auto_disable_hours": (0, 168),
         "purge_old_default_days": (0, 3650),  # 0 allowed: makes default /refresh do full non-pinned purge (deletion+recreation)
+        "cache_snapshot_interval": (1, 1440),
+        "reaction_mirror_delay": (0, 60),
+        "karma_digest_interval": (0, 3600),
+        "update_workers": (0, 64),
+        "update_queue_size": (1, 100000),
+        "async_concurrency": (1, 256),
+        "http_pool_size": (0, 128),
+        "http_connect_timeout": (1, 120),
+        "http_read_timeout": (1, 600),
+        "metrics_port": (0, 65535),
+        "lock_profiling_interval": (0, 1440),
+        "trace_file_size": (1, 1024),
+        "trace_file_count": (0, 100),
+        "slow_query_ms": (0, 60000),
     }
     
     for field, (min_val, max_val) in numeric_fields.items():
@@ -117,11 +148,30 @@ def validate_config(config: dict) -> list[str]:
         elif db_config[0] not in ("json", "sqlite"):
             errors.append("database type must be 'json' or 'sqlite'")
     
+    # Validate webhook config
+    webhook = config.get("webhook")
+    if webhook:
+        if not isinstance(webhook, dict):
+            errors.append("webhook must be a mapping")
+        else:
+            if not str(webhook.get("url", "")).startswith("https://"):
+                errors.append("webhook.url must be an https:// URL")
+            token = webhook.get("secret_token")
+            if not isinstance(token, str) or not re.match(r'^[A-Za-z0-9_-]{1,256}$', token):
+                errors.append("webhook.secret_token must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+            port = webhook.get("port", 8443)
+            if not isinstance(port, int) or not 0 < port < 65536:
+                errors.append("webhook.port must be between 1 and 65535")
+    
+    profile_dir = config.get("profile_dir")
+    if profile_dir is not None and (not isinstance(profile_dir, str) or profile_dir == ""):
+        errors.append("profile_dir must be a non-empty path")
+    
     # Validate boolean fields
     bool_fields = [
         "reg_open", "allow_contacts", "allow_documents", 
         "allow_polls", "enable_signing", "karma_is_pats",
-        "media_blocked", "is_leader"
+        "media_blocked", "is_leader", "async_runtime", "lock_profiling"
     ]
     
     for field in bool_fields:
@@ -0,0 +1,65 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY_SIZE = 1 << 20
+
+class WebhookServer():
+	"""Minimal HTTP server receiving updates pushed by the Bot API.
+
+	Every POST to `path` carrying the right secret token header is decoded
+	and handed to `on_update(dict)`. The handler should only enqueue the
+	update, Telegram waits for the response before sending the next one.
+	"""
+	def __init__(self, on_update, secret_token, listen="127.0.0.1", port=8443, path="/"):
+		self.on_update = on_update
+		self.secret_token = secret_token.encode()
+		self.path = path
+		self.httpd = ThreadingHTTPServer((listen, port), self._makeHandler())
+		self.httpd.daemon_threads = True
+
+	@property
+	def port(self):
+		return self.httpd.server_address[1]
+
+	def _makeHandler(self):
+		server = self
+		class Handler(BaseHTTPRequestHandler):
+			def do_POST(self):
+				self.send_response(server._handle(self))
+				self.send_header("Content-Length", "0")
+				self.end_headers()
+			def log_message(self, format, *args):
+				logging.debug("webhook: " + format, *args)
+		return Handler
+
+	def _handle(self, req):
+		if req.path != self.path:
+			return 404
+		token = req.headers.get(SECRET_TOKEN_HEADER, "").encode()
+		if not hmac.compare_digest(token, self.secret_token):
+			logging.warning("webhook: rejected request with bad secret token from %s", req.client_address[0])
+			return 403
+		try:
+			length = int(req.headers.get("Content-Length", 0))
+			if length > MAX_BODY_SIZE:
+				return 413
+			update = json.loads(req.rfile.read(length))
+		except ValueError:
+			return 400
+		try:
+			self.on_update(update)
+		except Exception:
+			logging.exception("webhook: failed to handle update")
+			return 500
+		return 200
+
+	def serve_forever(self):
+		logging.info("Listening for webhook updates on %s:%d%s", *self.httpd.server_address[:2], self.path)
+		self.httpd.serve_forever()
+
+	def shutdown(self):
+		self.httpd.shutdown()
+		self.httpd.server_close()
@@ -0,0 +1,288 @@
+"""Local stand-in for the Telegram Bot API.
+
+Implements the handful of methods the bot uses in its hot paths with just
+enough fidelity for telebot to parse the responses, plus knobs for latency
+and error injection. Used by the tests and the benchmarks:
+
+    with FakeBotAPI(latency=0.01) as api:
+        bot = telebot.TeleBot("123:abc", threaded=False)
+        bot.send_message(1, "hi")
+        assert api.count("sendMessage") == 1
+
+Entering the context starts the server and points telebot.apihelper.API_URL
+(and the async client's asyncio_helper.API_URL) at it, leaving restores the
+previous URLs and stops the server.
+"""
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+BOT_USER = {"id": 123, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+
+class FakeBotAPI:
+    """Fake Bot API server.
+
+    latency:    seconds added to every call, or a callable returning them
+    flood_rate: probability of answering a call with 429 Too Many Requests
+    error_rate: probability of answering a call with 500 Internal Server Error
+    retry_after: value reported in injected 429 responses
+    """
+
+    def __init__(self, latency=0.0, flood_rate=0.0, error_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.updates_cond = threading.Condition(self.lock)
+        self.reset()
+        self.httpd = None
+        self.stopping = False
+        self._saved_api_url = None
+
+    def reset(self):
+        """Forget all recorded state."""
+        with self.lock:
+            self.calls = []  # list of (method, params)
+            self.counts = Counter()
+            self.next_message_id = Counter()  # chat_id -> last message_id
+            self.messages = {}  # (chat_id, message_id) -> message dict
+            self.reactions = {}  # (chat_id, message_id) -> list of reactions
+            self.pinned = set()  # (chat_id, message_id)
+            self.updates = []
+            self.next_update_id = 1
+            self.injected = []  # list of [method or None, code, description, remaining]
+
+    # Harness
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, args=(0.05, ), daemon=True).start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.updates_cond.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def api_url(self):
+        """URL template in the format of telebot.apihelper.API_URL."""
+        return "http://127.0.0.1:%d/bot{0}/{1}" % self.httpd.server_address[1]
+
+    def __enter__(self):
+        self.start()
+        self._saved_api_url = [(helper, helper.API_URL) for helper in api_helpers()]
+        for helper, _ in self._saved_api_url:
+            helper.API_URL = self.api_url
+        return self
+
+    def __exit__(self, *exc):
+        for helper, url in self._saved_api_url:
+            helper.API_URL = url
+        self.stop()
+
+    # Test helpers
+
+    def inject_error(self, method=None, code=429, description=None, count=1):
+        """Make the next `count` calls of `method` (any method if None) fail."""
+        with self.lock:
+            self.injected.append([method, code, description, count])
+
+    def push_update(self, update):
+        """Queue an update (without update_id) to be returned by getUpdates."""
+        with self.lock:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.updates_cond.notify_all()
+        return update
+
+    def count(self, method):
+        with self.lock:
+            return self.counts[method]
+
+    # Request handling
+
+    def _make_handler(self):
+        api = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+            def do_GET(self):
+                self._handle()
+            def do_POST(self):
+                self._handle()
+            def _handle(self):
+                url = urlsplit(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length > 0 else b""
+                ctype = self.headers.get("Content-Type", "")
+                if ctype.startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode()))
+                elif ctype.startswith("application/json") and body:
+                    params.update(json.loads(body))
+                method = url.path.rsplit("/", 1)[-1]
+                code, resp = api._dispatch(method, params)
+                data = json.dumps(resp).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+    def _injected_error(self, method):
+        with self.lock:
+            for e in self.injected:
+                if e[0] is None or e[0] == method:
+                    e[3] -= 1
+                    if e[3] <= 0:
+                        self.injected.remove(e)
+                    return e[1], e[2]
+            r = self.random.random()
+        if r < self.flood_rate:
+            return 429, None
+        if r < self.flood_rate + self.error_rate:
+            return 500, None
+        return None
+
+    def _dispatch(self, method, params):
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > 0:
+            time.sleep(latency)
+        with self.lock:
+            self.calls.append((method, params))
+            self.counts[method] += 1
+        error = self._injected_error(method)
+        if error is not None:
+            code, description = error
+            resp = {"ok": False, "error_code": code}
+            if code == 429:
+                resp["description"] = description or "Too Many Requests: retry after %d" % self.retry_after
+                resp["parameters"] = {"retry_after": self.retry_after}
+            else:
+                resp["description"] = description or "Internal Server Error"
+            return code, resp
+        func = getattr(self, "_api_" + method, None)
+        if func is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        try:
+            return 200, {"ok": True, "result": func(params)}
+        except _APIError as e:
+            return e.code, {"ok": False, "error_code": e.code, "description": e.description}
+
+    def _new_message(self, params, **content):
+        chat_id = int(params["chat_id"])
+        with self.lock:
+            self.next_message_id[chat_id] += 1
+            msg = {
+                "message_id": self.next_message_id[chat_id],
+                "from": BOT_USER,
+                "chat": {"id": chat_id, "type": "private"},
+                "date": int(time.time()),
+            }
+            msg.update(content)
+            reply_to = params.get("reply_to_message_id")
+            if "reply_parameters" in params:
+                reply_to = json.loads(params["reply_parameters"]).get("message_id")
+            if reply_to is not None:
+                reply = self.messages.get((chat_id, int(reply_to)))
+                if reply is not None:
+                    msg["reply_to_message"] = reply
+            self.messages[(chat_id, msg["message_id"])] = msg
+        return msg
+
+    def _existing(self, params):
+        key = (int(params["chat_id"]), int(params["message_id"]))
+        if key not in self.messages:
+            raise _APIError(400, "Bad Request: message to delete not found")
+        return key
+
+    # Bot API methods
+
+    def _api_getMe(self, params):
+        return BOT_USER
+
+    def _api_sendMessage(self, params):
+        return self._new_message(params, text=params.get("text", ""))
+
+    def _api_sendPhoto(self, params):
+        photo = params.get("photo", "file")
+        content = {"photo": [{"file_id": photo, "file_unique_id": photo, "width": 640, "height": 480}]}
+        if "caption" in params:
+            content["caption"] = params["caption"]
+        return self._new_message(params, **content)
+
+    def _api_deleteMessage(self, params):
+        with self.lock:
+            key = self._existing(params)
+            del self.messages[key]
+            self.reactions.pop(key, None)
+            self.pinned.discard(key)
+        return True
+
+    def _api_setMessageReaction(self, params):
+        reaction = params.get("reaction", "[]")
+        with self.lock:
+            key = self._existing(params)
+            self.reactions[key] = json.loads(reaction) if isinstance(reaction, str) else reaction
+        return True
+
+    def _api_pinChatMessage(self, params):
+        with self.lock:
+            self.pinned.add(self._existing(params))
+        return True
+
+    def _api_unpinChatMessage(self, params):
+        with self.lock:
+            self.pinned.discard(self._existing(params))
+        return True
+
+    def _api_getUpdates(self, params):
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        limit = int(params.get("limit", 100))
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            if offset < 0:
+                self.updates = self.updates[offset:]
+            elif offset > 0:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            while not self.updates and not self.stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.updates_cond.wait(remaining)
+            return self.updates[:limit]
+
+
+def api_helpers():
+    """telebot modules whose API_URL to redirect (the async one needs aiohttp)."""
+    import telebot.apihelper
+    ret = [telebot.apihelper]
+    try:
+        import telebot.asyncio_helper
+        ret.append(telebot.asyncio_helper)
+    except ImportError:
+        pass
+    return ret
+
+
+class _APIError(Exception):
+    def __init__(self, code, description):
+        super().__init__(description)
+        self.code = code
+        self.description = description
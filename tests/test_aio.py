@@ -0,0 +1,143 @@
+"""Tests for the asyncio runtime."""
+import asyncio
+import threading
+import time
+import unittest
+import src.core as core
+import src.telegram as telegram
+from src.aio import AsyncRuntime, AsyncScheduler
+from src.cache import Cache, CachedMessage
+from src.database import SQLiteDatabase, User
+from tests.fake_bot_api import FakeBotAPI
+
+
+class TestAsyncRuntime(unittest.TestCase):
+    
+    def setUp(self):
+        self.rt = AsyncRuntime(concurrency=3)
+        self.rt.start()
+    
+    def tearDown(self):
+        self.rt.stop()
+    
+    def test_fan_out_bounded(self):
+        """Test that fan_out runs calls concurrently, but at most `concurrency` at once."""
+        state = {"running": 0, "peak": 0}
+        async def call(n):
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            await asyncio.sleep(0.01)
+            state["running"] -= 1
+            if n == 5:
+                raise ValueError(n)
+            return n
+        
+        results = self.rt.fan_out([call(n) for n in range(10)], timeout=5)
+        self.assertEqual(state["peak"], 3)
+        self.assertIsInstance(results[5], ValueError)
+        self.assertEqual([r for r in results if not isinstance(r, Exception)], [0, 1, 2, 3, 4, 6, 7, 8, 9])
+    
+    def test_ordered_per_key(self):
+        """Test that calls with the same key complete in submission order."""
+        seen = []
+        async def call(key, n):
+            await asyncio.sleep(0.001 * ((7 * n) % 5))
+            seen.append((key, n))
+        
+        futures = [self.rt.submit(self.rt.ordered(key, call(key, n)))
+            for n in range(20) for key in range(3)]
+        for f in futures:
+            f.result(5)
+        for key in range(3):
+            self.assertEqual([n for k, n in seen if k == key], list(range(20)))
+        self.assertEqual(self.rt.tails, {})
+
+
+class TestAsyncScheduler(unittest.TestCase):
+    
+    def test_runs_tasks(self):
+        """Test that both plain functions and coroutines get run."""
+        rt = AsyncRuntime()
+        rt.start()
+        ran = threading.Event()
+        ran_async = threading.Event()
+        async def coro():
+            ran_async.set()
+        sched = AsyncScheduler(rt)
+        sched.register(ran.set, seconds=1)
+        sched.register(coro, minutes=1)
+        threading.Thread(target=sched.run, daemon=True).start()
+        self.assertTrue(ran.wait(5))
+        self.assertTrue(ran_async.wait(5))
+        rt.stop()
+
+
+class TestAsyncDelivery(unittest.TestCase):
+    """telegram._deliver_async against the fake Bot API."""
+
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.db = SQLiteDatabase(":memory:")
+        for uid in (1, 2):
+            user = User()
+            user.defaults()
+            user.id = uid
+            user.realname = "user%d" % uid
+            self.db.addUser(user)
+        config = {"bot_token": "123:abc", "update_workers": 0, "http_pool_size": 0,
+            "karma_digest_interval": 0, "async_runtime": True, "async_concurrency": 2}
+        core.init(config, self.db, Cache())
+        telegram.init(config, self.db, core.ch)
+        self.aio = telegram.aio
+
+    def tearDown(self):
+        self.aio.submit(telegram.async_bot.close_session()).result(5)
+        self.aio.stop()
+        telegram.aio = telegram.async_bot = None
+        self.db.close()
+        self.api.__exit__(None, None, None)
+
+    def queue_items(self, n):
+        """Put n copies each for users 1 and 2 on the queue and take them off again."""
+        user1, user2 = self.db.getUser(id=1), self.db.getUser(id=2)
+        for i in range(n):
+            msid = core.ch.assignMessageId(CachedMessage())
+            telegram.send_to_single(telegram.SystemMessage("m%d" % i), msid, user1)
+            telegram.send_to_single(telegram.SystemMessage("m%d" % i), msid, user2)
+        return [telegram.message_queue.get() for i in range(2 * n)]
+
+    def test_chat_order(self):
+        """Test that concurrent deliveries keep the order per chat and save their mappings."""
+        items = self.queue_items(10)
+        futures = [self.aio.submit(telegram._deliver_async(item)) for item in items]
+        for f in futures:
+            f.result(5)
+        for uid in (1, 2):
+            texts = [p["text"] for method, p in self.api.calls
+                if method == "sendMessage" and p["chat_id"] == str(uid)]
+            self.assertEqual(texts, ["m%d" % i for i in range(10)])
+        for item in items:
+            self.assertIsNotNone(telegram.resolver.getMessageId(item.user.id, item.msid))
+        self.assertEqual(self.aio.tails, {})
+
+    def test_backoff_outside_slot(self):
+        """Test that a failed delivery is retried later without holding a slot meanwhile."""
+        item = self.queue_items(1)[0]
+        self.api.inject_error("sendMessage", code=500, description="Internal Server Error")
+        start = time.monotonic()
+        self.aio.submit(telegram._deliver_async(item)).result(5)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(self.aio.semaphore._value, self.aio.concurrency)
+        self.assertEqual(telegram.message_queue.qsize(), 0)
+        # it's back on the queue after the back-off
+        deadline = time.monotonic() + 5
+        while telegram.message_queue.qsize() == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertIs(telegram.message_queue.get(), item)
+        self.aio.submit(telegram._deliver_async(item)).result(5)
+        self.assertEqual(self.api.count("sendMessage"), 2)
+        self.assertIsNotNone(telegram.resolver.getMessageId(item.user.id, item.msid))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 """Tests for cache functionality."""
+import sys
+import threading
 import unittest
 from datetime import datetime, timedelta
-from src.cache import CachedMessage, Cache
+from src.cache import CachedMessage, Cache, FLAG_WARNED, FLAG_CLEANED, VOTES_SET_THRESHOLD
 
 
 class TestCachedMessage(unittest.TestCase):
@@ -46,6 +48,66 @@ class TestCachedMessage(unittest.TestCase):
         self.assertFalse(self.cm.hasDownvoted(user))
         self.cm.addDownvote(user)
         self.assertTrue(self.cm.hasDownvoted(user))
+    
+    def test_votes_share_empty_sentinel(self):
+        """Test that unvoted messages don't allocate their own containers."""
+        other = CachedMessage(user_id=1)
+        self.assertIs(self.cm.upvoted, other.upvoted)
+        self.assertIs(self.cm.upvoted, self.cm.downvoted)
+    
+    def test_votes_promoted_to_set(self):
+        """Test that votes grow as a tuple and are promoted past the threshold."""
+        from src.database import User
+        users = []
+        for i in range(VOTES_SET_THRESHOLD + 2):
+            user = User()
+            user.id = 1000 + i
+            users.append(user)
+            self.cm.addUpvote(user)
+            self.cm.addUpvote(user) # duplicate votes are ignored
+        self.assertIsInstance(self.cm.upvoted, set)
+        self.assertEqual(len(self.cm.upvoted), len(users))
+        for user in users:
+            self.assertTrue(self.cm.hasUpvoted(user))
+        self.assertEqual(len(self.cm.downvoted), 0)
+    
+    def test_concurrent_votes(self):
+        """Test that votes added from many threads at once are all kept, once."""
+        from src.database import User
+        users = []
+        for i in range(200):
+            user = User()
+            user.id = 1000 + i
+            users.append(user)
+        added = []
+        barrier = threading.Barrier(8)
+        def vote(part):
+            barrier.wait()
+            for user in users[part::4]: # every user votes from two threads
+                added.append(self.cm.addUpvote(user))
+        threads = [threading.Thread(target=vote, args=(i % 4, )) for i in range(8)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6) # switch threads as often as possible
+        try:
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(len(self.cm.upvoted), len(users))
+        self.assertEqual(added.count(True), len(users))
+        self.assertFalse(self.cm.addDownvote(users[0]))
+
+    def test_flags(self):
+        """Test warned property and flag bits."""
+        self.cm.warned = True
+        self.assertTrue(self.cm.hasFlag(FLAG_WARNED))
+        self.assertFalse(self.cm.hasFlag(FLAG_CLEANED))
+        self.cm.setFlag(FLAG_CLEANED)
+        self.cm.warned = False
+        self.assertFalse(self.cm.warned)
+        self.assertTrue(self.cm.hasFlag(FLAG_CLEANED))
 
 
 class TestCache(unittest.TestCase):
@@ -82,6 +144,19 @@ class TestCache(unittest.TestCase):
         result = self.cache.lookupMappingByData(message_id, uid=uid)
         self.assertEqual(result, msid)
     
+    def test_recipient_mappings(self):
+        """Test fetching all copies of a message and deleting them."""
+        self.cache.saveMapping(1, 100, 11)
+        self.cache.saveMapping(2, 100, 12)
+        self.cache.saveMapping(2, 101, 13)
+        self.assertEqual(sorted(self.cache.getRecipientMappings(100)), [(1, 11), (2, 12)])
+        self.assertEqual(self.cache.getRecipientMappings(102), [])
+        
+        self.cache.deleteMappings(100)
+        self.assertEqual(self.cache.getRecipientMappings(100), [])
+        self.assertIsNone(self.cache.lookupMappingByData(12, uid=2))
+        self.assertEqual(self.cache.lookupMappingByData(13, uid=2), 101)
+    
     def test_get_message(self):
         """Test retrieving cached message."""
         cm = CachedMessage(user_id=123)
@@ -110,6 +185,51 @@ class TestCache(unittest.TestCase):
         self.assertIn(msid1, msids)
         self.assertIn(msid2, msids)
         self.assertNotIn(msid3, msids)
+    
+    def test_snapshot_roundtrip(self):
+        """Test saving and reloading a cache snapshot."""
+        import os
+        import tempfile
+        from src.database import User
+        voter = User()
+        voter.id = 777
+        
+        cm = CachedMessage(user_id=123)
+        cm.warned = True
+        cm.addUpvote(voter)
+        msid = self.cache.assignMessageId(cm)
+        expired = CachedMessage(user_id=456)
+        expired.time = datetime.now() - timedelta(hours=49)
+        msid_expired = self.cache.assignMessageId(expired)
+        popular = CachedMessage(user_id=321)
+        popular.downvoted = set(range(1, 70001)) # more than fits in 16 bits
+        msid_popular = self.cache.assignMessageId(popular)
+        self.cache.assignMessageId(CachedMessage())
+        self.cache.saveMapping(123, msid, 5)
+        self.cache.saveMapping(999, msid, 6)
+        self.cache.saveMapping(999, msid_expired, 7)
+        
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "cache.snapshot")
+            self.cache.saveSnapshot(path)
+            cache2 = Cache()
+            self.assertTrue(cache2.loadSnapshot(path))
+        
+        cm2 = cache2.getMessage(msid)
+        self.assertEqual(cm2.user_id, 123)
+        self.assertTrue(cm2.warned)
+        self.assertTrue(cm2.hasUpvoted(voter))
+        self.assertIsNone(cache2.getMessage(msid_expired))
+        self.assertEqual(cache2.getMessage(msid_popular).downvoted, popular.downvoted)
+        self.assertEqual(cache2.lookupMapping(999, msid=msid), 6)
+        self.assertEqual(cache2.lookupMappingByData(5, uid=123), msid)
+        self.assertIsNone(cache2.lookupMappingByData(7, uid=999))
+        # new ids must not collide with restored ones
+        self.assertGreater(cache2.assignMessageId(CachedMessage()), msid)
+    
+    def test_snapshot_missing_file(self):
+        """Test loading a snapshot that doesn't exist."""
+        self.assertFalse(self.cache.loadSnapshot("/nonexistent/cache.snapshot"))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,181 @@
+"""Tests for the table-driven command dispatch, per-update context and system messages in telegram.py."""
+import time
+import unittest
+from telebot.types import Message
+import src.core as core
+import src.replies as rp
+import src.telegram as telegram
+from src.cache import Cache
+from src.database import SQLiteDatabase, User
+from tests.fake_bot_api import FakeBotAPI
+
+
+def make_command(text, uid, reply_to=None):
+    d = {
+        "message_id": 500,
+        "from": {"id": uid, "is_bot": False, "first_name": "user%d" % uid},
+        "chat": {"id": uid, "type": "private"},
+        "date": int(time.time()),
+        "text": text,
+    }
+    if reply_to is not None:
+        d["reply_to_message"] = dict(d, message_id=reply_to, text="hi")
+    return Message.de_json(d)
+
+
+class TestCommandDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.db = SQLiteDatabase(":memory:")
+        for uid, rank in ((1, core.RANKS.user), (2, core.RANKS.admin)):
+            user = User()
+            user.defaults()
+            user.id = uid
+            user.realname = "user%d" % uid
+            user.rank = rank
+            self.db.addUser(user)
+        config = {"bot_token": "123:abc", "update_workers": 0, "http_pool_size": 0,
+            "karma_digest_interval": 0}
+        core.init(config, self.db, Cache())
+        telegram.init(config, self.db, core.ch)
+        # count user lookups during dispatch
+        self.lookups = 0
+        get_user = self.db.getUser
+        def counting_get_user(*args, **kwargs):
+            self.lookups += 1
+            return get_user(*args, **kwargs)
+        self.db.getUser = counting_get_user
+        self.writes = []
+        update_user = self.db.updateUser
+        def recording_update_user(id, **fields):
+            self.writes.append(fields)
+            return update_user(id, **fields)
+        self.db.updateUser = recording_update_user
+
+    def tearDown(self):
+        self.db.close()
+        self.api.__exit__(None, None, None)
+
+    def sent(self):
+        return [p["text"] for method, p in self.api.calls if method == "sendMessage"]
+
+    def test_requirements(self):
+        """Test that rank and reply requirements are enforced before handlers run."""
+        self.assertTrue(telegram._handle_command(make_command("/stats", 1)))
+        self.assertTrue(telegram._handle_command(make_command("/warn@fake_bot", 2)))
+        self.assertTrue(telegram._handle_command(make_command("/warn", 2, reply_to=77)))
+        self.assertTrue(telegram._handle_command(make_command("/uncooldown", 2)))
+        sent = self.sent()
+        self.assertIn("This command has been disabled.", sent[0])
+        self.assertIn("You need to reply to a message", sent[1])
+        self.assertIn("not found in cache", sent[2])
+        self.assertIn("requires an argument", sent[3])
+        self.assertEqual(self.lookups, 4)
+
+    def test_dispatch(self):
+        """Test handler results, unknown commands and latency counters."""
+        calls = telegram.COMMAND_CALLS.get(command="help")
+        self.assertTrue(telegram._handle_command(make_command("/help", 1)))
+        self.assertFalse(telegram._handle_command(make_command("/nonexistent", 1)))
+        self.assertFalse(telegram._handle_command(make_command("not a command", 1)))
+        self.assertTrue(telegram._handle_command(make_command("/stats", 2)))
+        # commands from unknown users are swallowed
+        self.assertTrue(telegram._handle_command(make_command("/help", 3)))
+        sent = self.sent()
+        self.assertEqual(len(sent), 2)
+        self.assertIn("Show available commands", sent[0])
+        self.assertNotIn("/stats", sent[0])  # admin commands are hidden from users
+        self.assertIn("Relayed messages", sent[1])
+        self.assertEqual(self.api.calls[-1][1]["reply_parameters"].count("500"), 1)
+        self.assertEqual(telegram.COMMAND_CALLS.get(command="help"), calls + 2)
+        self.assertGreater(telegram.COMMAND_TIME.get(command="help"), 0)
+        self.assertEqual(self.lookups, 3)
+
+    def test_update_context(self):
+        """Test that an update reads the sender once and writes its changes in one go."""
+        self.assertTrue(telegram._handle_command(make_command("/info", 1)))
+        self.assertEqual(self.lookups, 1)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(list(self.writes[0].keys()), ["lastActive"])
+
+        self.lookups, self.writes = 0, []
+        for i in range(5):
+            telegram.relay(make_command("same text", 1))
+        self.assertEqual(self.lookups, 5)
+        # the repeat spam cooldown is coalesced with the lastActive update
+        self.assertEqual(len(self.writes), 5)
+        self.assertIn("cooldownUntil", self.writes[-1])
+        self.assertTrue(self.db.getUser(id=1).isInCooldown())
+
+    def test_system_broadcast(self):
+        """Test that a system broadcast is formatted once and delivered as HTML."""
+        user = User()
+        user.defaults()
+        user.id = 3
+        user.realname = "user3"
+        self.db.addUser(user)
+        for uid in (1, 2, 3):
+            self.db.mark_bot_user_seen(telegram.BOT_ID, uid)
+        core._push_system_message(rp.Reply(rp.types.SUCCESS_UNBLACKLIST, id="abc"),
+            except_who=self.db.getUser(id=1))
+        items = [telegram.message_queue.get() for i in range(telegram.message_queue.qsize())]
+        self.assertEqual(sorted(item.user.id for item in items), [2, 3])
+        self.assertIs(items[0].msg, items[1].msg)
+        self.assertIsNotNone(items[0].msid)
+        for item in items:
+            telegram.send_to_single_inner(item.user.id, item.msg, item.reply_to)
+        calls = [p for method, p in self.api.calls if method == "sendMessage"]
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0]["text"], "☑ <b>abc</b> <i>has been unblacklisted</i>")
+        self.assertEqual(calls[0]["parse_mode"], "HTML")
+
+    def test_karma_digest_pats(self):
+        """Test that a digest of several pat reactions is worded as pats."""
+        sender = self.db.getUser(id=2)
+        self.db.mark_bot_user_seen(telegram.BOT_ID, 2)
+        core.karma_digest.add(sender, 1, 9, "❤️", True) # notified right away
+        for i in range(3):
+            core.karma_digest.add(sender, 1, 10 + i, "❤️", True)
+        core.karma_digest.add(self.db.getUser(id=1), 1, 19, "👍", False)
+        core.karma_digest.add(self.db.getUser(id=1), 1, 20, "👍", False)
+        core.karma_digest.add(self.db.getUser(id=1), 1, 21, "👍", False)
+        core.karma_digest.scheduledTask()
+        items = [telegram.message_queue.get() for i in range(telegram.message_queue.qsize())]
+        texts = {item.user.id: item.msg.text for item in items}
+        self.assertIn("+3 pats from 3 reactions", texts[2])
+        self.assertIn("+2 karma from 2 reactions", texts[1])
+
+    def test_karma_digest_first_immediate(self):
+        """Test that the first reaction is notified right away and only the ones after it wait."""
+        core.karma_digest_interval = 60
+        try:
+            sender = self.db.getUser(id=2)
+            def queued():
+                return [telegram.message_queue.get().msg.text for i in range(telegram.message_queue.qsize())]
+            core._notify_karma_received(sender, 10, 1, "👍", False)
+            first = queued()
+            self.assertEqual(len(first), 1)
+            self.assertNotIn("reactions", first[0])
+            for i in range(3):
+                core._notify_karma_received(sender, 11 + i, 1, "👍", False)
+            self.assertEqual(queued(), [])
+            core.karma_digest.scheduledTask()
+            digest = queued()
+            self.assertEqual(len(digest), 1)
+            self.assertIn("+3 karma from 3 reactions", digest[0])
+            # still busy: the next reaction waits for the next digest
+            core._notify_karma_received(sender, 14, 1, "👍", False)
+            self.assertEqual(queued(), [])
+            core.karma_digest.scheduledTask()
+            self.assertEqual(queued(), first)
+            # a quiet interval later the first reaction is immediate again
+            core.karma_digest.scheduledTask()
+            self.assertEqual(queued(), [])
+            core._notify_karma_received(sender, 15, 1, "👍", False)
+            self.assertEqual(queued(), first)
+        finally:
+            core.karma_digest_interval = 0
+
+if __name__ == '__main__':
+    unittest.main()
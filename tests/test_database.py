@@ -0,0 +1,44 @@
+"""Tests for SQLiteDatabase statement timing and the slow-query log."""
+import unittest
+from src.database import SQLiteDatabase
+
+
+class TestQueryStats(unittest.TestCase):
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_aggregate_per_statement(self):
+        """Test that executions of the same statement are counted together."""
+        self.db = SQLiteDatabase(":memory:", slow_query_ms=0)
+        for msid in range(5):
+            self.db.save_message_mapping(10, msid, 1000 + msid, bot_id=1)
+        self.db.db.execute("SELECT   COUNT(*)\n FROM message_mapping")
+        self.db.db.execute("SELECT COUNT(*) FROM message_mapping")
+
+        stats = {e["sql"]: e for e in self.db.getQueryStats()}
+        count = stats["SELECT COUNT(*) FROM message_mapping"]
+        self.assertEqual(count["count"], 2)
+        self.assertEqual(count["slow"], 0)
+        self.assertGreaterEqual(count["max"], count["avg"])
+        self.assertEqual(max(e["count"] for e in stats.values() if e["sql"].startswith("REPLACE INTO message_mapping")), 5)
+        totals = [e["total"] for e in self.db.getQueryStats()]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        self.assertEqual(len(self.db.getQueryStats(top=1)), 1)
+
+    def test_slow_query_logged_with_plan(self):
+        """Test that statements over the threshold are logged with their plan, once a minute."""
+        self.db = SQLiteDatabase(":memory:", slow_query_ms=1e-6)
+        with self.assertLogs(level="WARNING") as logs:
+            for _ in range(3):
+                self.db.get_old_non_pinned_msids(bot_id=1)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("Slow query", logs.output[0])
+        self.assertIn("plan:", logs.output[0])
+        self.assertIn("SCAN", logs.output[0])
+        stats = self.db.getQueryStats(top=1)[0]
+        self.assertEqual(stats["slow"], stats["count"])
+
+
+if __name__ == '__main__':
+    unittest.main()
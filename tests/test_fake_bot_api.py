@@ -0,0 +1,72 @@
+"""Tests for the fake Bot API server used by tests and benchmarks."""
+import time
+import unittest
+import telebot
+from telebot.apihelper import ApiTelegramException
+from telebot.types import ReactionTypeEmoji
+from tests.fake_bot_api import FakeBotAPI
+
+
+class TestFakeBotAPI(unittest.TestCase):
+    
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.bot = telebot.TeleBot("123:abc", threaded=False)
+    
+    def tearDown(self):
+        self.api.__exit__(None, None, None)
+    
+    def test_send_and_modify(self):
+        """Test sending messages and acting on them through telebot."""
+        self.assertEqual(self.bot.get_me().username, "fake_bot")
+        m1 = self.bot.send_message(10, "hello")
+        m2 = self.bot.send_photo(10, "FILEID", caption="cap", reply_to_message_id=m1.message_id)
+        self.assertEqual((m1.message_id, m2.message_id), (1, 2))
+        self.assertEqual(m1.text, "hello")
+        self.assertEqual(m2.photo[0].file_id, "FILEID")
+        self.assertEqual(m2.reply_to_message.message_id, 1)
+        
+        self.bot.set_message_reaction(10, m1.message_id, [ReactionTypeEmoji("\U0001F44D")])
+        self.bot.pin_chat_message(10, m2.message_id)
+        self.assertEqual(self.api.reactions[(10, 1)][0]["emoji"], "\U0001F44D")
+        self.assertIn((10, 2), self.api.pinned)
+        
+        self.bot.delete_message(10, m1.message_id)
+        with self.assertRaises(ApiTelegramException):
+            self.bot.delete_message(10, m1.message_id)
+        self.assertEqual(self.api.count("deleteMessage"), 2)
+    
+    def test_error_injection(self):
+        """Test injected 429 and server errors."""
+        self.api.inject_error("sendMessage", code=429)
+        with self.assertRaises(ApiTelegramException) as cm:
+            self.bot.send_message(10, "x")
+        self.assertEqual(cm.exception.error_code, 429)
+        self.assertEqual(cm.exception.result_json["parameters"]["retry_after"], 1)
+        self.bot.send_message(10, "x")  # only the next call fails
+        
+        self.api.error_rate = 1.0
+        with self.assertRaises(ApiTelegramException) as cm:
+            self.bot.send_message(10, "x")
+        self.assertEqual(cm.exception.error_code, 500)
+    
+    def test_get_updates(self):
+        """Test that pushed updates are returned and confirmed via offset."""
+        for text in ("a", "b"):
+            self.api.push_update({"message": {"message_id": 1, "date": 0, "text": text,
+                "chat": {"id": 5, "type": "private"}, "from": {"id": 5, "is_bot": False, "first_name": "U"}}})
+        updates = self.bot.get_updates(timeout=5, long_polling_timeout=1)
+        self.assertEqual([u.message.text for u in updates], ["a", "b"])
+        updates = self.bot.get_updates(offset=updates[0].update_id + 1, timeout=5, long_polling_timeout=1)
+        self.assertEqual([u.message.text for u in updates], ["b"])
+    
+    def test_latency(self):
+        """Test that configured latency is applied to every call."""
+        self.api.latency = 0.05
+        start = time.monotonic()
+        self.bot.send_message(10, "x")
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Tests for the shared HTTP session pool."""
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from src.http_pool import HTTPSessionPool
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    
+    def do_POST(self):
+        if self.path.endswith("/slow"):
+            time.sleep(0.5)
+        body = json.dumps({"ok": True, "result": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHTTPSessionPool(unittest.TestCase):
+    
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/bot123:abc/" % self.httpd.server_address[1]
+        self.pool = HTTPSessionPool(size=2, connect_timeout=1, read_timeout=5)
+    
+    def tearDown(self):
+        self.pool.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+    
+    def test_connections_reused(self):
+        """Test that many requests from many threads share the pool's connections."""
+        def worker():
+            for _ in range(10):
+                r = self.pool.request("post", self.url + "sendMessage", params={"chat_id": 1},
+                    timeout=(15, 5))
+                self.assertEqual(r.json()["result"], True)
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        
+        stats = self.pool.getStats()
+        self.assertEqual(stats["requests"], 40)
+        self.assertLessEqual(stats["connections_opened"], 2)
+        self.assertEqual(stats["connections_reused"], 40 - stats["connections_opened"])
+    
+    def test_read_timeout(self):
+        """Test that the caller's read timeout is honoured."""
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.pool.request("post", self.url + "slow", timeout=(15, 0.1))
+        self.assertEqual(self.pool.getStats()["errors"], 1)
+
+    def test_environment_settings(self):
+        """Test that CA bundle, proxy and .netrc settings from the environment are honoured."""
+        import os
+        import tempfile
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as d:
+            netrc = os.path.join(d, "netrc")
+            with open(netrc, "w") as f:
+                f.write("machine api.example.org login bot password secret\n")
+            env = {"REQUESTS_CA_BUNDLE": "/etc/bundle.pem", "NETRC": netrc,
+                "HTTPS_PROXY": "http://proxy.example.org:3128", "NO_PROXY": ""}
+            with mock.patch.dict(os.environ, env):
+                settings = self.pool._environSettings("https://api.example.org/bot1/getMe")
+        self.assertEqual(settings["verify"], "/etc/bundle.pem")
+        self.assertEqual(settings["auth"], ("bot", "secret"))
+        self.assertEqual(settings["proxies"].get("https"), "http://proxy.example.org:3128")
+        # resolved once per host
+        self.assertIs(self.pool._environSettings("https://api.example.org/bot1/sendMessage"), settings)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Tests for the lock contention profiler."""
+import threading
+import time
+import unittest
+from threading import Lock, RLock
+from src.lockprof import LockProfiler, ProfiledLock
+
+
+class _Holder:
+    def __init__(self):
+        self.lock = RLock()
+
+
+class TestLockProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.profiler = LockProfiler(depth=1)
+
+    def test_wait_and_hold(self):
+        """Test that a contended acquisition records its wait, hold and site."""
+        lock = ProfiledLock(Lock(), "test.lock", self.profiler)
+        acquired = threading.Event()
+        def holder():
+            with lock:
+                acquired.set()
+                time.sleep(0.1)
+        t = threading.Thread(target=holder)
+        t.start()
+        acquired.wait()
+        with lock:
+            pass
+        t.join()
+
+        report = self.profiler.getReport()
+        self.assertEqual(len(report), 2)
+        top = report[0]
+        self.assertEqual(top["lock"], "test.lock")
+        self.assertIn("test_wait_and_hold", top["site"])
+        self.assertEqual(top["contended"], 1)
+        self.assertGreater(top["wait_total"], 0.05)
+        self.assertIn("holder", report[1]["site"])
+        self.assertGreater(report[1]["hold_max"], 0.05)
+        self.assertIn("test.lock @ test_lockprof.py", self.profiler.formatReport())
+
+    def test_wrap_reentrant(self):
+        """Test wrapping an attribute and counting nested acquires once."""
+        obj = _Holder()
+        self.profiler.wrap(obj, "lock")
+        self.assertIsInstance(obj.lock, ProfiledLock)
+        with obj.lock:
+            self.assertTrue(obj.lock.acquire())
+            obj.lock.release()
+        self.assertFalse(obj.lock.lock._is_owned())
+
+        report = self.profiler.getReport()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]["lock"], "_Holder.lock")
+        self.assertEqual(report[0]["acquisitions"], 1)
+        self.assertEqual(report[0]["contended"], 0)
+        self.profiler.reset()
+        self.assertEqual(self.profiler.getReport(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Tests for the metrics registry."""
+import threading
+import unittest
+from threading import RLock
+from urllib.request import urlopen
+from src.metrics import Registry, Histogram, TimedLock, MetricsServer
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_counter_render(self):
+        """Test labelled and function-backed metrics in the text format."""
+        registry = Registry()
+        c = registry.counter("failures_total", "Failures", ("error", ))
+        c.inc(error="api_429")
+        c.inc(2, error="api_429")
+        c.inc(error='say "hi"')
+        registry.gauge("depth", "Queue depth", func=lambda: 7)
+        self.assertEqual(c.get(error="api_429"), 3)
+        self.assertEqual(c.get(), 4)
+        self.assertIs(registry.counter("failures_total", "Failures", ("error", )), c)
+
+        text = registry.render()
+        self.assertIn("# TYPE failures_total counter", text)
+        self.assertIn('failures_total{error="api_429"} 3', text)
+        self.assertIn('failures_total{error="say \\"hi\\""} 1', text)
+        self.assertIn("# TYPE depth gauge\ndepth 7\n", text)
+
+    def test_histogram(self):
+        """Test bucket counts and quantile estimates."""
+        h = Histogram("t", "Time", buckets=(1, 2, 4))
+        self.assertIsNone(h.quantile(0.5))
+        for v in (0.5, 1.5, 1.5, 3, 10):
+            h.observe(v)
+        lines = h.render()
+        self.assertIn('t_bucket{le="1"} 1', lines)
+        self.assertIn('t_bucket{le="2"} 3', lines)
+        self.assertIn('t_bucket{le="+Inf"} 5', lines)
+        self.assertIn("t_count 5", lines)
+        self.assertTrue(1 <= h.quantile(0.5) <= 2)
+        self.assertEqual(h.quantile(1.0), 4)
+
+    def test_timed_lock_and_server(self):
+        """Test that a reentrant hold counts once, and scraping /metrics."""
+        registry = Registry()
+        held = registry.histogram("held", "Lock held")
+        lock = TimedLock(RLock(), held)
+        with lock:
+            with lock:
+                pass
+        t = threading.Thread(target=lambda: lock.acquire() and lock.release())
+        t.start()
+        t.join()
+        self.assertEqual(held.count, 2)
+
+        server = MetricsServer(registry, port=0)
+        server.start()
+        try:
+            with urlopen("http://127.0.0.1:%d/metrics" % server.port) as r:
+                body = r.read().decode()
+        finally:
+            server.shutdown()
+        self.assertIn("held_count 2", body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+"""Tests for the coalesced reaction mirroring in telegram.py."""
+import time
+import unittest
+from unittest import mock
+from telebot.types import Update
+import src.core as core
+import src.telegram as telegram
+from src.cache import Cache, CachedMessage
+from src.database import SQLiteDatabase, User
+from tests.fake_bot_api import FakeBotAPI
+
+
+def make_reaction(uid, message_id, emoji):
+    return Update.de_json({"update_id": 1, "message_reaction": {
+        "chat": {"id": uid, "type": "private"},
+        "message_id": message_id,
+        "user": {"id": uid, "is_bot": False, "first_name": "user%d" % uid},
+        "date": int(time.time()),
+        "old_reaction": [],
+        "new_reaction": [{"type": "emoji", "emoji": emoji}],
+    }})
+
+
+class TestReactionMirrors(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.db = SQLiteDatabase(":memory:")
+        for uid in (1, 2, 3, 4):
+            user = User()
+            user.defaults()
+            user.id = uid
+            user.realname = "user%d" % uid
+            self.db.addUser(user)
+        config = {"bot_token": "123:abc", "update_workers": 0, "http_pool_size": 0,
+            "karma_digest_interval": 0, "reaction_mirror_delay": 0}
+        core.init(config, self.db, Cache())
+        telegram.init(config, self.db, core.ch)
+        telegram._pending_reactions.clear()
+        # two relayed messages by user 1, with a copy for everyone
+        self.msids = []
+        self.copies = {} # (msid, uid) -> message_id
+        for i in range(2):
+            msid = core.ch.assignMessageId(CachedMessage(user_id=1))
+            for uid in (1, 2, 3, 4):
+                mid = telegram.bot.send_message(uid, "message %d" % i).message_id
+                telegram.resolver.saveMapping(uid, msid, mid)
+                self.copies[(msid, uid)] = mid
+            self.msids.append(msid)
+        self.api.calls.clear()
+
+    def tearDown(self):
+        telegram._pending_reactions.clear()
+        self.db.close()
+        self.api.__exit__(None, None, None)
+
+    def queued(self):
+        """(priority, item) for everything waiting in message_queue, in queue order."""
+        q = telegram.message_queue
+        with q.lock:
+            items = dict(q.items)
+        prios = {iid: prio for prio, iid in q.queue.queue}
+        return [(prios[iid], item) for iid, item in sorted(items.items())]
+
+    def mirrors(self):
+        """{(msid, chat_id): emoji} of the queued reaction mirrors."""
+        ret = {}
+        for prio, item in self.queued():
+            if item.kind == "reaction":
+                self.assertNotIn((item.msid, item.chat_id), ret)
+                ret[(item.msid, item.chat_id)] = item.emoji
+        return ret
+
+    def test_handler_queues_mirror(self):
+        """Test that a reaction update only records a job, which the flush turns into API calls."""
+        msid = self.msids[0]
+        telegram._process_update(make_reaction(2, self.copies[(msid, 2)], "👍"))
+        self.assertIn(msid, telegram._pending_reactions)
+        self.assertEqual(self.api.count("setMessageReaction"), 0)
+        telegram._flush_reaction_mirrors()
+        self.assertEqual(self.mirrors(), {(msid, 1): "👍", (msid, 3): "👍", (msid, 4): "👍"})
+        for prio, item in self.queued():
+            if item.kind == "reaction":
+                telegram._mirror_reaction(item)
+        self.assertEqual(self.api.count("setMessageReaction"), 3)
+        self.assertEqual(self.api.reactions, {(uid, self.copies[(msid, uid)]): [{"type": "emoji", "emoji": "👍"}]
+            for uid in (1, 3, 4)})
+
+    def test_coalesced_per_msid(self):
+        """Test that reactions on one msid result in a single call per copy."""
+        a, b = self.msids
+        telegram.queue_reaction_mirror(a, "👍", 2)
+        telegram.queue_reaction_mirror(a, "❤", 3)
+        telegram.queue_reaction_mirror(a, "🔥", 3)
+        telegram.queue_reaction_mirror(b, "👍", 4)
+        self.assertEqual(set(telegram._pending_reactions), {a, b})
+        telegram._flush_reaction_mirrors()
+        self.assertEqual(telegram._pending_reactions, {})
+        self.assertEqual(self.mirrors(), {
+            # the latest emoji wins, including on the copy of the earlier reactor...
+            (a, 1): "🔥", (a, 2): "🔥", (a, 4): "🔥",
+            # ...while the latest reactor gets the one before it, from someone else
+            (a, 3): "👍",
+            (b, 1): "👍", (b, 2): "👍", (b, 3): "👍",
+        })
+
+    def test_reactor_skipped(self):
+        """Test that the only reactor's own copy gets no mirror, however often they react."""
+        msid = self.msids[0]
+        telegram.queue_reaction_mirror(msid, "👍", 2)
+        telegram.queue_reaction_mirror(msid, "❤", 2)
+        telegram._flush_reaction_mirrors()
+        self.assertEqual(self.mirrors(), {(msid, 1): "❤", (msid, 3): "❤", (msid, 4): "❤"})
+
+    def test_due_window(self):
+        """Test that jobs are only queued once reaction_mirror_delay has passed."""
+        telegram.reaction_mirror_delay = 60
+        msid = self.msids[0]
+        telegram.queue_reaction_mirror(msid, "👍", 2)
+        telegram._flush_reaction_mirrors()
+        self.assertEqual(self.queued(), [])
+        # reactions within the window join the pending job, they don't extend it
+        due = telegram._pending_reactions[msid]["due"]
+        telegram.queue_reaction_mirror(msid, "❤", 3)
+        self.assertEqual(telegram._pending_reactions[msid]["due"], due)
+        with mock.patch.object(telegram.time, "monotonic", return_value=due + 1):
+            telegram._flush_reaction_mirrors()
+        self.assertEqual(len(self.mirrors()), 4)
+        self.assertEqual(telegram._pending_reactions, {})
+
+    def test_priority(self):
+        """Test that mirrors queue behind relayed messages."""
+        msid = self.msids[0]
+        telegram.queue_reaction_mirror(msid, "👍", 2)
+        telegram._flush_reaction_mirrors()
+        telegram.send_to_single(telegram.SystemMessage("hi"), None, self.db.getUser(id=2))
+        queued = self.queued()
+        self.assertEqual([prio for prio, item in queued if item.kind == "reaction"],
+            [telegram.PRIORITY_REACTION] * 3)
+        self.assertEqual(telegram.message_queue.get().kind, "message")
+        self.assertEqual(telegram.message_queue.get().kind, "reaction")
+
+    def test_cancel_on_delete(self):
+        """Test that deleting a message drops its pending and already queued mirrors."""
+        a, b = self.msids
+        telegram.queue_reaction_mirror(a, "👍", 2)
+        telegram._flush_reaction_mirrors()
+        telegram.queue_reaction_mirror(a, "❤", 3)
+        telegram.queue_reaction_mirror(b, "👍", 2)
+        telegram.send_to_single(telegram.SystemMessage("hi"), a, self.db.getUser(id=2))
+        self.assertEqual(len(self.mirrors()), 3)
+        telegram._TelegramReceiver.delete([a])
+        self.assertEqual(set(telegram._pending_reactions), {b})
+        self.assertEqual(self.mirrors(), {})
+        self.assertEqual([item.kind for prio, item in self.queued()], ["message"])
+        self.assertEqual(self.api.count("deleteMessage"), 4)
+        self.assertEqual(len(self.api.messages), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests for reply formatting with compiled templates."""
+import unittest
+from datetime import datetime, timedelta
+import src.replies as rp
+
+
+def sample_kwargs(s):
+    """Arguments that fit the fields of the format string `s`."""
+    kw = {}
+    for _, field, spec, conversion in rp.CustomFormatter().parse(s):
+        if field is None:
+            continue
+        if conversion == "t":
+            kw[field] = datetime(2024, 5, 6, 7, 8)
+        elif conversion == "d":
+            kw[field] = timedelta(hours=3, minutes=20)
+        elif spec.endswith("f"):
+            kw[field] = 0.25
+        elif spec.endswith("d") or spec.endswith("n"):
+            kw[field] = 42
+        else:
+            kw[field] = "<b>x & y</b>"
+    return kw
+
+
+class TestFormatForTelegram(unittest.TestCase):
+
+    def setUp(self):
+        self.localization = rp.localization
+        rp.localization = {}
+
+    def tearDown(self):
+        rp.localization = self.localization
+
+    def test_same_as_formatter(self):
+        """Test that compiled templates give the same text as str.format did."""
+        n = 0
+        for type, s in rp.format_strs.items():
+            if callable(s):
+                continue
+            kw = sample_kwargs(s)
+            expected = rp.CustomFormatter().format(s, **dict(rp.defaults, **kw))
+            for i in range(2): # compiled, then cached
+                self.assertEqual(rp.formatForTelegram(rp.Reply(type, **kw)), expected)
+            n += 1
+        self.assertGreater(n, 40)
+        reply = rp.Reply(rp.types.BOOLEAN_CONFIG, description="a<b", enabled=True)
+        self.assertEqual(rp.formatForTelegram(reply), "<b>a&#60;b</b>: enabled")
+        reply = rp.Reply(rp.types.SUCCESS_WARN, id="abc", cooldown="1h")
+        self.assertEqual(rp.formatForTelegram(reply), "☑ <b>abc</b> <i>has been warned (cooldown: 1h)</i>")
+
+    def test_cache_invalidation(self):
+        """Test memoized replies and that changing localization or defaults resets them."""
+        text = rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED))
+        self.assertIs(rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED)), text)
+        rp.localization = {rp.types.ERR_COMMAND_DISABLED: "nope"}
+        self.assertEqual(rp.formatForTelegram(rp.Reply(rp.types.ERR_COMMAND_DISABLED)), "nope")
+
+        bot_name = rp.defaults["bot_name"]
+        try:
+            rp.defaults["bot_name"] = "A"
+            self.assertIn("A lounge", rp.formatForTelegram(rp.Reply(rp.types.CHAT_LEAVE)))
+            rp.defaults["bot_name"] = "B"
+            self.assertIn("B lounge", rp.formatForTelegram(rp.Reply(rp.types.CHAT_LEAVE)))
+        finally:
+            rp.defaults["bot_name"] = bot_name
+
+
+if __name__ == '__main__':
+    unittest.main()
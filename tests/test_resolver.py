@@ -0,0 +1,120 @@
+"""Tests for the tiered message resolver."""
+import unittest
+from src.cache import Cache
+from src.resolver import MessageResolver
+
+
+class FakeDatabase:
+    """Minimal stand-in for the message mapping part of SQLiteDatabase."""
+    
+    def __init__(self):
+        self.mappings = {}  # (uid, message_id) -> msid
+        self.queries = 0
+    
+    def save_message_mapping(self, uid, msid, message_id, bot_id=None):
+        self.mappings[(uid, message_id)] = msid
+    
+    def get_msid_by_uid_message(self, uid, message_id, bot_id=None):
+        self.queries += 1
+        return self.mappings.get((uid, message_id))
+    
+    def get_message_id_by_uid_msid(self, uid, msid, bot_id=None):
+        self.queries += 1
+        return next((mid for (_uid, mid), m in self.mappings.items() if _uid == uid and m == msid), None)
+    
+    def get_recipient_mappings_by_msid(self, msid, bot_id=None):
+        self.queries += 1
+        return [(uid, mid) for (uid, mid), m in self.mappings.items() if m == msid]
+
+
+class TestMessageResolver(unittest.TestCase):
+    
+    def setUp(self):
+        """Create a resolver backed by an empty cache and fake DB."""
+        self.ch = Cache()
+        self.db = FakeDatabase()
+        self.resolver = MessageResolver(self.ch, self.db, bot_id=1)
+    
+    def test_l1_hit(self):
+        """Test that cached mappings don't touch the database."""
+        self.resolver.saveMapping(10, 100, 1000)
+        self.assertEqual(self.resolver.getMsid(10, 1000), 100)
+        self.assertEqual(self.resolver.getMessageId(10, 100), 1000)
+        self.assertEqual(self.db.queries, 0)
+        self.assertEqual(self.resolver.getStats()["l1_hits"], 2)
+    
+    def test_l2_hit(self):
+        """Test falling back to the database."""
+        self.db.save_message_mapping(10, 100, 1000)
+        self.assertEqual(self.resolver.getMsid(10, 1000), 100)
+        self.assertEqual(self.resolver.getMessageId(10, 100), 1000)
+        self.assertEqual(self.resolver.getStats()["l2_hits"], 2)
+    
+    def test_negative_caching(self):
+        """Test that repeated misses only query the database once."""
+        self.assertIsNone(self.resolver.getMsid(10, 1000))
+        self.assertIsNone(self.resolver.getMsid(10, 1000))
+        self.assertEqual(self.db.queries, 1)
+        stats = self.resolver.getStats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["negative_hits"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.0)
+    
+    def test_save_clears_negative_entry(self):
+        """Test that saving a mapping makes a previous miss resolvable."""
+        self.assertIsNone(self.resolver.getMessageId(10, 100))
+        self.resolver.saveMapping(10, 100, 1000)
+        self.assertEqual(self.resolver.getMessageId(10, 100), 1000)
+        self.assertEqual(self.resolver.getMsid(10, 1000), 100)
+
+    
+    def test_batch_lookup(self):
+        """Test resolving all copies of a message at once."""
+        self.db.save_message_mapping(10, 100, 1000)
+        self.db.save_message_mapping(11, 100, 2000)
+        self.assertEqual(self.resolver.getMessageIds(100), {10: 1000, 11: 2000})
+        self.assertEqual(self.db.queries, 1)
+        self.resolver.saveMapping(12, 101, 3000)
+        self.assertEqual(self.resolver.getMessageIds(101), {12: 3000})
+        self.assertEqual(self.db.queries, 1)
+        self.assertEqual(self.resolver.getMessageIds(102), {})
+        self.assertEqual(self.resolver.getMessageIds(102), {})
+        self.assertEqual(self.db.queries, 2)
+
+
+class TestSQLiteMessageLookup(unittest.TestCase):
+    
+    def setUp(self):
+        """Create an in-memory SQLite database."""
+        from src.database import SQLiteDatabase
+        self.db = SQLiteDatabase(":memory:")
+    
+    def tearDown(self):
+        self.db.close()
+    
+    def test_point_lookup(self):
+        """Test the (uid, msid) -> message_id query."""
+        self.db.save_message_mapping(10, 100, 1000, bot_id=1)
+        self.db.save_message_mapping(11, 100, 2000, bot_id=1)
+        self.assertEqual(self.db.get_message_id_by_uid_msid(11, 100, bot_id=1), 2000)
+        self.assertIsNone(self.db.get_message_id_by_uid_msid(12, 100, bot_id=1))
+        self.assertIsNone(self.db.get_message_id_by_uid_msid(11, 100, bot_id=2))
+    
+    def test_point_lookup_uses_index(self):
+        """Test that the point lookup is served by idx_mm_uid_msid."""
+        for bot_id in (1, None):
+            # capture the statement get_message_id_by_uid_msid actually runs
+            statements = []
+            self.db.db.set_trace_callback(statements.append)
+            try:
+                self.db.get_message_id_by_uid_msid(1, 1, bot_id=bot_id)
+            finally:
+                self.db.db.set_trace_callback(None)
+            sql = [s for s in statements if "message_mapping" in s]
+            self.assertEqual(len(sql), 1)
+            plan = self.db.db.execute("EXPLAIN QUERY PLAN " + sql[0]).fetchall()
+            self.assertIn("idx_mm_uid_msid", " ".join(str(row[-1]) for row in plan))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""Tests for the sampling profiler."""
+import os
+import tempfile
+import threading
+import unittest
+from src.sampler import SamplingProfiler
+
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def test_collapsed_stacks(self):
+        """Test that other threads' stacks are written in collapsed format."""
+        stop = threading.Event()
+        worker = threading.Thread(target=_spin, args=(stop, ), name="busy worker")
+        worker.start()
+        done = threading.Event()
+        result = []
+        def on_done(path, samples):
+            result.append((path, samples))
+            done.set()
+        profiler = SamplingProfiler(interval=0.005)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub", "profile.folded")
+            try:
+                self.assertTrue(profiler.start(0.3, path, on_done))
+                self.assertFalse(profiler.start(1, path))
+                self.assertTrue(done.wait(5))
+            finally:
+                stop.set()
+                worker.join()
+            with open(path) as f:
+                lines = f.read().splitlines()
+
+        self.assertEqual(result[0][0], path)
+        self.assertGreater(result[0][1], 10)
+        busy = [l for l in lines if l.startswith("busy_worker;")]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(" ", 1)
+        self.assertIn("test_sampler.py:_spin", stack)
+        self.assertGreater(int(count), 0)
+        self.assertFalse(any("SamplingProfiler" in l for l in lines))
+        profiler.thread.join()
+        self.assertFalse(profiler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for the lazily decaying spam scores."""
+import unittest
+from src.core import ScoreKeeper
+from src.globals import SPAM_LIMIT, SPAM_LIMIT_HIT
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestScoreKeeper(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.sk = ScoreKeeper(interval=5, clock=self.clock)
+
+    def test_limit(self):
+        """Test that crossing the limit blocks the user until the score decays."""
+        for i in range(SPAM_LIMIT):
+            self.assertTrue(self.sk.increaseSpamScore(1, 1))
+        # the message crossing the limit still passes, but sets the penalty score
+        self.assertTrue(self.sk.increaseSpamScore(1, 1))
+        self.assertEqual(self.sk.getSpamScore(1), SPAM_LIMIT_HIT)
+        self.assertFalse(self.sk.increaseSpamScore(1, 0.1))
+        # blocked scores don't increase further
+        self.assertEqual(self.sk.getSpamScore(1), SPAM_LIMIT_HIT)
+        # a single message scoring above the penalty is refused outright
+        self.assertFalse(self.sk.increaseSpamScore(2, SPAM_LIMIT_HIT + 1))
+        self.assertEqual(self.sk.getSpamScore(3), 0)
+
+    def test_decay(self):
+        """Test that scores drop by 1 per interval and never below zero."""
+        self.sk.increaseSpamScore(1, 3)
+        self.clock.now += 5
+        self.assertAlmostEqual(self.sk.getSpamScore(1), 2)
+        self.clock.now += 2.5
+        self.assertAlmostEqual(self.sk.getSpamScore(1), 1.5)
+        self.clock.now += 60
+        self.assertEqual(self.sk.getSpamScore(1), 0)
+        # a long quiet period doesn't give credit for later messages
+        for i in range(SPAM_LIMIT):
+            self.assertTrue(self.sk.increaseSpamScore(1, 1))
+        self.assertAlmostEqual(self.sk.getSpamScore(1), SPAM_LIMIT)
+        self.clock.now += 60
+        self.assertFalse(self.sk.increaseSpamScore(1, SPAM_LIMIT_HIT + 1))
+
+        self.sk.increaseSpamScore(2, SPAM_LIMIT + 1)
+        self.assertFalse(self.sk.increaseSpamScore(2, 0.1))
+        self.clock.now += 5 * (SPAM_LIMIT_HIT - SPAM_LIMIT) + 0.1
+        self.assertTrue(self.sk.increaseSpamScore(2, 0.1))
+
+    def test_prune(self):
+        """Test that users whose score decayed to zero are forgotten."""
+        for uid in range(1, 101):
+            self.sk.increaseSpamScore(uid, 1)
+        self.assertEqual(len(self.sk.scores), 100)
+        self.clock.now += 5
+        for i in range(200):
+            self.assertTrue(self.sk.increaseSpamScore(1000, 0.01))
+        self.assertEqual(set(self.sk.scores), {1000})
+        self.assertEqual(self.sk.getSpamScore(1), 0)
+        # a zero score doesn't need an entry at all
+        self.assertTrue(self.sk.increaseSpamScore(1001, 0))
+        self.assertNotIn(1001, self.sk.scores)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests for per-message relay tracing."""
+import importlib.util
+import json
+import os
+import tempfile
+import unittest
+from src.tracing import Tracer
+
+_spec = importlib.util.spec_from_file_location("trace_summary",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "util", "trace_summary.py"))
+trace_summary = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(trace_summary)
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "trace.log")
+        self.tracer = Tracer(self.path)
+
+    def tearDown(self):
+        self.tracer.close()
+        self.tmp.cleanup()
+
+    def spans(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_lifecycle(self):
+        """Test that a span is written once every copy is persisted or failed."""
+        trace = self.tracer.begin("text")
+        self.tracer.stamp(trace, "spam")
+        self.tracer.bind(trace, 1)
+        # the send thread may finish copies before enqueueing is done
+        self.tracer.delivered(1)
+        self.tracer.persisted(1)
+        self.tracer.enqueued(trace, 3)
+        self.tracer.failed(1)
+        self.assertEqual(self.spans(), [])
+        self.tracer.delivered(1)
+        self.tracer.persisted(1)
+
+        span, = self.spans()
+        self.assertEqual(span["msid"], 1)
+        self.assertEqual(span["type"], "text")
+        self.assertEqual((span["n"], span["ok"], span["failed"]), (3, 2, 1))
+        stages = ["spam", "assign", "first", "last", "persist"]
+        self.assertEqual([span[s] for s in stages], sorted(span[s] for s in stages))
+        self.assertNotIn("incomplete", span)
+
+    def test_expire_and_summary(self):
+        """Test writing unfinished traces and summarising them per type."""
+        self.tracer.timeout = 0
+        trace = self.tracer.begin("photo")
+        self.tracer.bind(trace, 2)
+        self.tracer.enqueued(trace, 5)
+        # a message without recipients is complete right away
+        other = self.tracer.begin("text")
+        self.tracer.bind(other, 3)
+        self.tracer.enqueued(other, 0)
+        self.tracer.expire()
+
+        summary = trace_summary.summarise(trace_summary.read_spans([self.path]))
+        self.assertEqual(summary["photo"]["messages"], 1)
+        self.assertEqual(summary["photo"]["incomplete"], 1)
+        self.assertEqual(summary["photo"]["copies"], 5)
+        self.assertIn("enqueue", summary["photo"]["stages"])
+        self.assertEqual(summary["text"]["incomplete"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
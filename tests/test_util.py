@@ -0,0 +1,47 @@
+"""Tests for utility classes."""
+import threading
+import unittest
+from src.util import OrderedWorkerPool
+
+
+class TestOrderedWorkerPool(unittest.TestCase):
+    
+    def test_per_key_order(self):
+        """Test that items with the same key are processed in order."""
+        seen = {}
+        lock = threading.Lock()
+        def func(item):
+            key, n = item
+            with lock:
+                seen.setdefault(key, []).append(n)
+        
+        pool = OrderedWorkerPool(func, workers=3, maxsize=8)
+        pool.start()
+        for n in range(200):
+            for key in range(5):
+                pool.submit(key, (key, n))
+        pool.join()
+        
+        self.assertEqual(len(seen), 5)
+        for key in range(5):
+            self.assertEqual(seen[key], list(range(200)))
+    
+    def test_exception_does_not_kill_worker(self):
+        """Test that a failing item doesn't stop the worker."""
+        done = []
+        def func(item):
+            if item == 0:
+                raise ValueError()
+            done.append(item)
+        
+        pool = OrderedWorkerPool(func, workers=1)
+        pool.start()
+        with self.assertLogs(level="ERROR"):
+            pool.submit(1, 0)
+            pool.submit(1, 1)
+            pool.join()
+        self.assertEqual(done, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 """Tests for input validation utilities."""
+import random
+import unicodedata
 import unittest
+from src.globals import escape_html
 from src.validation import (
     sanitize_text, 
     sanitize_username, 
@@ -41,6 +44,65 @@ class TestSanitizeText(unittest.TestCase):
         self.assertIsNone(result)
 
 
+def old_escape_html(s):
+    ret = ""
+    for c in s:
+        if c in ("<", ">", "&"):
+            c = "&#" + str(ord(c)) + ";"
+        ret += c
+    return ret
+
+
+def old_sanitize_text(text, max_length=500):
+    if not text or not isinstance(text, str):
+        return None
+    text = text.strip()
+    if not text:
+        return None
+    if len(text) > max_length:
+        text = text[:max_length]
+    text = ''.join(
+        c for c in text
+        if c in ('\n', '\t') or not unicodedata.category(c).startswith('C')
+    )
+    return text.strip() if text.strip() else None
+
+
+class TestEquivalence(unittest.TestCase):
+    """Fuzz the table-driven implementations against the per-character ones they replaced."""
+
+    # plain text, HTML, whitespace, controls, format characters, separators,
+    # surrogates, private use, unassigned code points and astral characters
+    ALPHABET = ("abc XYZ 019 <>&;#\n\t\r\x00\x07\x1b\x7f\x85\xa0\xad\u200b\u200e"
+        "\u2028\u2029\u3000\ud800\udfff\ue000\ufeff\uffff\u0378\u00e9\u4e2d"
+        "\U0001f642\U000e0001\U0010fffd")
+
+    def random_text(self, rng):
+        n = rng.choice((0, 1, 5, 50, 600))
+        return "".join(rng.choice(self.ALPHABET) for i in range(n))
+
+    def test_escape_html(self):
+        rng = random.Random(1)
+        for i in range(2000):
+            s = self.random_text(rng)
+            self.assertEqual(escape_html(s), old_escape_html(s))
+
+    def test_sanitize_text(self):
+        rng = random.Random(2)
+        for i in range(2000):
+            s = self.random_text(rng)
+            max_length = rng.choice((30, 500, 4000))
+            self.assertEqual(sanitize_text(s, max_length=max_length), old_sanitize_text(s, max_length))
+
+    def test_sanitize_text_table_bounded(self):
+        """Test that text with many distinct code points doesn't grow the translate table without bound."""
+        from src.validation import _CONTROL_CHARS
+        s = "".join(chr(cp) for cp in range(0xf0000, 0xf0000 + 3 * _CONTROL_CHARS.max_size)) + "a\x00b"
+        s += "".join(chr(cp) for cp in range(0x4e00, 0x4e00 + 2 * _CONTROL_CHARS.max_size))
+        self.assertEqual(sanitize_text(s, max_length=len(s)), old_sanitize_text(s, len(s)))
+        self.assertLessEqual(len(_CONTROL_CHARS), _CONTROL_CHARS.max_size)
+
+
 class TestSanitizeUsername(unittest.TestCase):
     
     def test_valid_username(self):
@@ -122,6 +184,17 @@ class TestValidateConfig(unittest.TestCase):
         }
         errors = validate_config(config)
         self.assertTrue(any("database type" in e for e in errors))
+    
+    def test_webhook_config(self):
+        config = {
+            "bot_token": "test",
+            "webhook": {"url": "https://example.com/hook", "secret_token": "abc_123-XYZ"}
+        }
+        self.assertEqual(validate_config(config), [])
+        config["webhook"] = {"url": "http://example.com/hook", "secret_token": "bad token!"}
+        errors = validate_config(config)
+        self.assertTrue(any("webhook.url" in e for e in errors))
+        self.assertTrue(any("webhook.secret_token" in e for e in errors))
 
 
 if __name__ == '__main__':
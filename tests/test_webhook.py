@@ -0,0 +1,157 @@
+"""Tests for receiving updates: the webhook receiver and the start of polling."""
+import json
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+import src.core as core
+import src.telegram as telegram
+from src.cache import Cache
+from src.database import SQLiteDatabase, User
+from src.webhook import WebhookServer, SECRET_TOKEN_HEADER
+from tests.fake_bot_api import FakeBotAPI
+
+# Updates as recorded from the Bot API
+RECORDED_UPDATES = [
+    {"update_id": 100000001, "message": {"message_id": 11,
+        "from": {"id": 1234, "is_bot": False, "first_name": "A", "username": "a_user"},
+        "chat": {"id": 1234, "first_name": "A", "username": "a_user", "type": "private"},
+        "date": 1700000000, "text": "hello"}},
+    {"update_id": 100000002, "message": {"message_id": 12,
+        "from": {"id": 1234, "is_bot": False, "first_name": "A"},
+        "chat": {"id": 1234, "first_name": "A", "type": "private"},
+        "date": 1700000001, "text": "/start",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}]}},
+    {"update_id": 100000003, "message_reaction": {"message_id": 11,
+        "chat": {"id": 1234, "type": "private"}, "user": {"id": 1234, "is_bot": False, "first_name": "A"},
+        "date": 1700000002, "old_reaction": [], "new_reaction": [{"type": "emoji", "emoji": "\U0001F44D"}]}},
+]
+
+
+def post(port, body, token="s3cret", path="/hook"):
+    req = urllib.request.Request("http://127.0.0.1:%d%s" % (port, path),
+        data=body, method="POST", headers={"Content-Type": "application/json"})
+    if token is not None:
+        req.add_header(SECRET_TOKEN_HEADER, token)
+    try:
+        with urllib.request.urlopen(req, timeout=5) as resp:
+            return resp.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+class TestWebhookServer(unittest.TestCase):
+    
+    def setUp(self):
+        self.received = []
+        self.server = WebhookServer(self.received.append, "s3cret", port=0, path="/hook")
+        self.thread = threading.Thread(target=self.server.httpd.serve_forever, daemon=True)
+        self.thread.start()
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+    
+    def post(self, body, token="s3cret", path="/hook"):
+        return post(self.server.port, body, token, path)
+    
+    def test_recorded_updates(self):
+        """Test that recorded updates are delivered in order."""
+        for update in RECORDED_UPDATES:
+            self.assertEqual(self.post(json.dumps(update).encode()), 200)
+        self.assertEqual(self.received, RECORDED_UPDATES)
+    
+    def test_rejects_bad_token(self):
+        """Test that requests without the right secret token are refused."""
+        body = json.dumps(RECORDED_UPDATES[0]).encode()
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(self.post(body, token="wrong"), 403)
+            self.assertEqual(self.post(body, token=None), 403)
+        self.assertEqual(self.received, [])
+    
+    def test_rejects_bad_request(self):
+        """Test wrong paths and malformed bodies."""
+        self.assertEqual(self.post(b"{}", path="/other"), 404)
+        self.assertEqual(self.post(b"not json"), 400)
+        self.assertEqual(self.received, [])
+
+
+class TestWebhookUpdates(unittest.TestCase):
+    """Updates posted to the bot's webhook, through to the handlers."""
+    
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.db = SQLiteDatabase(":memory:")
+        user = User()
+        user.defaults()
+        user.id = 1234
+        user.realname = "A"
+        self.db.addUser(user)
+        config = {"bot_token": "123:abc", "update_workers": 0, "http_pool_size": 0,
+            "karma_digest_interval": 0,
+            "webhook": {"url": "https://example.org/hook", "secret_token": "s3cret", "port": 0}}
+        core.init(config, self.db, Cache())
+        telegram.init(config, self.db, core.ch)
+        self.server = telegram._webhook_server()
+        telegram.update_pool.start()
+        self.thread = threading.Thread(target=self.server.httpd.serve_forever, daemon=True)
+        self.thread.start()
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        telegram.webhook = telegram.update_pool = None
+        self.db.close()
+        self.api.__exit__(None, None, None)
+    
+    def test_updates_reach_handlers_in_order(self):
+        """Test that posted updates are processed one by one, in order, even without update_workers."""
+        self.assertEqual(len(telegram.update_pool.queues), 1)
+        updates = []
+        for i, cmd in enumerate(("/info", "/help", "/info")):
+            updates.append({"update_id": 1 + i, "message": {"message_id": 20 + i,
+                "from": {"id": 1234, "is_bot": False, "first_name": "A"},
+                "chat": {"id": 1234, "type": "private"}, "date": int(time.time()), "text": cmd,
+                "entities": [{"offset": 0, "length": len(cmd), "type": "bot_command"}]}})
+        for update in updates:
+            self.assertEqual(post(self.server.port, json.dumps(update).encode()), 200)
+        deadline = time.monotonic() + 5
+        while self.api.count("sendMessage") < 3 and time.monotonic() < deadline:
+            time.sleep(0.02)
+        replies = [(json.loads(p["reply_parameters"])["message_id"], p["text"])
+            for method, p in self.api.calls if method == "sendMessage"]
+        self.assertEqual([mid for mid, text in replies], [20, 21, 22])
+        self.assertIn("Show available commands", replies[1][1])
+
+
+class TestPollingStart(unittest.TestCase):
+    
+    def setUp(self):
+        self.api = FakeBotAPI().__enter__()
+        self.db = SQLiteDatabase(":memory:")
+        config = {"bot_token": "123:abc", "update_workers": 1, "http_pool_size": 0, "karma_digest_interval": 0}
+        core.init(config, self.db, Cache())
+        telegram.init(config, self.db, core.ch)
+    
+    def tearDown(self):
+        telegram.update_pool = None
+        self.db.close()
+        self.api.__exit__(None, None, None)
+    
+    def test_skip_pending_updates(self):
+        """Test that updates pending at startup, including the last one, aren't polled again."""
+        pushed = [self.api.push_update(update) for update in RECORDED_UPDATES]
+        offset = telegram._skip_pending_updates()
+        self.assertEqual(offset, pushed[-1]["update_id"] + 1)
+        self.assertEqual(telegram.bot.get_updates(offset=offset, long_polling_timeout=1), [])
+        new = self.api.push_update(RECORDED_UPDATES[0])
+        updates = telegram.bot.get_updates(offset=offset, long_polling_timeout=1)
+        self.assertEqual([u.update_id for u in updates], [new["update_id"]])
+        # nothing pending
+        self.api.updates.clear()
+        self.assertIsNone(telegram._skip_pending_updates())
+
+
+if __name__ == '__main__':
+    unittest.main()
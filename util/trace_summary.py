@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""Summarise relay traces written by the bot when `trace_file` is set.
+
+Prints, per message type, the latency distribution of each lifecycle stage
+relative to ingestion; "last" is the fan-out latency (all copies sent) and
+"persist" includes saving the last mapping.
+
+Usage: util/trace_summary.py [--since HOURS] [--json] trace.log [trace.log.1 ...]
+"""
+import argparse
+import json
+import time
+
+STAGES = ("spam", "assign", "enqueue", "first", "last", "persist")
+QUANTILES = (50, 90, 99)
+
+def read_spans(paths, since=None):
+	for path in paths:
+		with open(path) as f:
+			for line in f:
+				try:
+					span = json.loads(line)
+				except ValueError:
+					continue # truncated line at rotation
+				if since is not None and span.get("ts", 0) < since:
+					continue
+				yield span
+
+def percentile(values, p):
+	return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def summarise(spans):
+	"""Return dict(type -> summary) for an iterable of spans."""
+	ret = {}
+	for span in spans:
+		s = ret.setdefault(span.get("type") or "unknown",
+			{"messages": 0, "incomplete": 0, "copies": 0, "failed": 0, "stages": {}})
+		s["messages"] += 1
+		s["incomplete"] += 1 if span.get("incomplete") else 0
+		s["copies"] += span.get("n") or 0
+		s["failed"] += span.get("failed", 0)
+		for stage in STAGES:
+			if stage in span:
+				s["stages"].setdefault(stage, []).append(span[stage])
+	for s in ret.values():
+		for stage, values in s["stages"].items():
+			values.sort()
+			d = {"p%d" % p: percentile(values, p) for p in QUANTILES}
+			d["max"] = values[-1]
+			s["stages"][stage] = d
+	return ret
+
+def main():
+	parser = argparse.ArgumentParser(description="Summarise relay traces per message type")
+	parser.add_argument("files", nargs="+", help="trace files, rotated ones included")
+	parser.add_argument("--since", type=float, help="only messages from the last HOURS")
+	parser.add_argument("--json", action="store_true", help="print JSON instead of a table")
+	args = parser.parse_args()
+
+	since = time.time() - args.since * 3600 if args.since is not None else None
+	summary = summarise(read_spans(args.files, since))
+	if args.json:
+		print(json.dumps(summary, indent=2))
+		return
+	if len(summary) == 0:
+		print("No traced messages found.")
+		return
+	for type, s in sorted(summary.items(), key=lambda e: -e[1]["messages"]):
+		print("%s: %d messages, %d copies (%d failed), %d incomplete" % (
+			type, s["messages"], s["copies"], s["failed"], s["incomplete"]))
+		print("  %-8s %10s %10s %10s %10s" % (("stage", ) + tuple("p%d ms" % p for p in QUANTILES) + ("max ms", )))
+		for stage in STAGES:
+			d = s["stages"].get(stage)
+			if d is None:
+				continue
+			print("  %-8s %10.1f %10.1f %10.1f %10.1f" % (stage, d["p50"], d["p90"], d["p99"], d["max"]))
+
+if __name__ == "__main__":
+	main()